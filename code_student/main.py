@@ -1,113 +1,145 @@
-import datetime
-from threading import Thread
 from typing import Optional
 
 from appJar import gui
 from enum import Enum
-from uuid import uuid1
 
-from stmpy import Machine, Driver
+from stmpy import Machine
 
-from code_student.queue_manager import QueueManager
+from common.queue_manager import QueueManager
 from code_student.stm_utils import get_stm_transitions, get_stm_states
+from common.clock import ClockDriver, get_clock
+from common.dispatcher import MessageDispatcher
+from common import metrics, profiling
+from common.logger import DEBUG, get_logger
+from common.transport import Transport, PahoTransport
+from common.sequencer import EventSequencer
+from common.storage import get_store
 from common.feedback import Feedback
-from common.io_utils import import_modules, import_groups
+from common.refresh_scheduler import RefreshScheduler
+from common.ui_utils import SpacerFactory
+from common.catalog import Catalog, add_catalog_listener, get_catalog, watch_catalog
 from common.help_request import HelpRequest
-import paho.mqtt.client as mqtt
+from common.mqtt_utils import TOPIC_QUEUE, TOPIC_TA, TOPIC_SERVER, TOPIC_SNAPSHOT, TOPIC_RESYNC, \
+    RequestWrapper, TYPE_ADD_HELP_REQUEST, TYPE_CANCEL_HELP_REQUEST, TYPE_SEND_FEEDBACK, TOPIC_TASK, \
+    TYPE_CLAIM_REQUEST, TYPE_CONFIRM_CLAIM, TYPE_RESOLVE_REQUEST, TYPE_CANCEL_CLAIM, TYPE_QUEUE_EVENT, \
+    TYPE_QUEUE_SNAPSHOT, TYPE_RESYNC_REQUEST, QUEUE_OP_ADD, QUEUE_OP_REMOVE, TYPE_NAMES, Message
 
-from common.mqtt_utils import BROKER, PORT, TOPIC_QUEUE, TOPIC_TA, RequestWrapper, TYPE_ADD_HELP_REQUEST, \
-    TYPE_CANCEL_HELP_REQUEST, TYPE_SEND_FEEDBACK, TOPIC_TASK, TYPE_CLAIM_REQUEST, \
-    parse_claim_request, TYPE_CONFIRM_CLAIM, TYPE_RESOLVE_REQUEST, parse_body_field, TYPE_CANCEL_CLAIM
+log = get_logger("student")
 
+SCENE_SECONDS = metrics.histogram("scene_render_seconds", "Time spent in show_scene(), by scene")
 
-def clear_retained_messages(client: mqtt.Client):
-    client.publish(TOPIC_QUEUE, payload=None, retain=True)
-    client.publish(TOPIC_TA, payload=None, retain=True)
 
+def clear_retained_messages(transport: Transport):
+    transport.publish(TOPIC_QUEUE, payload=None, retain=True)
+    transport.publish(TOPIC_TA, payload=None, retain=True)
 
-class MQTTClient:
-    def __init__(self, stm: Machine):
-        self.client = mqtt.Client()
 
-        # mqtt setup
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        print(f"Trying to connect to {BROKER}")
-        # clear_retained_messages(self.client)
-        self.client.connect(BROKER, PORT)
-        self.client.subscribe(TOPIC_QUEUE)
+@profiling.profile_methods("on_message", "handle_message")
+class MQTTClient:
+    def __init__(self, stm: Machine, transport: Optional[Transport] = None, dispatcher_workers: int = 1):
+        # mqtt setup, the real broker unless another transport (e.g. a loopback bus) is given
+        self.transport = transport if transport is not None else PahoTransport()
+        self.transport.on_message = self.on_message
+        # clear_retained_messages(self.transport)
+        self.transport.connect()
+        self.transport.subscribe(TOPIC_QUEUE)
+        self.transport.subscribe(TOPIC_SNAPSHOT)  # retained, gives the current queue right after connecting
+        self.transport.subscribe(TOPIC_SERVER)
 
         # misc
         self.stm = stm
         self.ta_claiming_request = None
-        self.request_claimed = None
-        self.request_to_resolve = None
-        self.request_to_cancel = None
 
         # queue sys
         self.queue_manager = QueueManager()
         self.recently_added_req_id = None
-        try:
-            thread = Thread(target=self.client.loop_forever)
-            thread.start()
-        except KeyboardInterrupt:
-            self.client.disconnect()
-
-    def on_connect(self, client, userdata, flags, rc):
-        print(format(mqtt.connack_string(rc)))
-
-    def on_message(self, client, userdata, msg: mqtt.MQTTMessage):
-        print("on_message(): topic: {}, data: {}".format(msg.topic, msg.payload))
-        request_type = int(str(msg.payload).split(": ")[1][0])
-        payload = str(msg.payload).replace("\\", "")
-        if request_type == TYPE_ADD_HELP_REQUEST:
-            req_id = parse_body_field(payload, "id")
-            is_mine = self.recently_added_req_id == req_id
-            self.queue_manager.on_add(req_id, datetime.datetime.now(), is_mine)
-            self.stm.send("sig_update_queue_pos")
-        elif request_type == TYPE_CANCEL_HELP_REQUEST:
-            req_id = parse_body_field(payload, "id")
-            self.queue_manager.on_cancel(req_id)
-            self.stm.send("sig_update_queue_pos")
+        # queue events are applied in sequence order, missed ones are requested again from the queue server
+        self.sequencer = EventSequencer(self.apply_queue_event, self.request_resync, on_restart=self.on_server_restart)
+
+        # messages are handled on a worker thread, keeping the network thread free
+        self.dispatcher = MessageDispatcher(self.handle_message, workers=dispatcher_workers)
+        self.transport.start()
+
+    def on_message(self, topic: str, payload: bytes):
+        self.dispatcher.submit(topic, payload)
+
+    def handle_message(self, topic: str, message: Message):
+        """ Runs on the dispatcher worker thread """
+        request_type = message.request_type
+        if log.enabled(DEBUG):
+            log.debug("Message", topic=topic, type=TYPE_NAMES.get(request_type), data=message.data)
+        if request_type == TYPE_QUEUE_EVENT:
+            # the queue itself is maintained by the queue server, we only apply its results
+            self.on_queue_event(message)
+        elif request_type == TYPE_QUEUE_SNAPSHOT:
+            self.on_queue_snapshot(message)
         elif request_type == TYPE_CLAIM_REQUEST:
-            print("Received claim request from ta")
-            if self.ta_claiming_request is not None:
-                return
-            request_id, ta_name = parse_claim_request(payload)
-            self.ta_claiming_request = ta_name
-            self.request_claimed = request_id
-            self.stm.send("sig_receive_request_claim")
+            log.debug("Received claim request", type="claim_request", id=message.get("id"), ta=message.get("ta"))
+            self.stm.send("sig_receive_request_claim", args=[message.get("id"), message.get("ta")])
         elif request_type == TYPE_RESOLVE_REQUEST:
-            req_id = parse_body_field(payload, "id")
-            self.request_to_resolve = req_id
-            self.queue_manager.on_resolve(req_id)
-            self.stm.send("sig_update_queue_pos")
-            self.stm.send("sig_receive_request_resolution")
+            self.stm.send("sig_receive_request_resolution", args=[message.get("id")])
         elif request_type == TYPE_CANCEL_CLAIM:
-            self.request_to_cancel = parse_body_field(payload, "id")
-            self.stm.send("sig_cancel_claim")
+            self.stm.send("sig_cancel_claim", args=[message.get("id")])
+
+    def on_queue_event(self, message: Message):
+        if self.sequencer.accept_epoch(message.get("epoch")):
+            self.sequencer.offer(message.get("seq"), message)
+
+    def on_server_restart(self):
+        log.warning("Queue server restarted, starting over from its queue", epoch=self.sequencer.epoch)
+        self.queue_manager.clear()
+        self.stm.send("sig_update_queue_pos")
+
+    def apply_queue_event(self, message: Message):
+        req_id = message.get("id")
+        op = message.get("op")
+        if op == QUEUE_OP_ADD:
+            is_mine = self.recently_added_req_id == req_id
+            self.queue_manager.on_add(req_id, get_clock().now(), is_mine, seq=message.get("seq"))
+        elif op == QUEUE_OP_REMOVE:
+            self.queue_manager.on_cancel(req_id)
+        else:
+            return
+        self.stm.send("sig_update_queue_pos")
+
+    def on_queue_snapshot(self, message: Message):
+        if not self.sequencer.accept_epoch(message.get("epoch")) or message.get("seq") <= self.sequencer.last_seq:
+            # from an older run of the queue server, or we are already up to date
+            return
+        self.queue_manager.clear()
+        now = get_clock().now()
+        for entry in message.body:
+            is_mine = self.recently_added_req_id == entry["id"]
+            self.queue_manager.on_add(entry["id"], now, is_mine, seq=entry["seq"])
+        self.stm.send("sig_update_queue_pos")
+        self.sequencer.reset(message.get("seq"))  # applies the buffered events that follow the snapshot
+
+    def request_resync(self, first: int, last: int):
+        log.warning("Missed queue events, asking the queue server for them", first=first, last=last)
+        req_body = RequestWrapper(TYPE_RESYNC_REQUEST, {"from": first, "to": last}).payload()
+        self.transport.publish(TOPIC_RESYNC, payload=req_body)
 
     def request_help(self, request: HelpRequest) -> bool:
         """ Send help request """
-        print(f"Sending help request")
+        log.info("Sending help request", id=request.id, group=request.group_number)
         req_body = RequestWrapper(TYPE_ADD_HELP_REQUEST, request.payload()).payload()
         self.recently_added_req_id = request.id
-        return self.client.publish(TOPIC_QUEUE, payload=req_body).is_published()
+        return self.transport.publish(TOPIC_QUEUE, payload=req_body)
 
     def cancel_request(self, request_id: str) -> bool:
         """ Cancel help request by id """
-        print(f"Cancelling help request with id {request_id}")
-        req_body = RequestWrapper(TYPE_CANCEL_HELP_REQUEST, str({"id": request_id})).payload()
-        return self.client.publish(TOPIC_QUEUE, payload=req_body).is_published()
+        log.info("Cancelling help request", id=request_id)
+        req_body = RequestWrapper(TYPE_CANCEL_HELP_REQUEST, {"id": request_id}).payload()
+        return self.transport.publish(TOPIC_QUEUE, payload=req_body)
 
     def send_feedback(self, feedback: Feedback) -> bool:
         req_body = RequestWrapper(TYPE_SEND_FEEDBACK, feedback.payload())
-        return self.client.publish(TOPIC_TASK, payload=req_body.payload()).is_published()
+        return self.transport.publish(TOPIC_TASK, payload=req_body.payload())
 
-    def confirm_claim(self, ta: str) -> bool:
-        print("Confirming claim")
-        req_body = RequestWrapper(TYPE_CONFIRM_CLAIM, str({'ta': ta, 'id': self.request_claimed}))
-        return self.client.publish(TOPIC_QUEUE, payload=req_body.payload()).is_published()
+    def confirm_claim(self, request_id: str, ta: str) -> bool:
+        log.info("Confirming claim", id=request_id, ta=ta)
+        req_body = RequestWrapper(TYPE_CONFIRM_CLAIM, {'ta': ta, 'id': request_id})
+        return self.transport.publish(TOPIC_QUEUE, payload=req_body.payload())
 
 
 class Scene(Enum):
@@ -118,110 +150,107 @@ class Scene(Enum):
     TASK_MENU: int = 4
 
 
+@metrics.instrument_stm_callbacks
+@profiling.profile_methods("show_scene", prefix="stm_")
 class UserInterface:
-    def __init__(self, modules: list, groups: list):
+    def __init__(self, catalog: Catalog):
         self.app = gui("Student Client", "1x1")  # size is set in show_scene() method
+        # redraws requested by the state machine are done on the main thread, at most once per frame
+        self.refresh = RefreshScheduler(self.app, self.show_scene, lambda: self.current_scene)
+        self.rendered_request_state = None  # help_request_state() when the help request scene was built
 
         self.stm_help_request = Machine(name="stm_student_help_request", transitions=get_stm_transitions(), obj=self,
                                         states=get_stm_states())
-        self.driver = Driver()
+        self.driver = ClockDriver()
         self.driver.add_machine(self.stm_help_request)
 
         self.mqtt_client = MQTTClient(self.stm_help_request)
+        metrics.gauge("queue_length", "Open help requests").set_function(
+            lambda: self.mqtt_client.queue_manager.global_q_pos)
 
         self.current_scene = -1
-        self.modules = modules
-        self.groups = groups
+        self.catalog = catalog
+        self.rendered_catalog = None  # the catalog the current scene was built from
+        add_catalog_listener(self.on_catalog_changed)
         self.feedback_responses = []
+        self.store = get_store()  # None unless KOMSYS_DB is set
         self.logged_in_user = ""
         self.selected_module = 1
         self.selected_task = 1
         self.active_help_request: Optional[HelpRequest] = None
+        self.spacers = SpacerFactory(self.app)
         self.driver.start()
         self.start_app()
         self.logged_in_group_number = -1
 
     # ======== STM-controlled methods ========
     def stm_log(self, text: str):
-        print(self.current_scene)
-        print(text)
+        log.info("State", state=text, scene=getattr(self.current_scene, "name", self.current_scene))
 
     def stm_request_help(self):
         # take active help request and send mqtt requests
-        print("inside stm method for sending request")
         success = self.mqtt_client.request_help(self.active_help_request)
         # if mqtt request fails, set it to None and refresh scene
         if not success:
-            print("MQTT request failed!")
+            log.error("Could not send help request", id=self.active_help_request.id)
             self.active_help_request = None
-            if self.current_scene == Scene.HELP_REQUEST:
-                # if user is watching the help request page, refresh the scene
-                self.show_scene(self.current_scene)
+            # if user is watching the help request page, refresh the scene
+            self.refresh.invalidate(Scene.HELP_REQUEST)
 
     def stm_cancel_help_request(self):
         # take active help request send mqtt request cancelling the help request
         success = self.mqtt_client.cancel_request(self.active_help_request.id)
         if success:
             self.active_help_request = None
-            self.show_scene(self.current_scene)
+            self.refresh.invalidate(self.current_scene)
 
-    def stm_receive_request_claim(self):
-        print("stm received request claim")
-        if self.active_help_request is None or self.active_help_request.id != self.mqtt_client.request_claimed:
+    def stm_receive_request_claim(self, request_id: str, ta: str):
+        if self.active_help_request is None or self.active_help_request.id != request_id:
             # the request claim was not meant for this student. If it was, TA will time out anyway
-            print("the request claim was not for this student")
-            self.mqtt_client.ta_claiming_request = None
-            self.mqtt_client.request_claimed = None
+            log.debug("Claim request is not for this group", id=request_id, ta=ta)
             return
-        if self.active_help_request.claimed_by == "":
+        if not self.active_help_request.claimed_by:
             self.stm_help_request.send("sig_claim")
-            ta = self.mqtt_client.ta_claiming_request
-            print(f"Ta {ta} wants to claim current help request, and we're gonna let him")
-            if self.mqtt_client.confirm_claim(ta):
+            self.mqtt_client.ta_claiming_request = ta
+            if self.mqtt_client.confirm_claim(request_id, ta):
                 self.active_help_request.claimed_by = ta
-                if self.current_scene == Scene.HELP_REQUEST:
-                    # if user is watching the help request page, refresh the scene
-                    self.show_scene(self.current_scene)
-        print("Hmm, none of the ifs were triggered...")
-        print(f"Active help request is claimed by: {self.active_help_request.claimed_by}")
-
-    def stm_receive_request_resolution(self):
-        if self.active_help_request is None or self.mqtt_client.request_to_resolve != self.active_help_request.id:
+                # if user is watching the help request page, refresh the scene
+                self.refresh.invalidate(Scene.HELP_REQUEST)
+        log.info("Help request claimed", id=request_id, claimed_by=self.active_help_request.claimed_by)
+
+    def stm_receive_request_resolution(self, request_id: str):
+        if self.active_help_request is None or request_id != self.active_help_request.id:
             return
         self.stm_help_request.send("sig_resolve")
-        self.mqtt_client.request_to_resolve = None
         self.mqtt_client.ta_claiming_request = None
         old_hr = self.active_help_request
         self.active_help_request = None
-        if self.current_scene == Scene.HELP_REQUEST and self.selected_module == old_hr.module_number \
-                and self.selected_task == old_hr.task_idx:
-            self.show_scene(self.current_scene)
+        if self.selected_module == old_hr.module_number and self.selected_task == old_hr.task_idx:
+            self.refresh.invalidate(Scene.HELP_REQUEST)
 
-    def stm_cancel_claim(self):
-        if self.active_help_request is None or self.active_help_request.id != self.mqtt_client.request_to_cancel:
-            self.mqtt_client.request_to_cancel = None
+    def stm_cancel_claim(self, request_id: str):
+        if self.active_help_request is None or self.active_help_request.id != request_id:
             return
-        print("stm_cancel_claim this request is for me")
+        log.info("Claim cancelled", id=request_id)
         self.stm_help_request.send("sig_unclaim")
-        self.mqtt_client.request_to_cancel = None
         self.mqtt_client.ta_claiming_request = None
         self.active_help_request.claimed_by = ""
-        if self.current_scene == Scene.HELP_REQUEST and self.selected_module == self.active_help_request.module_number \
+        if self.selected_module == self.active_help_request.module_number \
                 and self.selected_task == self.active_help_request.task_idx:
-            self.show_scene(self.current_scene)
+            self.refresh.invalidate(Scene.HELP_REQUEST)
 
     def stm_update_queue_pos(self):
-        if self.current_scene == Scene.HELP_REQUEST and self.active_help_request is not None and \
+        if self.active_help_request is not None and \
                 self.selected_task == self.active_help_request.task_idx and \
                 self.selected_module == self.active_help_request.module_number:
-            # refresh page
-            self.show_scene(self.current_scene)
+            self.refresh.invalidate(Scene.HELP_REQUEST)
 
     # ======== UI-controlled methods ========
     def start_app(self):
         """ Set up initial scene """
         self.app.setGuiPadding(5, 5)
         self.show_scene(Scene.LOGIN)
+        self.refresh.start()
         self.app.go()
 
     def get_feedback_idx_for_this_module_task(self, module_number: int, task_number: int):
@@ -233,8 +262,10 @@ class UserInterface:
 
     def add_or_update_feedback_response(self, feedback: Feedback):
         if not self.mqtt_client.send_feedback(feedback):
-            print("failed to send feedback via mqtt")
+            log.error("Could not send feedback", module=feedback.module_number, task=feedback.task_number)
             return
+        if self.store is not None:
+            self.store.record_feedback(feedback)
         feedback_idx = self.get_feedback_idx_for_this_module_task(feedback.module_number, feedback.task_number)
         if feedback_idx == -1:  # doesn't exist, add new
             self.feedback_responses.append(feedback)
@@ -259,12 +290,47 @@ class UserInterface:
         else:
             self.app.topLevel.geometry(f"{x}x{y}")
 
+    @property
+    def modules(self) -> tuple:
+        return self.catalog.modules
+
+    @property
+    def groups(self) -> tuple:
+        return self.catalog.groups
+
+    def on_catalog_changed(self, catalog: Catalog):
+        """ Called on the catalog watcher thread when modules.json or groups.json changed """
+        self.catalog = catalog
+        self.refresh.invalidate(self.current_scene)
+
+    def refresh_scene_in_place(self, scene: int) -> bool:
+        """ Update only the widgets that changed in the current scene. Returns False if a full rebuild is needed """
+        if scene == Scene.HELP_REQUEST and self.rendered_request_state == self.help_request_state():
+            if self.active_help_request is not None and not self.active_help_request.claimed_by:
+                # only the queue position can have changed
+                self.app.setLabel("LAB_QUEUE_POS", f"Position in queue: {self.mqtt_client.queue_manager.local_q_pos}")
+            return True
+        return False
+
+    def help_request_state(self) -> tuple:
+        """ What the help request scene shows, apart from the queue position """
+        if self.active_help_request is None:
+            return self.selected_module, self.selected_task, None, None
+        return self.selected_module, self.selected_task, self.active_help_request.id, \
+            self.active_help_request.claimed_by
+
     def show_scene(self, scene: int):
+        with SCENE_SECONDS.time(scene=getattr(scene, "name", scene)):
+            self.build_scene(scene)
+
+    def build_scene(self, scene: int):
+        if scene == self.current_scene and self.rendered_catalog is self.catalog and \
+                self.refresh_scene_in_place(scene):
+            return
+
         def add_whitespace(desired_row_count: int, current_row_count: int):
             """ Essentially just used to push elements into place """
-            rows_to_add = desired_row_count - current_row_count
-            for _i in range(rows_to_add):
-                self.app.addLabel(str(uuid1()), text="", row=_i + current_row_count + 1, rowspan=1)
+            self.spacers.add_whitespace(desired_row_count, current_row_count)
 
         def add_side_menu(back_btn_func=None, desired_rows=5):
             def show_active_request():
@@ -286,12 +352,16 @@ class UserInterface:
             self.app.stopLabelFrame()
 
         self.app.removeAllWidgets()
+        self.spacers.reset()
         self.current_scene = scene
+        self.rendered_catalog = self.catalog
         if scene == Scene.LOGIN:
             def on_login_click():
                 group_name = self.app.getOptionBox("Group")
                 self.logged_in_user = group_name
                 self.logged_in_group_number = int(group_name.split(" ")[1][:-1])
+                if self.store is not None:  # the feedback the group gave before the client was restarted
+                    self.feedback_responses = self.store.group_feedback(self.logged_in_group_number)
                 self.show_scene(Scene.MAIN_PAGE)
 
             self.set_window_size_and_center(500, 100)
@@ -336,7 +406,6 @@ class UserInterface:
             def on_help_submit():
                 if self.active_help_request is None:
                     # Send new help request
-                    print("SENDING NEW HELP REQUEST")
                     comment = self.app.getTextArea("LAB_COMMENT")
                     is_online = self.app.getCheckBox("Online")
                     zoom_url = self.app.getEntry("TXT_ZOOM")
@@ -348,7 +417,6 @@ class UserInterface:
                     self.stm_help_request.send("click")
                 else:
                     # Cancel help request
-                    print("CANCELING HELP REQUEST")
                     self.stm_help_request.send("click")
                 self.show_scene(Scene.HELP_REQUEST)
 
@@ -367,7 +435,7 @@ class UserInterface:
                 self.app.setTextArea("LAB_COMMENT", text="What do you need help with?")
                 self.app.setLabel("LAB_SENT_STATUS", text="Request status: NOT SENT")
                 self.app.setLabelFg("LAB_SENT_STATUS", "red")
-            elif self.active_help_request.claimed_by == "":
+            elif not self.active_help_request.claimed_by:
                 self.app.setTextArea("LAB_COMMENT", text=self.active_help_request.comment)
                 self.app.setCheckBox("Online", ticked=self.active_help_request.is_online)
                 self.app.setEntry("TXT_ZOOM", text=self.active_help_request.zoom_url)
@@ -388,6 +456,7 @@ class UserInterface:
                 self.app.setLabelFg("LAB_SENT_STATUS", "green")
                 self.app.setButton("BTN_SUBMIT", "Cancel help request")
                 self.app.disableButton("BTN_SUBMIT")
+            self.rendered_request_state = self.help_request_state()
 
             self.app.stopLabelFrame()
 
@@ -468,7 +537,11 @@ class UserInterface:
 
 
 if __name__ == "__main__":
-    ui = UserInterface(modules=sorted(import_modules(), key=lambda m: m.number),
-                       groups=sorted(import_groups(), key=lambda g: g.number))
+    metrics.start_exporter()
+    watch_catalog()
+    ui = UserInterface(get_catalog())
     ui.driver.stop()
-    ui.mqtt_client.client.disconnect()
+    ui.mqtt_client.transport.disconnect()
+    ui.mqtt_client.dispatcher.stop()
+    log.info("Redraws", redraws=ui.refresh.redraws, saved=ui.refresh.redraws_saved)
+    log.info("Queue events", **ui.mqtt_client.sequencer.stats())
@@ -43,20 +43,20 @@ def get_stm_states():
     unsent = {
         "name": "unsent",
         "entry": "stm_log('unsent');",
-        "sig_receive_request_resolution": "stm_receive_request_resolution"
+        "sig_receive_request_resolution": "stm_receive_request_resolution(*)"
     }
     sent = {
         "name": "sent",
         "entry": "stm_log('sent')",
-        "sig_receive_request_claim": "stm_receive_request_claim",
-        "sig_receive_request_resolution": "stm_receive_request_resolution",
+        "sig_receive_request_claim": "stm_receive_request_claim(*)",
+        "sig_receive_request_resolution": "stm_receive_request_resolution(*)",
         "sig_update_queue_pos": "stm_update_queue_pos"
     }
     confirmed = {
         "name": "confirmed",
         "entry": "stm_log('confirmed')",
-        "sig_receive_request_claim": "stm_receive_request_claim",
-        "sig_receive_request_resolution": "stm_receive_request_resolution",
-        "sig_cancel_claim": "stm_cancel_claim"
+        "sig_receive_request_claim": "stm_receive_request_claim(*)",
+        "sig_receive_request_resolution": "stm_receive_request_resolution(*)",
+        "sig_cancel_claim": "stm_cancel_claim(*)"
     }
     return [unsent, sent, confirmed]
@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import struct
+import time
+from array import array
+
+from code_teaching_assistant.feedback_index import DIFFICULTY_SCORES
+from common.feedback import Feedback
+
+try:
+    import numpy as np
+except ImportError:  # optional, the pure Python version gives the same results, only slower
+    np = None
+
+# KOMSYS_FEEDBACK_HISTORY=<path> is the file with the feedback of earlier sessions. The TA client shows the
+# trends from it, and appends the feedback it received when it exits.
+HISTORY_PATH = os.environ.get("KOMSYS_FEEDBACK_HISTORY")
+
+# rating codes, 0 is feedback without a known difficulty
+RATING_CODES = DIFFICULTY_SCORES
+RATING_NAMES = {code: name for name, code in RATING_CODES.items()}
+
+# history file: a magic string, then fixed-size little-endian rows, so sessions are appended without rewriting
+HISTORY_MAGIC = b"KFBROWS1"
+ROW_FORMAT = "<qIHHB"  # time (ns since the epoch), group, module, task, rating code
+ROW_SIZE = struct.calcsize(ROW_FORMAT)
+ROW_DTYPE = None if np is None else np.dtype([("time", "<i8"), ("group", "<u4"), ("module", "<u2"), ("task", "<u2"),
+                                              ("rating", "u1")])
+
+
+def semester_of(time_ns: int) -> int:
+    """ year * 2, + 1 for the autumn semester (July to December), in UTC """
+    date = time.gmtime(time_ns // 1_000_000_000)
+    return date.tm_year * 2 + (1 if date.tm_mon >= 7 else 0)
+
+
+def semester_name(semester: int) -> str:
+    return f"{semester // 2} {'autumn' if semester % 2 else 'spring'}"
+
+
+class FeedbackColumns:
+    """
+    Feedback rows stored as typed arrays, one per column: module, task, group, rating code and time.
+    That is 17 bytes per row instead of an object per row, and with NumPy the columns are used as arrays
+    without copying. Appending is O(1).
+    """
+
+    def __init__(self):
+        self.time = array("q")
+        self.group = array("I")
+        self.module = array("H")
+        self.task = array("H")
+        self.rating = array("B")
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def append(self, feedback: Feedback, time_ns: int):
+        self.time.append(time_ns)
+        self.group.append(feedback.group_number)
+        self.module.append(feedback.module_number)
+        self.task.append(feedback.task_number)
+        self.rating.append(RATING_CODES.get(feedback.difficulty, 0))
+
+    def extend(self, other: "FeedbackColumns"):
+        for name in ("time", "group", "module", "task", "rating"):
+            getattr(self, name).extend(getattr(other, name))
+
+    def rows(self):
+        """ (time, group, module, task, rating code) tuples """
+        return zip(self.time, self.group, self.module, self.task, self.rating)
+
+    @staticmethod
+    def load(path: str) -> "FeedbackColumns":
+        columns = FeedbackColumns()
+        with open(path, "rb") as f:
+            if f.read(len(HISTORY_MAGIC)) != HISTORY_MAGIC:
+                raise ValueError(f"{path} is not a feedback history file")
+            data = f.read()
+        data = data[:len(data) - len(data) % ROW_SIZE]  # ignore a partly written last row
+        if np is not None:
+            rows = np.frombuffer(data, dtype=ROW_DTYPE)
+            for name in ("time", "group", "module", "task", "rating"):
+                getattr(columns, name).frombytes(np.ascontiguousarray(rows[name]).tobytes())
+        else:
+            for time_ns, group, module, task, rating in struct.iter_unpack(ROW_FORMAT, data):
+                columns.time.append(time_ns)
+                columns.group.append(group)
+                columns.module.append(module)
+                columns.task.append(task)
+                columns.rating.append(rating)
+        return columns
+
+    def append_to(self, path: str):
+        """ Append the rows to a history file, creating it if needed """
+        with open(path, "ab") as f:
+            if f.tell() == 0:
+                f.write(HISTORY_MAGIC)
+            if np is not None:
+                rows = np.empty(len(self), dtype=ROW_DTYPE)
+                for name in ("time", "group", "module", "task", "rating"):
+                    rows[name] = getattr(self, name)
+                f.write(rows.tobytes())
+            else:
+                f.write(b"".join(struct.pack(ROW_FORMAT, *row) for row in self.rows()))
+
+
+class TaskStats:
+    """ Feedback for one task in one semester, counting the latest feedback of each group """
+
+    def __init__(self, module: int, task: int, counts: list, group_count: int):
+        self.module = module
+        self.task = task
+        self.counts = counts  # groups per rating code, counts[0] is feedback without a rating
+        self.groups = sum(counts)
+        rated = self.groups - counts[0]
+        self.average = sum(code * count for code, count in enumerate(counts)) / rated if rated else 0.0
+        self.completion_percent = round(self.groups * 100 / group_count, 2) if group_count else 0.0
+
+    def to_dict(self) -> dict:
+        return {"module": self.module, "task": self.task, "groups": self.groups,
+                "ratings": {RATING_NAMES[code]: self.counts[code] for code in RATING_NAMES},
+                "average": round(self.average, 3), "completion_percent": self.completion_percent}
+
+
+class FeedbackAnalytics:
+    """
+    Statistics over feedback columns, per semester and task: rating distributions, averages, completion rates
+    and the trend of the average over the semesters. Only the latest feedback of a group for a task in a semester
+    counts, so updated feedback and rows that were archived twice don't count double.
+    Vectorized with NumPy when it is installed.
+    """
+
+    def __init__(self, columns: FeedbackColumns, use_numpy: bool = np is not None):
+        self.columns = columns
+        # (semester, module, task) -> [groups per rating code]
+        self.counts = self._count_numpy() if use_numpy and len(columns) > 0 else self._count_python()
+
+    def semesters(self) -> list:
+        return sorted({semester for semester, _module, _task in self.counts})
+
+    def task_stats(self, semester: int = None, group_count: int = 0) -> list:
+        """ TaskStats of every task with feedback, by module and task, in the given (default: latest) semester """
+        semesters = self.semesters()
+        if semester is None:
+            semester = semesters[-1] if semesters else 0
+        return [TaskStats(module, task, counts, group_count)
+                for (s, module, task), counts in sorted(self.counts.items()) if s == semester]
+
+    def trend(self, module: int, task: int) -> list:
+        """ [(semester, average rating, groups)] for a task, oldest first """
+        result = []
+        for semester in self.semesters():
+            counts = self.counts.get((semester, module, task))
+            if counts is not None:
+                stats = TaskStats(module, task, counts, 0)
+                result.append((semester, stats.average, stats.groups))
+        return result
+
+    def _count_python(self) -> dict:
+        latest = {}  # (semester, module, task, group) -> (time, rating)
+        semesters = {}  # cache, rows of a session share a few days
+        for time_ns, group, module, task, rating in self.columns.rows():
+            day = time_ns // 86_400_000_000_000
+            semester = semesters.get(day)
+            if semester is None:
+                semester = semesters[day] = semester_of(time_ns)
+            key = (semester, module, task, group)
+            previous = latest.get(key)
+            if previous is None or previous[0] <= time_ns:
+                latest[key] = (time_ns, rating)
+        counts = {}
+        for (semester, module, task, _group), (_time, rating) in latest.items():
+            task_counts = counts.get((semester, module, task))
+            if task_counts is None:
+                task_counts = counts[(semester, module, task)] = [0] * (len(RATING_NAMES) + 1)
+            task_counts[rating] += 1
+        return counts
+
+    def _count_numpy(self) -> dict:
+        columns = self.columns
+        time_ns = np.frombuffer(columns.time, dtype=np.int64)
+        group = np.frombuffer(columns.group, dtype=np.uint32).astype(np.int64)
+        task_key = (np.frombuffer(columns.module, dtype=np.uint16).astype(np.int64) << 16) \
+            | np.frombuffer(columns.task, dtype=np.uint16)
+        rating = np.frombuffer(columns.rating, dtype=np.uint8)
+        if np.any(time_ns[1:] < time_ns[:-1]):  # rows are normally appended in time order already
+            order = np.argsort(time_ns, kind="stable")
+            time_ns, group, task_key, rating = time_ns[order], group[order], task_key[order], rating[order]
+        months = time_ns.astype("datetime64[ns]").astype("datetime64[M]").astype(np.int64)  # since 1970-01
+        semester = (months // 12 + 1970) * 2 + (months % 12 >= 6)
+
+        # number the (semester, task) pairs, then keep the last row of each (semester, task, group): the first
+        # occurrence in the reversed rows
+        semester_tasks, task_index = np.unique((semester << 32) | task_key, return_inverse=True)
+        key = task_index.astype(np.int64) * (int(group.max()) + 1) + group
+        _keys, first_reversed = np.unique(key[::-1], return_index=True)
+        last = len(key) - 1 - first_reversed
+
+        # groups per rating code for each (semester, task)
+        codes = len(RATING_NAMES) + 1
+        counts = np.bincount(task_index[last] * codes + rating[last], minlength=len(semester_tasks) * codes)
+        counts = counts.reshape(len(semester_tasks), codes)
+        return {(key >> 32, (key >> 16) & 0xFFFF, key & 0xFFFF): row
+                for key, row in zip(semester_tasks.tolist(), counts.tolist())}
+
+
+def report(analytics: FeedbackAnalytics, group_count: int, semester: int = None) -> str:
+    semesters = analytics.semesters()
+    if semester is None and semesters:
+        semester = semesters[-1]
+    lines = [f"Feedback in {semester_name(semester) if semester else '-'}, {group_count} groups",
+             "module task  groups  completed  easy medium hard  average  trend"]
+    for stats in analytics.task_stats(semester, group_count):
+        trend = " ".join(f"{average:.2f}" for s, average, _groups in analytics.trend(stats.module, stats.task)
+                         if s <= semester)
+        lines.append(f"{stats.module:6} {stats.task + 1:4} {stats.groups:7} {stats.completion_percent:9.1f}% "
+                     f"{stats.counts[1]:5} {stats.counts[2]:6} {stats.counts[3]:4} {stats.average:8.2f}  {trend}")
+    lines.append(f"Semesters: {', '.join(semester_name(s) for s in semesters)}")
+    return "\n".join(lines)
+
+
+def demo_columns(rows: int, groups: int = 150, modules: int = 9, tasks: int = 4, seed: int = 4115) -> FeedbackColumns:
+    """ Random feedback over two years, where each task gets a little harder every semester """
+    import random
+    rng = random.Random(seed)
+    columns = FeedbackColumns()
+    start = 1_700_000_000 * 1_000_000_000  # November 2023
+    half_year = 182 * 86_400 * 1_000_000_000
+    for i in range(rows):
+        semester = i * 4 // rows
+        difficulty = min(3, max(1, round(rng.gauss(1.5 + semester * 0.3, 0.7))))
+        columns.append(Feedback(rng.randint(1, groups), rng.randint(1, modules), rng.randrange(tasks), "",
+                                RATING_NAMES[difficulty]), start + semester * half_year + rng.randrange(half_year // 2))
+    return columns
+
+
+def main():
+    from common.catalog import get_catalog
+    from common.storage import DB_PATH, SqliteStore
+
+    parser = argparse.ArgumentParser(description="Feedback report per task, over the semesters")
+    parser.add_argument("--history", default=HISTORY_PATH,
+                        help="feedback history file (default $KOMSYS_FEEDBACK_HISTORY)")
+    parser.add_argument("--db", default=DB_PATH, help="also include the feedback in this database (default $KOMSYS_DB)")
+    parser.add_argument("--archive", action="store_true", help="append the feedback in --db to --history")
+    parser.add_argument("--groups", type=int, help="number of groups, for the completion rate (default: data/groups.json)")
+    parser.add_argument("--semester", help='e.g. "2026 spring", default: the latest one')
+    parser.add_argument("--demo", type=int, metavar="ROWS",
+                        help="report on random feedback instead, and check that both implementations agree")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    semester = None
+    if args.semester:
+        words = args.semester.lower().split()
+        if len(words) != 2 or not words[0].isdigit() or words[1] not in ("spring", "autumn"):
+            parser.error(f'--semester must be a year and spring or autumn, e.g. "2026 spring", got {args.semester!r}')
+        semester = int(words[0]) * 2 + (1 if words[1] == "autumn" else 0)
+
+    columns = FeedbackColumns()
+    if args.demo:
+        columns = demo_columns(args.demo)
+        args.groups = 150 if args.groups is None else args.groups
+    if args.history and os.path.exists(args.history) and not args.demo:
+        columns = FeedbackColumns.load(args.history)
+    if args.db and not args.demo:
+        from_db = FeedbackColumns()
+        for feedback, time_ns in SqliteStore(args.db).timed_feedback():
+            from_db.append(feedback, time_ns)
+        columns.extend(from_db)
+        if args.archive and args.history:
+            from_db.append_to(args.history)
+            print(f"{len(from_db)} feedback rows appended to {args.history}")
+    group_count = args.groups if args.groups is not None else len(get_catalog().groups)
+
+    started = time.perf_counter()
+    analytics = FeedbackAnalytics(columns)
+    elapsed = time.perf_counter() - started
+    if args.json:
+        print(json.dumps({"semesters": [semester_name(s) for s in analytics.semesters()],
+                          "tasks": [stats.to_dict() for stats in analytics.task_stats(semester, group_count)]}))
+    else:
+        print(report(analytics, group_count, semester))
+        print(f"{len(columns)} rows analyzed in {elapsed:.3f}s{'' if np is not None else ' (without NumPy)'}")
+    if args.demo and np is not None:
+        started = time.perf_counter()
+        assert FeedbackAnalytics(columns, use_numpy=False).counts == analytics.counts
+        print(f"Same result without NumPy, in {time.perf_counter() - started:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
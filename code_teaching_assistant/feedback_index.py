@@ -0,0 +1,69 @@
+from threading import Lock
+
+from common.feedback import Feedback
+
+# score of each difficulty, used for the average rating
+DIFFICULTY_SCORES = {"Easy": 1, "Medium": 2, "Hard": 3}
+
+
+class TaskFeedback:
+    """
+    Running aggregates of the feedback for one task. Updated on the stm thread and read on the UI thread, so
+    by_group is only iterated through comments(), which copies it under the lock.
+    """
+
+    def __init__(self):
+        self.ratings = {difficulty: 0 for difficulty in DIFFICULTY_SCORES}
+        self.by_group = {}  # group number -> Feedback
+        self.rating_sum = 0
+        self._lock = Lock()
+
+    @property
+    def groups_completed(self) -> int:
+        """ Groups that rated the task Easy, Medium or Hard, so it matches the rating counts """
+        return sum(self.ratings.values())
+
+    @property
+    def average_rating(self) -> float:
+        rated = sum(self.ratings.values())
+        return self.rating_sum / rated if rated > 0 else 0
+
+    def completion_percent(self, group_count: int) -> float:
+        if group_count == 0:
+            return 0
+        return round(self.groups_completed * 100 / group_count, 2)
+
+    def comments(self) -> list:
+        """ (group number, comment) of every group, a copy """
+        with self._lock:
+            return [(group, feedback.comment) for group, feedback in self.by_group.items()]
+
+    def update(self, feedback: Feedback):
+        """ Add feedback from a group, or replace the group's previous feedback for this task """
+        with self._lock:
+            previous = self.by_group.get(feedback.group_number)
+            if previous is not None and previous.difficulty in DIFFICULTY_SCORES:
+                self.ratings[previous.difficulty] -= 1
+                self.rating_sum -= DIFFICULTY_SCORES[previous.difficulty]
+            self.by_group[feedback.group_number] = feedback
+            if feedback.difficulty in DIFFICULTY_SCORES:
+                self.ratings[feedback.difficulty] += 1
+                self.rating_sum += DIFFICULTY_SCORES[feedback.difficulty]
+
+
+class FeedbackIndex:
+    """ Feedback aggregated per (module, task), updated in O(1) for every incoming feedback """
+
+    def __init__(self):
+        self.tasks = {}  # (module number, task number) -> TaskFeedback
+
+    def update(self, feedback: Feedback):
+        key = (feedback.module_number, feedback.task_number)
+        task_feedback = self.tasks.get(key)
+        if task_feedback is None:
+            task_feedback = self.tasks[key] = TaskFeedback()
+        task_feedback.update(feedback)
+
+    def get(self, module_number: int, task_number: int) -> TaskFeedback:
+        """ Aggregates for a task, empty if no feedback has been received """
+        return self.tasks.get((module_number, task_number), TaskFeedback())
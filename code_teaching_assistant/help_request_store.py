@@ -0,0 +1,94 @@
+from bisect import bisect_left, insort
+from threading import RLock
+from typing import Optional
+
+from common.help_request import HelpRequest
+
+
+class HelpRequestStore:
+    """
+    The TA client's outstanding help requests.
+    Indexed by id (dict) and by time (sorted list, searched with bisect), so lookups never scan the whole store and
+    iteration is always in time order.
+    Lookups by id are O(1), and index_of() and [i] are O(log n) and O(1). add() and remove() find the position in
+    O(log n) but shift the list behind it, O(n); that is a single memmove, and requests mostly arrive in time order,
+    where add() appends at the end.
+    Mutations come from both the stm driver and the MQTT dispatcher thread, and are guarded by a lock.
+    """
+
+    def __init__(self):
+        self._by_id = {}
+        self._sort_keys = {}  # id -> key in self._ordered
+        self._ordered = []  # sorted list of (time, seq, id)
+        self._next_seq = 0  # tie-breaker for requests sent at the same time
+        self._lock = RLock()
+
+    def add(self, request: HelpRequest) -> bool:
+        """ Add a request, returns False if it is already in the store """
+        with self._lock:
+            if request.id in self._by_id:
+                return False
+            key = (request.time, self._next_seq, request.id)
+            self._next_seq += 1
+            self._by_id[request.id] = request
+            self._sort_keys[request.id] = key
+            insort(self._ordered, key)
+        return True
+
+    def remove(self, request_id: str) -> Optional[HelpRequest]:
+        """ Remove a request by id, returns the removed request or None if it wasn't in the store """
+        with self._lock:
+            request = self._by_id.pop(request_id, None)
+            if request is None:
+                return None
+            key = self._sort_keys.pop(request_id)
+            del self._ordered[bisect_left(self._ordered, key)]
+        return request
+
+    def set_claimed_by(self, request_id: str, ta: Optional[str]) -> Optional[HelpRequest]:
+        """ Set (or clear, with None) the claimant of a request """
+        with self._lock:
+            request = self._by_id.get(request_id)
+            if request is None:
+                return None
+            request.claimed_by = ta
+        return request
+
+    def sync(self, requests: list):
+        """ Make the store hold exactly `requests`, e.g. from a queue snapshot. Existing requests are kept """
+        wanted = {request.id: request for request in requests}
+        for request in self:
+            if request.id not in wanted:
+                self.remove(request.id)
+        for request in requests:
+            existing = self.get(request.id)
+            if existing is None:
+                self.add(request)
+            elif existing.claimed_by != request.claimed_by:
+                self.set_claimed_by(request.id, request.claimed_by)
+
+    def get(self, request_id: str) -> Optional[HelpRequest]:
+        return self._by_id.get(request_id)
+
+    def index_of(self, request_id: str) -> int:
+        """ 0-based position of a request in time order, -1 if it isn't in the store """
+        with self._lock:
+            key = self._sort_keys.get(request_id)
+            return -1 if key is None else bisect_left(self._ordered, key)
+
+    def __getitem__(self, index: int) -> HelpRequest:
+        """ Request at a position in time order """
+        with self._lock:
+            return self._by_id[self._ordered[index][2]]
+
+    def __contains__(self, request_id: str) -> bool:
+        return request_id in self._by_id
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self):
+        """ Iterate in time order, over a copy so the store can change while iterating """
+        with self._lock:
+            ordered = [self._by_id[key[2]] for key in self._ordered]
+        return iter(ordered)
@@ -1,116 +1,143 @@
+import os
 from typing import Optional
-from threading import Thread
-import os.path
-from playsound import playsound
 
 from appJar import gui
 from enum import Enum
-from uuid import uuid1
 
-from stmpy import Machine, Driver
+from stmpy import Machine
 
+from code_teaching_assistant.feedback_analytics import HISTORY_PATH, FeedbackAnalytics, FeedbackColumns, semester_name
+from code_teaching_assistant.feedback_index import FeedbackIndex, TaskFeedback
+from code_teaching_assistant.help_request_store import HelpRequestStore
+from code_teaching_assistant.virtual_list import VirtualList
 from code_teaching_assistant.stm_utils import get_stm_transitions, get_stm_states
+from common.clock import ClockDriver, get_clock
+from common.dispatcher import MessageDispatcher
+from common import metrics, profiling
+from common.logger import DEBUG, get_logger
+from common.transport import Transport, PahoTransport
+from common.sequencer import EventSequencer
+from common.storage import get_store
 from common.feedback import Feedback
 from common.group import Group
-from common.io_utils import import_modules, import_groups
+from common.catalog import Catalog, add_catalog_listener, get_catalog, watch_catalog
 from common.help_request import HelpRequest, RequestStatus
-from common.mqtt_utils import parse_help_request, get_request_type, parse_cancel_request, parse_feedback, TOPIC_TASK, \
-    BROKER, PORT, TOPIC_QUEUE, RequestWrapper, TYPE_CLAIM_REQUEST, TYPE_ADD_HELP_REQUEST, TYPE_CANCEL_HELP_REQUEST, \
-    TYPE_SEND_FEEDBACK, TYPE_CONFIRM_CLAIM, TYPE_RESOLVE_REQUEST, TYPE_CANCEL_CLAIM, \
-    parse_body_field
-import paho.mqtt.client as mqtt
+from common.notification import NotificationPlayer
+from common.refresh_scheduler import RefreshScheduler
+from common.ui_utils import SpacerFactory, KeyedRows
+from common.mqtt_utils import TOPIC_TASK, TOPIC_QUEUE, TOPIC_SERVER, TOPIC_SNAPSHOT, TOPIC_RESYNC, \
+    RequestWrapper, TYPE_CLAIM_REQUEST, TYPE_SEND_FEEDBACK, TYPE_CONFIRM_CLAIM, TYPE_RESOLVE_REQUEST, \
+    TYPE_CANCEL_CLAIM, TYPE_QUEUE_EVENT, TYPE_QUEUE_SNAPSHOT, TYPE_RESYNC_REQUEST, QUEUE_OP_ADD, QUEUE_OP_REMOVE, \
+    QUEUE_OP_CLAIM, QUEUE_OP_UNCLAIM, TYPE_NAMES, Message, parse_help_request
 
+log = get_logger("ta")
+SCENE_SECONDS = metrics.histogram("scene_render_seconds", "Time spent in show_scene(), by scene")
+CLAIM_TIMEOUTS = metrics.counter("claim_timeouts_total", "Claims the student did not confirm before the timer 't'")
+TREND_SEMESTERS = 3  # semesters of earlier feedback shown in the task menu
 
+
+@profiling.profile_methods("on_message", "handle_message")
 class MQTTClient:
-    def __init__(self, stm_teaching_assistant, help_requests: list):
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+    def __init__(self, stm_teaching_assistant, help_requests: HelpRequestStore, transport: Optional[Transport] = None,
+                 dispatcher_workers: int = 1):
+        # the real broker unless another transport (e.g. a loopback bus) is given
+        self.transport = transport if transport is not None else PahoTransport()
+        self.transport.on_message = self.on_message
         self.stm_teaching_assistant = stm_teaching_assistant
         self.help_requests = help_requests
-        self.help_request_to_add = None
-        self.help_request_to_remove = None
-        self.incoming_feedback = []
         self.logged_in_ta = None
-       
-        print(f"Trying to connect to {BROKER}")
-        self.client.connect(BROKER, PORT)
-        self.client.subscribe(TOPIC_QUEUE)
-        self.client.subscribe(TOPIC_TASK)
-        try:
-            thread = Thread(target=self.client.loop_forever)
-            thread.start()
-        except KeyboardInterrupt:
-            self.client.disconnect()
-
-    def on_connect(self, client, userdata, flags, rc):
-        print(format(mqtt.connack_string(rc)))
-
-    def on_message(self, client, userdata, msg: mqtt.MQTTMessage):
-        print("on_message(): topic: {}, data: {}".format(msg.topic, msg.payload))
-        payload = str(msg.payload).replace("\\", "")
-        req_type = get_request_type(str(msg.payload).replace("\\", ""))
-        if req_type == TYPE_ADD_HELP_REQUEST:
-            self.help_request_to_add = parse_help_request(payload)
-            self.stm_teaching_assistant.send("sig_rec_help_req")
-            # Make sound to notify the TA's
-            file_path = os.path.join("data", "notification_sound.wav")
-            playsound(file_path)
-        elif req_type == TYPE_CANCEL_HELP_REQUEST:
-            self.help_request_to_remove = parse_cancel_request(payload)
-            self.stm_teaching_assistant.send("sig_rem_help_req")
+        # queue events are applied in sequence order, missed ones are requested again from the queue server
+        self.sequencer = EventSequencer(self.apply_queue_event, self.request_resync, on_restart=self.on_server_restart)
+        self.notifier = NotificationPlayer(on_chime=self.on_notification)
+        # messages are handled on a worker thread, keeping the network thread free
+        self.dispatcher = MessageDispatcher(self.handle_message, workers=dispatcher_workers)
+
+        self.transport.connect()
+        self.transport.subscribe(TOPIC_QUEUE)
+        self.transport.subscribe(TOPIC_TASK)
+        self.transport.subscribe(TOPIC_SNAPSHOT)  # retained, gives the current queue right after connecting
+        self.transport.subscribe(TOPIC_SERVER)
+        self.transport.start()
+
+    def on_message(self, topic: str, payload: bytes):
+        self.dispatcher.submit(topic, payload)
+
+    def on_notification(self, count: int):
+        if count > 1:
+            log.info("New help requests", count=count)
+
+    def handle_message(self, topic: str, message: Message):
+        """ Runs on the dispatcher worker thread """
+        req_type = message.request_type
+        if log.enabled(DEBUG):
+            log.debug("Message", topic=topic, type=TYPE_NAMES.get(req_type), data=message.data)
+        if req_type == TYPE_QUEUE_EVENT:
+            # the queue itself is maintained by the queue server, we only apply its results
+            self.on_queue_event(message)
+        elif req_type == TYPE_QUEUE_SNAPSHOT:
+            self.on_queue_snapshot(message)
         elif req_type == TYPE_SEND_FEEDBACK:
-            self.incoming_feedback.append(parse_feedback(payload))
-            self.stm_teaching_assistant.send("sig_feedback")
-        elif req_type == TYPE_CONFIRM_CLAIM:
-            print("Received claim confirmation")
-            ta = parse_body_field(payload, "ta")
-            if ta == self.logged_in_ta:
-                print("ta name matches")
-                self.stm_teaching_assistant.send("sig_acc_claim")
-            else:
-                req_id = parse_body_field(payload, "id")
-                for request in self.help_requests:
-                    if request.id == req_id:
-                        request.claimed_by = ta
-                        self.stm_teaching_assistant.send("sig_update_request")
-                        break
-        elif req_type == TYPE_RESOLVE_REQUEST:
-            print("Received request resolution message")
-            req_id = parse_body_field(payload, "id")
-            rec_to_del = None
-            for req in self.help_requests:
-                if req.id == req_id:
-                    rec_to_del = req
-            try:
-                self.help_requests.remove(rec_to_del)
-            except ValueError:
-                pass
-            if rec_to_del is not None:
+            self.stm_teaching_assistant.send("sig_feedback", args=[message.body])
+        elif req_type == TYPE_CONFIRM_CLAIM and message.get("ta") == self.logged_in_ta:
+            log.info("Claim confirmed", type="confirm_claim", id=message.get("id"), ta=self.logged_in_ta)
+            self.stm_teaching_assistant.send("sig_acc_claim")
+
+    def on_queue_event(self, message: Message):
+        if self.sequencer.accept_epoch(message.get("epoch")):
+            self.sequencer.offer(message.get("seq"), message)
+
+    def on_server_restart(self):
+        log.warning("Queue server restarted, starting over from its queue", epoch=self.sequencer.epoch)
+        self.stm_teaching_assistant.send("sig_queue_snapshot", args=[[]])
+
+    def apply_queue_event(self, message: Message):
+        op = message.get("op")
+        req_id = message.get("id")
+        if op == QUEUE_OP_ADD:
+            self.stm_teaching_assistant.send("sig_rec_help_req", args=[parse_help_request(message.get("request"))])
+            # Make sound to notify the TA's
+            self.notifier.notify()
+        elif op == QUEUE_OP_REMOVE:
+            self.stm_teaching_assistant.send("sig_rem_help_req", args=[req_id])
+        elif op == QUEUE_OP_CLAIM and message.get("ta") != self.logged_in_ta:
+            if self.help_requests.set_claimed_by(req_id, message.get("ta")) is not None:
+                self.stm_teaching_assistant.send("sig_update_request")
+        elif op == QUEUE_OP_UNCLAIM and message.get("ta") != self.logged_in_ta:
+            log.info("Claim cancelled by another TA", id=req_id, ta=message.get("ta"))
+            if self.help_requests.set_claimed_by(req_id, None) is not None:
                 self.stm_teaching_assistant.send("sig_update_request")
-        elif req_type == TYPE_CANCEL_CLAIM:
-            print("Claim was cancelled")
-            ta = parse_body_field(payload, "ta")
-            if ta != self.logged_in_ta:
-                req_id = parse_body_field(payload, "id")
-                for request in self.help_requests:
-                    if request.id == req_id:
-                        request.claimed_by = None
-                        self.stm_teaching_assistant.send("sig_update_request")
-                        break
+
+    def on_queue_snapshot(self, message: Message):
+        if not self.sequencer.accept_epoch(message.get("epoch")) or message.get("seq") <= self.sequencer.last_seq:
+            # from an older run of the queue server, or we are already up to date
+            return
+        requests = []
+        for entry in message.body:
+            request = HelpRequest(entry["group_number"], entry["module_number"], entry["task_idx"],
+                                  bool(entry["is_online"]), entry["zoom_url"], entry["comment"], entry["id"],
+                                  time=entry["time"])
+            request.claimed_by = entry["claimed_by"] or None
+            requests.append(request)
+        self.stm_teaching_assistant.send("sig_queue_snapshot", args=[requests])
+        self.sequencer.reset(message.get("seq"))  # applies the buffered events that follow the snapshot
+
+    def request_resync(self, first: int, last: int):
+        log.warning("Missed queue events, asking the queue server for them", first=first, last=last)
+        req_body = RequestWrapper(TYPE_RESYNC_REQUEST, {"from": first, "to": last}).payload()
+        self.transport.publish(TOPIC_RESYNC, payload=req_body)
 
     def claim_request(self, request: HelpRequest, ta_name: str) -> bool:
-        print(f"going to claim request {request.id}")
-        req_body = RequestWrapper(TYPE_CLAIM_REQUEST, str({'id': request.id, 'ta': ta_name})).payload()
-        return self.client.publish(TOPIC_QUEUE, payload=req_body).is_published()
+        log.info("Claiming help request", id=request.id, group=request.group_number, ta=ta_name)
+        req_body = RequestWrapper(TYPE_CLAIM_REQUEST, {'id': request.id, 'ta': ta_name}).payload()
+        return self.transport.publish(TOPIC_QUEUE, payload=req_body)
 
     def resolve_request(self, req_id: str):
-        req_body = RequestWrapper(TYPE_RESOLVE_REQUEST, str({'id': req_id})).payload()
-        return self.client.publish(TOPIC_QUEUE, payload=req_body).is_published()
+        req_body = RequestWrapper(TYPE_RESOLVE_REQUEST, {'id': req_id}).payload()
+        return self.transport.publish(TOPIC_QUEUE, payload=req_body)
 
     def cancel_claim(self, req_id: str):
-        req_body = RequestWrapper(TYPE_CANCEL_CLAIM, str({'id': req_id, 'ta': self.logged_in_ta})).payload()
-        return self.client.publish(TOPIC_QUEUE, payload=req_body).is_published()
+        req_body = RequestWrapper(TYPE_CANCEL_CLAIM, {'id': req_id, 'ta': self.logged_in_ta}).payload()
+        return self.transport.publish(TOPIC_QUEUE, payload=req_body)
 
 
 class Scene(Enum):
@@ -121,129 +148,120 @@ class Scene(Enum):
     TASK_MENU: int = 4
 
 
+@metrics.instrument_stm_callbacks
+@profiling.profile_methods("show_scene", prefix="stm_")
 class UserInterface:
-    def __init__(self, modules: list, groups: list):
+    def __init__(self, catalog: Catalog):
         self.app = gui("Teacher Assistant Client", "1x1")  # size is set in show_scene() method
-        self.help_requests = []
+        # redraws requested by the state machine are done on the main thread, at most once per frame
+        self.refresh = RefreshScheduler(self.app, self.show_scene, lambda: self.current_scene)
+        self.help_requests = HelpRequestStore()
         self.stm_teaching_assistant = Machine(name="stm_teaching_assistant", transitions=get_stm_transitions(), obj=self, states=get_stm_states())
-        self.driver = Driver()
+        self.driver = ClockDriver()
         self.driver.add_machine(self.stm_teaching_assistant)
         self.driver.start()
 
         self.mqtt_client = MQTTClient(self.stm_teaching_assistant, self.help_requests)
+        metrics.gauge("queue_length", "Open help requests").set_function(lambda: len(self.help_requests))
 
         self.current_scene = -1
-        self.modules = modules
-        self.groups = groups
-        self.feedback_responses = []
+        self.catalog = catalog
+        self.rendered_catalog = None  # the catalog the current scene was built from
+        add_catalog_listener(self.on_catalog_changed)
+        self.feedback_index = FeedbackIndex()
+        self.store = get_store()  # None unless KOMSYS_DB is set
+        if self.store is not None:
+            for feedback in self.store.feedback():  # from before a restart
+                self.feedback_index.update(feedback)
+        # feedback of earlier sessions, for the trend in the task menu, and the feedback to append to it on exit
+        history = FeedbackColumns.load(HISTORY_PATH) if HISTORY_PATH and os.path.exists(HISTORY_PATH) \
+            else FeedbackColumns()
+        self.feedback_history = FeedbackAnalytics(history)
+        self.session_feedback = FeedbackColumns()
         self.logged_in_user = ""
         self.selected_module = 1
         self.selected_task = 1
         self.selected_help_request: str = ""
         self.active_help_request: Optional[HelpRequest] = None
+
+        # rendering state, used to update the current scene in place instead of rebuilding it
+        self.spacers = SpacerFactory(self.app)
+        self.help_request_list: Optional[VirtualList] = None
+        self.feedback_rows = KeyedRows(self.add_feedback_row, self.update_feedback_row, self.move_feedback_row,
+                                       self.remove_feedback_row)
+        self.rendered_active_request = None  # id of the active request when the main page was built
+        self.rendered_task = None  # (module, task) shown when the task menu was built
         self.start_app()
 
     # =========== STM-controlled methods =========== ""
     def stm_log(self, text: str):
-        print(text)
+        log.info("State", state=text)
 
     def stm_request_resolved(self):
         if self.mqtt_client.resolve_request(self.active_help_request.id):
             previous_claimed_request = self.active_help_request
             self.active_help_request = None
-            for i in range(len(self.help_requests)):
-                req: HelpRequest = self.help_requests[i]
-                if req.id == previous_claimed_request.id:
-                    self.help_requests.pop(i)
-                    break
-            self.show_scene(Scene.MAIN_PAGE)
+            self.help_requests.remove(previous_claimed_request.id)
+            self.refresh.navigate(Scene.MAIN_PAGE)
 
     def stm_update_request(self):
         if self.current_scene == Scene.HELP_REQUEST or self.current_scene == Scene.MAIN_PAGE:
-            self.show_scene(Scene.MAIN_PAGE)
-
+            self.refresh.navigate(Scene.MAIN_PAGE)
 
     def stm_timer_expired(self):
-        self.active_help_request.claimed_by = None
+        CLAIM_TIMEOUTS.inc()
+        self.help_requests.set_claimed_by(self.active_help_request.id, None)
         self.active_help_request = None
-        if self.current_scene == Scene.HELP_REQUEST:
-            self.show_scene(self.current_scene)
+        self.refresh.invalidate(Scene.HELP_REQUEST)
 
     def timer_expired(self):
-        self.active_help_request.claimed_by = None
+        self.help_requests.set_claimed_by(self.active_help_request.id, None)
         self.active_help_request = None
-        self.show_scene(self.current_scene)
-
-    def stm_receive_feedback(self):
-        if len(self.mqtt_client.incoming_feedback) > 0:
-            feedback = self.mqtt_client.incoming_feedback.pop()
-            idx = self.get_feedback_idx_for_this_group_module_task(feedback.group_number, feedback.module_number,
-                                                                   feedback.task_number)
-            if idx == -1:
-                self.feedback_responses.append(feedback)  # add
-            else:
-                self.feedback_responses[idx] = feedback  # update
-            if self.current_scene == Scene.TASK_MENU and self.selected_module == feedback.module_number and \
-                    self.selected_task == feedback.task_number:
-                # refresh page if currently in task menu for the right module / task
-                self.show_scene(self.current_scene)
-
-    def stm_rec_help_req(self):
-        self.help_requests.append(self.mqtt_client.help_request_to_add)
-       
-        if self.current_scene == Scene.MAIN_PAGE:
-            self.show_scene(self.current_scene)
-    
-    def stm_rem_help_req(self):
-        print(self.help_requests)
-        cancelled_request_id = ""
-        for i in range (len(self.help_requests)):
-            if self.help_requests[i].id == self.mqtt_client.help_request_to_remove:
-                cancelled_request_id = self.help_requests[i].id
-                del self.help_requests[i]
-                break
-        if self.current_scene == Scene.MAIN_PAGE:
-            self.show_scene(self.current_scene)
-        if self.current_scene == Scene.HELP_REQUEST and self.selected_help_request == cancelled_request_id:
-            self.show_scene(Scene.MAIN_PAGE)
+        self.refresh.invalidate(self.current_scene)
+
+    def stm_receive_feedback(self, feedback: Feedback):
+        self.feedback_index.update(feedback)
+        self.session_feedback.append(feedback, get_clock().time_ns())
+        if self.store is not None:
+            self.store.record_feedback(feedback)
+        if self.current_scene == Scene.TASK_MENU and self.selected_module == feedback.module_number and \
+                self.selected_task == feedback.task_number:
+            # refresh page if currently in task menu for the right module / task
+            self.refresh.invalidate(Scene.TASK_MENU)
+
+    def stm_rec_help_req(self, request: HelpRequest):
+        self.help_requests.add(request)
+        self.refresh.invalidate(Scene.MAIN_PAGE)
+
+    def stm_queue_snapshot(self, requests: list):
+        self.help_requests.sync(requests)
+        self.refresh.invalidate(Scene.MAIN_PAGE)
+        if self.current_scene == Scene.HELP_REQUEST and self.selected_help_request not in self.help_requests:
+            self.refresh.navigate(Scene.MAIN_PAGE)
+
+    def stm_rem_help_req(self, request_id: str):
+        cancelled_request = self.help_requests.remove(request_id)
+        self.refresh.invalidate(Scene.MAIN_PAGE)
+        if self.current_scene == Scene.HELP_REQUEST and cancelled_request is not None and \
+                self.selected_help_request == cancelled_request.id:
+            self.refresh.navigate(Scene.MAIN_PAGE)
 
     def stm_cancel_claim(self):
         if self.active_help_request is None:
             return
         if self.mqtt_client.cancel_claim(self.active_help_request.id):
-            self.active_help_request.claimed_by = None
+            self.help_requests.set_claimed_by(self.active_help_request.id, None)
             self.active_help_request = None
-            if self.current_scene == Scene.HELP_REQUEST:
-                self.show_scene(self.current_scene)
+            self.refresh.invalidate(Scene.HELP_REQUEST)
 
     # =========== UI-controlled methods =========== ""
     def start_app(self):
         """ Set up initial scene """
         self.app.setGuiPadding(5, 5)
         self.show_scene(Scene.LOGIN)
+        self.refresh.start()
         self.app.go()
 
-    def get_feedback_idx_for_this_module_task(self, module_number: int, task_number: int):
-        for i in range(len(self.feedback_responses)):
-            fr: Feedback = self.feedback_responses[i]
-            if fr.module_number == module_number and fr.task_number == task_number:
-                return i
-        return -1
-
-    def get_feedback_idx_for_this_group_module_task(self, group_number: int, module: int, task: int):
-        for i in range(len(self.feedback_responses)):
-            fr: Feedback = self.feedback_responses[i]
-            if fr.module_number == module and fr.task_number == task and fr.group_number == group_number:
-                return i
-        return -1
-
-    def add_or_update_feedback_response(self, feedback: Feedback):
-        feedback_idx = self.get_feedback_idx_for_this_module_task(feedback.module_number, feedback.task_number)
-        if  feedback_idx == -1:  # doesn't exist, add new
-            self.feedback_responses.append(feedback)
-            return
-        self.feedback_responses[feedback_idx] = feedback  # exists, replace
-
     def set_window_size_and_center(self, x: int, y: int, center=False):
         """ Resize and center window """
         screen_width = self.app.topLevel.winfo_screenwidth()
@@ -256,12 +274,87 @@ class UserInterface:
         else:
             self.app.topLevel.geometry(f"{x}x{y}")
 
+    def on_see_request(self, request_id: str):
+        self.selected_help_request = request_id
+        self.show_scene(Scene.HELP_REQUEST)
+
+    def help_request_row(self, index: int) -> tuple:
+        """ (id, text, button enabled) for the help request at a position in time order """
+        request = self.help_requests[index]
+        text = f"{index + 1}: Group {request.group_number}, module {request.module_number}, " \
+               f"task {request.task_idx + 1}, time {request.time_str}"
+        if request.status == RequestStatus.COMPLETED:
+            text += " (resolved)"
+        enabled = not self.active_help_request or self.active_help_request.id == request.id
+        return request.id, text, enabled
+
+    def add_feedback_row(self, group_number: int, comment: str, row: int):
+        self.app.addLabel(f"LAB_FEEDBACK_{group_number}", f""" "{comment}"\n-Group {group_number} """, row=row)
+
+    def update_feedback_row(self, group_number: int, comment: str):
+        self.app.setLabel(f"LAB_FEEDBACK_{group_number}", f""" "{comment}"\n-Group {group_number} """)
+
+    def move_feedback_row(self, group_number: int, row: int):
+        self.app.getLabelWidget(f"LAB_FEEDBACK_{group_number}").grid(row=row)
+
+    def remove_feedback_row(self, group_number: int):
+        self.app.removeLabel(f"LAB_FEEDBACK_{group_number}")
+
+    @property
+    def modules(self) -> tuple:
+        return self.catalog.modules
+
+    @property
+    def groups(self) -> tuple:
+        return self.catalog.groups
+
+    def on_catalog_changed(self, catalog: Catalog):
+        """ Called on the catalog watcher thread when modules.json or groups.json changed """
+        self.catalog = catalog
+        self.refresh.invalidate(self.current_scene)
+
+    def refresh_scene_in_place(self, scene: int) -> bool:
+        """ Update only the widgets that changed in the current scene. Returns False if a full rebuild is needed """
+        if scene == Scene.MAIN_PAGE:
+            active_request_id = None if self.active_help_request is None else self.active_help_request.id
+            if active_request_id != self.rendered_active_request:
+                return False  # side menu and buttons change
+            self.help_request_list.refresh()
+            return True
+        if scene == Scene.TASK_MENU:
+            if (self.selected_module, self.selected_task) != self.rendered_task:
+                return False
+            task_feedback = self.feedback_index.get(self.selected_module, self.selected_task)
+            self.set_task_feedback_labels(task_feedback)
+            self.app.openScrollPane("PANE_FEEDBACK")
+            self.feedback_rows.sync(task_feedback.comments(), first_row=1)
+            self.app.stopScrollPane()
+            return True
+        return False
+
+    def set_task_feedback_labels(self, task_feedback: TaskFeedback):
+        ratings = task_feedback.ratings
+        self.app.setLabel("LAB_GROUPS_COMPLETED",
+                          f"{task_feedback.completion_percent(len(self.groups))}% of groups completed")
+        self.app.setLabel("LAB_RATINGS", f"Easy: {ratings['Easy']}, Medium: {ratings['Medium']}, Hard: {ratings['Hard']}")
+        self.app.setLabel("LAB_AVERAGE_RATING", f"Average rating: {round(task_feedback.average_rating, 2)}")
+        trend = self.feedback_history.trend(self.selected_module, self.selected_task)[-TREND_SEMESTERS:]
+        trend_text = ", ".join(f"{semester_name(semester)}: {round(average, 2)} ({groups} groups)"
+                               for semester, average, groups in trend)
+        self.app.setLabel("LAB_TREND", f"Earlier sessions: {trend_text}" if trend else "No earlier feedback")
+
     def show_scene(self, scene: int):
+        with SCENE_SECONDS.time(scene=getattr(scene, "name", scene)):
+            self.build_scene(scene)
+
+    def build_scene(self, scene: int):
+        if scene == self.current_scene and self.rendered_catalog is self.catalog and \
+                self.refresh_scene_in_place(scene):
+            return
+
         def add_whitespace(desired_row_count: int, current_row_count: int):
             """ Essentially just used to push elements into place """
-            rows_to_add = desired_row_count - current_row_count
-            for _i in range(rows_to_add):
-                self.app.addLabel(str(uuid1()), text="", row=_i + current_row_count + 1, rowspan=1)
+            self.spacers.add_whitespace(desired_row_count, current_row_count)
 
         def add_side_menu(back_btn_func=None, desired_rows=5, rowspan=5):
             def show_active_request():
@@ -282,7 +375,10 @@ class UserInterface:
             self.app.stopLabelFrame()
 
         self.app.removeAllWidgets()
+        self.spacers.reset()
+        self.feedback_rows.clear()
         self.current_scene = scene
+        self.rendered_catalog = self.catalog
         if scene == Scene.LOGIN:
             def on_login_click():
                 name = self.app.getEntry("TXT_NAME")
@@ -309,21 +405,6 @@ class UserInterface:
                 self.selected_module = int(btn_text.split(" ")[0][1:])
                 self.show_scene(Scene.TASK_MENU)
 
-            def see_request(request_id: str):
-                self.selected_help_request = request_id
-                self.show_scene(Scene.HELP_REQUEST)
-
-            def add_help_request_frame(_request: HelpRequest, num: int):
-                self.app.addLabel(
-                    f"LAB_GROUP_{_request.id}",
-                    f"{num}: Group {_request.group_number}, module {_request.module_number}, task {_request.task_idx + 1}, time "
-                    f"{str(_request.time).split('.')[0]}",
-                    column=0, row=self.app.getRow())
-                self.app.addButton(f"{_request.id}", see_request, column=1, row=self.app.getRow()-1)
-                self.app.setButton(f"{_request.id}", "See request")
-                if self.active_help_request and self.active_help_request.id != _request.id:
-                    self.app.disableButton(f"{_request.id}")
-
             self.set_window_size_and_center(500, 500)
             add_side_menu(desired_rows=15, rowspan=10)
             self.app.startLabelFrame("Modules", sticky="news", row=0, rowspan=5, column=1, colspan=3)
@@ -348,45 +429,36 @@ class UserInterface:
             self.app.stopLabelFrame()
 
             self.app.startLabelFrame("Unresolved help requests", sticky="news", row=5, rowspan=5, column=1, colspan=3)
-            self.app.startScrollPane("PANE_HELP_REQUESTS")
-            i = 1
-            for request in sorted(self.help_requests, key=lambda x: x.time):
-                if request.status != RequestStatus.COMPLETED:
-                    add_help_request_frame(request, i)
-                    i += 1
-            if len(self.help_requests) == 0:  # To remove warning
-                self.app.addLabel(str(uuid1()), "")
-            self.app.stopScrollPane()
+            # only the visible rows are created, however many requests there are
+            self.help_request_list = VirtualList(self.app.getContainer(), lambda: len(self.help_requests),
+                                                 self.help_request_row, self.on_see_request, "See request",
+                                                 visible_rows=8)
+            self.help_request_list.grid(row=0, column=0, sticky="news")
+            self.help_request_list.refresh()
+            self.rendered_active_request = None if self.active_help_request is None else self.active_help_request.id
             self.app.stopLabelFrame()
 
         elif scene == Scene.HELP_REQUEST:
-            current_request: Optional[HelpRequest] = None
-            for request in self.help_requests:
-                if request.id == self.selected_help_request:
-                    current_request = request
-                    break
+            current_request: Optional[HelpRequest] = self.help_requests.get(self.selected_help_request)
             if current_request is None:
-                print("SOMETHING WENT WRONG, COULDN'T FIND REQUEST WITH ID " + str(self.selected_help_request))
+                log.error("Selected help request not found", id=self.selected_help_request)
                 self.show_scene(Scene.MAIN_PAGE)
-            request_group: Optional[Group] = None
-            for group in self.groups:
-                if group.number == current_request.group_number:
-                    request_group = group
-                    break
+                return
+            request_group: Optional[Group] = self.catalog.group(current_request.group_number)
+            table = "unknown" if request_group is None else request_group.table
 
             def on_claim():
                 if current_request.claimed_by is None:
-                    current_request.claimed_by = self.logged_in_user  # claim
+                    self.help_requests.set_claimed_by(current_request.id, self.logged_in_user)  # claim
                     current_request.status = RequestStatus.CONFIRMED
                     if self.mqtt_client.claim_request(current_request, self.logged_in_user):
                         self.active_help_request = current_request
                         self.stm_teaching_assistant.send("claim_button")
                         self.show_scene(self.current_scene)
                     else:
-                        print("Failed to send mqtt claim request")
+                        log.error("Could not send claim request", id=current_request.id)
                 else:
                     # cancel claim
-                    print("cancelling claim")
                     self.stm_teaching_assistant.send("cancel_claim")
 
             def on_resolve_claim():
@@ -398,7 +470,7 @@ class UserInterface:
             add_side_menu(lambda x: self.show_scene(Scene.MAIN_PAGE))
             self.app.startLabelFrame(f"Help request", sticky="news", row=0, rowspan=6, column=1, colspan=3)
             self.app.addLabel("LAB_COMMENT", text=f""" "{current_request.comment}" """)
-            self.app.addLabel("LAB_GROUP", text=f"- Group {request_group.number}, table {request_group.table}")
+            self.app.addLabel("LAB_GROUP", text=f"- Group {current_request.group_number}, table {table}")
             self.app.addLabel("LAB_EMPTY", text="")
             self.app.addLabel("LAB_MODULE_AND_TASK", text=f"Module {current_request.module_number}, task {current_request.task_idx + 1}")
             self.app.addLabel("LAB_IS_ONLINE", text=f"Online? {'Yes' if current_request.is_online else 'No'}")
@@ -422,34 +494,24 @@ class UserInterface:
             self.app.stopLabelFrame()
 
         elif scene == Scene.TASK_MENU:
-            # gather data for display
-            ratings = {"Easy": 0, "Medium": 0, "Hard": 0}
-            feedback_for_this_task = []
-            for feedback in self.feedback_responses:
-                if feedback.module_number == self.selected_module and feedback.task_number == self.selected_task:
-                    feedback_for_this_task.append(feedback)
-                    ratings[feedback.difficulty] += 1
-            groups_completed = ratings["Easy"] + ratings["Medium"] + ratings["Hard"]
-            groups_completed_percent = 0
-            avg_rating = 0
-            if groups_completed > 0:
-                groups_completed_percent = round(groups_completed * 100 / len(self.groups), 2)
-                avg_rating = (ratings["Easy"] + (2 * ratings["Medium"]) + (3 * ratings["Hard"])) / groups_completed
-
-            self.set_window_size_and_center(500, 350)
+            # aggregated as feedback arrives
+            task_feedback = self.feedback_index.get(self.selected_module, self.selected_task)
+
+            self.set_window_size_and_center(500, 375)
             add_side_menu(lambda x: self.show_scene(Scene.MAIN_PAGE))
             self.app.startLabelFrame(f"Feedback for task {self.selected_task + 1} module {self.selected_module}",
                                      sticky="news", row=0, rowspan=6, column=1, colspan=3)
-            self.app.addLabel("LAB_GROUPS_COMPLETED", text=f"{groups_completed_percent}% of groups completed")
+            self.app.addLabel("LAB_GROUPS_COMPLETED")
             self.app.addLabel("LAB_RATINGS_TITLE", text="Ratings:")
-            self.app.addLabel("LAB_RATINGS", text=f"Easy: {ratings['Easy']}, Medium: {ratings['Medium']}, Hard: {ratings['Hard']}")
-            self.app.addLabel("LAB_AVERAGE_RATING", text=f"Average rating: {round(avg_rating, 2)}")
+            self.app.addLabel("LAB_RATINGS")
+            self.app.addLabel("LAB_AVERAGE_RATING")
+            self.app.addLabel("LAB_TREND")
+            self.set_task_feedback_labels(task_feedback)
 
             self.app.startScrollPane("PANE_FEEDBACK")
-            for feedback in feedback_for_this_task:
-                self.app.addLabel(str(uuid1()), f""" "{feedback.comment}"\n-Group {feedback.group_number} """)
-            if len(feedback_for_this_task) == 0:  # To remove warning
-                self.app.addLabel(str(uuid1()), "")
+            self.app.addLabel("LAB_FEEDBACK_TOP", "", row=0)  # To remove warning when there is no feedback
+            self.feedback_rows.sync(task_feedback.comments(), first_row=1)
+            self.rendered_task = (self.selected_module, self.selected_task)
             self.app.stopScrollPane()
             self.app.stopLabelFrame()
         else:
@@ -457,7 +519,14 @@ class UserInterface:
 
 
 if __name__ == "__main__":
-    ui = UserInterface(modules=sorted(import_modules(), key=lambda m: m.number),
-                       groups=sorted(import_groups(), key=lambda g: g.number))
+    metrics.start_exporter()
+    watch_catalog()
+    ui = UserInterface(get_catalog())
     ui.driver.stop()
-    ui.mqtt_client.client.disconnect()
+    if HISTORY_PATH and len(ui.session_feedback) > 0:
+        ui.session_feedback.append_to(HISTORY_PATH)
+    ui.mqtt_client.transport.disconnect()
+    ui.mqtt_client.dispatcher.stop()
+    ui.mqtt_client.notifier.stop()
+    log.info("Redraws", redraws=ui.refresh.redraws, saved=ui.refresh.redraws_saved)
+    log.info("Queue events", **ui.mqtt_client.sequencer.stats())
@@ -51,26 +51,167 @@ def get_stm_states():
     unclaimed = {
         "name": "unclaimed",
         "entry": "stm_log('unclaimed');",
-        "sig_feedback": "stm_receive_feedback",
-        "sig_rec_help_req": "stm_rec_help_req",
-        "sig_rem_help_req": "stm_rem_help_req",
+        "sig_feedback": "stm_receive_feedback(*)",
+        "sig_rec_help_req": "stm_rec_help_req(*)",
+        "sig_rem_help_req": "stm_rem_help_req(*)",
+        "sig_queue_snapshot": "stm_queue_snapshot(*)",
         "resolve_button": "stm_request_resolved",
         "sig_update_request": "stm_update_request"
     }
     waiting = {
         "name": "waiting",
         "entry": "stm_log('waiting'); start_timer('t', 500)",
-        "sig_feedback": "stm_receive_feedback",
-        "sig_rec_help_req": "stm_rec_help_req",
-        "sig_rem_help_req": "stm_rem_help_req",
+        "sig_feedback": "stm_receive_feedback(*)",
+        "sig_rec_help_req": "stm_rec_help_req(*)",
+        "sig_rem_help_req": "stm_rem_help_req(*)",
+        "sig_queue_snapshot": "stm_queue_snapshot(*)",
         "sig_update_request": "stm_update_request"
     }
     claimed = {
         "name": "claimed",
         "entry": "stm_log('claimed')",
-        "sig_feedback": "stm_receive_feedback",
-        "sig_rec_help_req": "stm_rec_help_req",
-        "sig_rem_help_req": "stm_rem_help_req",
+        "sig_feedback": "stm_receive_feedback(*)",
+        "sig_rec_help_req": "stm_rec_help_req(*)",
+        "sig_rem_help_req": "stm_rem_help_req(*)",
+        "sig_queue_snapshot": "stm_queue_snapshot(*)",
         "sig_update_request": "stm_update_request"
     }
     return [unclaimed, waiting, claimed]
+
+
+if __name__ == "__main__":
+    # ==== BURST TEST: N back-to-back messages must give N processed events ====
+    # queue events are dropped and reordered on the way to the client, which has to resync
+    import json
+    import random
+    import time
+    from stmpy import Machine, Driver
+    from code_teaching_assistant.help_request_store import HelpRequestStore
+    from code_teaching_assistant.main import MQTTClient, UserInterface
+    from common.dispatcher import MessageDispatcher
+    from common.help_request import HelpRequest
+    from common.mqtt_utils import RequestWrapper, TOPIC_QUEUE, TOPIC_SERVER, TOPIC_SNAPSHOT, TOPIC_RESYNC, \
+        TYPE_ADD_HELP_REQUEST, TYPE_CANCEL_HELP_REQUEST
+    from common.notification import NullBackend
+    from common.refresh_scheduler import RefreshScheduler
+    from common.transport import LoopbackBus, LoopbackTransport
+    from server.main import QueueServer
+
+    class HeadlessTA:
+        """ Runs the TA state machine callbacks without a window """
+        stm_log = UserInterface.stm_log
+        stm_rec_help_req = UserInterface.stm_rec_help_req
+        stm_rem_help_req = UserInterface.stm_rem_help_req
+        stm_queue_snapshot = UserInterface.stm_queue_snapshot
+
+        def __init__(self):
+            self.help_requests = HelpRequestStore()
+            self.current_scene = -1
+            self.refresh = RefreshScheduler(None, None, lambda: self.current_scene)  # never started, no redraws
+            self.selected_help_request = ""
+
+    class LossyTransport(LoopbackTransport):
+        """
+        2% of the queue events are dropped the first time they are delivered, and the rest are shuffled in groups
+        of 4. Events sent again are delivered right away
+        """
+        def __init__(self, bus):
+            super().__init__(bus)
+            self.held = []
+            self.seen = set()
+            self.random = random.Random(4115)
+
+        def deliver(self, topic, payload):
+            if topic != TOPIC_SERVER or payload in self.seen:
+                self.flush()
+                super().deliver(topic, payload)
+                return
+            self.seen.add(payload)
+            if self.random.random() >= 0.02:
+                self.held.append(payload)
+                if len(self.held) == 4:
+                    self.flush()
+
+        def flush(self):
+            self.random.shuffle(self.held)
+            for payload in self.held:
+                super().deliver(TOPIC_SERVER, payload)
+            self.held = []
+
+    def start_ta(transport):
+        ta = HeadlessTA()
+        stm = Machine(name="stm_teaching_assistant", transitions=get_stm_transitions(), obj=ta, states=get_stm_states())
+        driver = Driver()
+        driver.add_machine(stm)
+        driver.start()
+        client = MQTTClient(stm, ta.help_requests, transport)
+        client.notifier.backend = NullBackend()
+        return ta, driver, client
+
+    def wait_until(condition, timeout=30):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.1)
+
+    bus = LoopbackBus()
+    server_transport = LoopbackTransport(bus)
+    server = QueueServer(server_transport)
+    server_dispatcher = MessageDispatcher(server.handle_message, maxsize=2000)
+    server_transport.on_message = server_dispatcher.submit
+    server_transport.subscribe(TOPIC_RESYNC)
+    server_transport.start()
+    ta, driver, client = start_ta(LossyTransport(bus))
+
+    added = [HelpRequest(i % 50, 1, 0, False, "", f"request {i}") for i in range(700)]
+    cancelled = added[::7] + added[1::7] + added[2::7]  # 300 cancels, 1000 messages in total
+    for request in added:
+        server_dispatcher.submit(TOPIC_QUEUE, RequestWrapper(TYPE_ADD_HELP_REQUEST, request.payload()).payload())
+    for request in cancelled:
+        server_dispatcher.submit(TOPIC_QUEUE, RequestWrapper(TYPE_CANCEL_HELP_REQUEST, {"id": request.id}).payload())
+
+    expected = {r.id for r in added} - {r.id for r in cancelled}
+    wait_until(lambda: client.sequencer.last_seq == server.seq == len(added) + len(cancelled) and
+               client.dispatcher.stats()["depth"] == 0 and driver._event_queue.empty())
+    actual = {r.id for r in ta.help_requests}
+    print(client.dispatcher.stats())
+    print(f"Sequencer: {client.sequencer.stats()}, resync requests at the server: {server.resync_requests}")
+    print(f"Expected {len(expected)} help requests, got {len(actual)}")
+    assert actual == expected, "help requests were lost or duplicated"
+    assert server.queue.global_q_pos == len(expected), "queue server and TA client disagree"
+
+    # ==== LATE JOIN: a client connecting now starts from the retained snapshot alone ====
+    wait_until(lambda: json.loads(bus.retained.get(TOPIC_SNAPSHOT, b"{}")).get("data", {}).get("seq") == server.seq)
+    late_ta, late_driver, late_client = start_ta(LoopbackTransport(bus))
+    wait_until(lambda: len(late_ta.help_requests) == len(expected))
+    print(f"{server.snapshots_published} snapshots published for {server.seq} queue events, "
+          f"{len(bus.retained[TOPIC_SNAPSHOT])} bytes")
+    assert [r.id for r in late_ta.help_requests] == [r.id for r in added if r.id in expected], \
+        "late-joining client has a different queue"
+
+    # ==== SERVER RESTART: a new server without a snapshot numbers its events from 1 again ====
+    server_transport.disconnect()
+    server_dispatcher.stop()
+    server_transport = LoopbackTransport(bus)
+    server = QueueServer(server_transport)
+    server_dispatcher = MessageDispatcher(server.handle_message)
+    server_transport.on_message = server_dispatcher.submit
+    server_transport.subscribe(TOPIC_RESYNC)
+    server_transport.start()
+    added = [HelpRequest(i, 2, 0, False, "", f"after restart {i}") for i in range(5)]
+    for request in added:
+        server_dispatcher.submit(TOPIC_QUEUE, RequestWrapper(TYPE_ADD_HELP_REQUEST, request.payload()).payload())
+    expected = [r.id for r in added]
+    wait_until(lambda: [r.id for r in ta.help_requests] == [r.id for r in late_ta.help_requests] == expected)
+    print(f"After the restart: {len(ta.help_requests)} help requests, sequencer {client.sequencer.stats()}")
+    assert [r.id for r in ta.help_requests] == [r.id for r in late_ta.help_requests] == expected, \
+        "clients kept the queue of the old server"
+    assert client.sequencer.restarts == late_client.sequencer.restarts == 1
+
+    for d in (driver, late_driver):
+        d.stop()
+    for c in (client, late_client):
+        c.dispatcher.stop()
+        c.notifier.stop()
+    server_dispatcher.stop()
+    print("OK")
@@ -0,0 +1,89 @@
+import tkinter as tk
+
+
+class VirtualList:
+    """
+    Scrolling list of (label, button) rows that only creates widgets for the rows in view.
+    A fixed pool of `visible_rows` rows is created once. Scrolling moves the offset into the data and rebinds
+    the pooled rows, so memory and redraw time stay constant no matter how many items there are.
+    Scrolling is row by row, so no rows outside the view need to be kept.
+    Items are read through get_count() and get_row(index) -> (key, text, enabled); on_click(key) is called
+    when the button of a row is pressed.
+    """
+
+    def __init__(self, parent, get_count, get_row, on_click, button_text: str, visible_rows: int = 10):
+        self.get_count = get_count
+        self.get_row = get_row
+        self.on_click = on_click
+        self.visible_rows = visible_rows
+        self.offset = 0
+
+        self.frame = tk.Frame(parent)
+        self.scrollbar = tk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.scrollbar.grid(row=0, column=2, rowspan=visible_rows, sticky="ns")
+        self.labels = []
+        self.buttons = []
+        self.keys = [None] * visible_rows
+        for i in range(visible_rows):
+            label = tk.Label(self.frame, anchor="w")
+            button = tk.Button(self.frame, text=button_text, command=lambda _i=i: self.on_row_click(_i))
+            label.grid(row=i, column=0, sticky="we")
+            button.grid(row=i, column=1)
+            self.labels.append(label)
+            self.buttons.append(button)
+        self.frame.columnconfigure(0, weight=1)
+        # appJar warns about widgets it did not create when it removes them
+        for widget in [self.frame, self.scrollbar] + self.labels + self.buttons:
+            widget.SKIP_CLEANSE = True
+            widget.bind("<MouseWheel>", self.on_mouse_wheel)
+            widget.bind("<Button-4>", lambda e: self.scroll(-1))  # mouse wheel on X11
+            widget.bind("<Button-5>", lambda e: self.scroll(1))
+
+    def grid(self, **kwargs):
+        self.frame.grid(**kwargs)
+
+    def refresh(self):
+        """ Rebind the visible rows to the current data, O(visible rows) """
+        count = self.get_count()
+        self.offset = max(0, min(self.offset, count - self.visible_rows))
+        for i in range(self.visible_rows):
+            index = self.offset + i
+            row = None
+            if index < count:
+                try:
+                    row = self.get_row(index)
+                except IndexError:  # items were removed by another thread since get_count()
+                    pass
+            if row is not None:
+                key, text, enabled = row
+                self.keys[i] = key
+                self.labels[i].config(text=text)
+                self.buttons[i].config(state=tk.NORMAL if enabled else tk.DISABLED)
+                self.labels[i].grid()
+                self.buttons[i].grid()
+            else:
+                self.keys[i] = None
+                self.labels[i].grid_remove()
+                self.buttons[i].grid_remove()
+        if count <= self.visible_rows:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.offset / count, (self.offset + self.visible_rows) / count)
+
+    def scroll(self, rows: int):
+        self.offset += rows
+        self.refresh()
+
+    def on_scrollbar(self, action, value, unit=None):
+        if action == tk.MOVETO:
+            self.offset = int(float(value) * self.get_count())
+            self.refresh()
+        elif action == tk.SCROLL:
+            self.scroll(int(value) * (self.visible_rows if unit == tk.PAGES else 1))
+
+    def on_mouse_wheel(self, event):
+        self.scroll(-1 if event.delta > 0 else 1)
+
+    def on_row_click(self, i: int):
+        if self.keys[i] is not None:
+            self.on_click(self.keys[i])
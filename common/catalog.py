@@ -0,0 +1,153 @@
+import os
+from threading import Lock, Thread
+from time import sleep
+from typing import Optional
+
+from common.group import Group
+from common.io_utils import DATA_DIR, import_groups, import_modules
+from common.logger import get_logger
+from common.module import Module
+
+log = get_logger("catalog")
+
+CATALOG_FILES = ("modules.json", "groups.json")
+
+
+class Catalog:
+    """
+    The modules and groups of the course, sorted by number, with O(1) lookups by module number, group number and
+    table. Immutable: a changed data directory gives a new Catalog, see get_catalog() and watch_catalog().
+    """
+    __slots__ = ("modules", "groups", "_modules", "_groups", "_tables")
+
+    def __init__(self, modules: list, groups: list):
+        set_field = object.__setattr__
+        set_field(self, "modules", tuple(sorted(modules, key=lambda m: m.number)))
+        set_field(self, "groups", tuple(sorted(groups, key=lambda g: g.number)))
+        set_field(self, "_modules", {module.number: module for module in self.modules})
+        set_field(self, "_groups", {group.number: group for group in self.groups})
+        set_field(self, "_tables", {group.table: group for group in self.groups})
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Catalog is immutable, can't set {name}")
+
+    @staticmethod
+    def load(data_dir: str = DATA_DIR) -> "Catalog":
+        return Catalog(import_modules(data_dir), import_groups(data_dir))
+
+    def module(self, number: int) -> Optional[Module]:
+        return self._modules.get(number)
+
+    def group(self, number: int) -> Optional[Group]:
+        return self._groups.get(number)
+
+    def group_at_table(self, table: int) -> Optional[Group]:
+        return self._tables.get(table)
+
+    def task_count(self, module_number: int) -> int:
+        """ Number of tasks in a module, 0 for unknown modules """
+        module = self._modules.get(module_number)
+        return module.task_count if module is not None else 0
+
+
+_catalog = None
+_data_dir = DATA_DIR
+_signature = None  # (mtime, size) of the catalog files when _catalog was loaded
+_listeners = []
+_lock = Lock()
+_watching = False
+
+
+def _file_signature(data_dir: str) -> tuple:
+    signature = []
+    for name in CATALOG_FILES:
+        try:
+            stat = os.stat(os.path.join(data_dir, name))
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def get_catalog() -> Catalog:
+    """ The shared catalog, loaded from the data directory the first time """
+    global _catalog, _signature
+    with _lock:
+        if _catalog is None:
+            _signature = _file_signature(_data_dir)
+            _catalog = Catalog.load(_data_dir)
+        return _catalog
+
+
+def add_catalog_listener(listener):
+    """ listener(catalog) is called on the watcher thread after the catalog was reloaded """
+    _listeners.append(listener)
+
+
+def reload_catalog_if_changed() -> bool:
+    """ Load the catalog again if a data file changed since it was loaded. Returns True if it was replaced """
+    global _catalog, _signature
+    with _lock:
+        signature = _file_signature(_data_dir)
+        if signature == _signature:
+            return False
+        try:
+            catalog = Catalog.load(_data_dir)
+        except (ValueError, KeyError, TypeError) as e:  # e.g. a file that is being written, try again next time
+            log.warning("Could not reload the catalog", error=e)
+            return False
+        _signature = signature
+        _catalog = catalog
+    log.info("Catalog reloaded", modules=len(catalog.modules), groups=len(catalog.groups))
+    for listener in _listeners:
+        listener(catalog)
+    return True
+
+
+def watch_catalog(interval: float = 1.0):
+    """ Reload the catalog whenever the data files change, checking their modification times every `interval` s """
+    global _watching
+    with _lock:
+        if _watching:
+            return
+        _watching = True
+
+    def poll():
+        while True:
+            sleep(interval)
+            reload_catalog_if_changed()
+    Thread(target=poll, daemon=True).start()
+
+
+if __name__ == "__main__":
+    # ==== CATALOG TEST: lookups, and reloading after the data files change ====
+    import json
+    import tempfile
+    from threading import Event
+
+    _data_dir = tempfile.mkdtemp()
+
+    def write(modules: list, groups: list):
+        for name, items in (("modules.json", modules), ("groups.json", groups)):
+            with open(os.path.join(_data_dir, name), "w") as file:
+                json.dump([item.payload() for item in items], file)
+
+    write([Module(2, "State machines", 4), Module(1, "Sequence diagrams", 6)], [Group(i, 100 - i) for i in range(1, 61)])
+    catalog = get_catalog()
+    assert [module.number for module in catalog.modules] == [1, 2]
+    assert catalog.task_count(1) == 6 and catalog.task_count(3) == 0
+    assert catalog.group(7).table == 93 and catalog.group_at_table(93).number == 7 and catalog.group(61) is None
+    try:
+        catalog.groups = ()
+        assert False, "catalog should be immutable"
+    except AttributeError:
+        pass
+
+    reloaded = Event()
+    add_catalog_listener(lambda new_catalog: reloaded.set())
+    watch_catalog(interval=0.05)
+    assert not reload_catalog_if_changed()
+    write([Module(1, "Sequence diagrams", 6)], [Group(1, 1)])
+    assert reloaded.wait(2), "catalog was not reloaded"
+    assert get_catalog() is not catalog and get_catalog().task_count(2) == 0 and catalog.task_count(2) == 4
+    print("OK")
@@ -0,0 +1,211 @@
+import heapq
+import time
+from datetime import datetime
+from queue import Empty
+from threading import Lock, Timer
+
+from stmpy import Driver
+
+
+class SystemClock:
+    """ The wall clock """
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def time(self) -> float:
+        """ Seconds since the epoch """
+        return time.time()
+
+    def time_ns(self) -> int:
+        """ Nanoseconds since the epoch """
+        return time.time_ns()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def call_later(self, delay: float, callback):
+        timer = Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+
+    def add_listener(self, listener):
+        """ The wall clock never jumps, listeners are not needed """
+
+
+class VirtualClock:
+    """
+    A clock that only moves when advance() is called, for simulations that run much faster than real time and
+    give the same result every time. Callbacks from call_later() run inside advance(), in time order.
+    """
+
+    def __init__(self, start: datetime = datetime(2022, 5, 2, 8, 15)):
+        self._time = start.timestamp()
+        self._callbacks = []  # heap of (time, seq, callback)
+        self._seq = 0
+        self._listeners = []
+        self._lock = Lock()
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self._time)
+
+    def time(self) -> float:
+        return self._time
+
+    def time_ns(self) -> int:
+        return int(round(self._time * 1e9))
+
+    def monotonic(self) -> float:
+        return self._time
+
+    def call_later(self, delay: float, callback):
+        with self._lock:
+            heapq.heappush(self._callbacks, (self._time + delay, self._seq, callback))
+            self._seq += 1
+
+    def next_callback_at(self):
+        """ Time of the next call_later() callback, None if there is none """
+        with self._lock:
+            return self._callbacks[0][0] if self._callbacks else None
+
+    def add_listener(self, listener):
+        """ listener() is called after every advance(), e.g. to wake up a waiting thread """
+        self._listeners.append(listener)
+
+    def advance(self, seconds: float):
+        self.advance_to(self._time + seconds)
+
+    def advance_to(self, t: float):
+        while True:
+            with self._lock:
+                if not self._callbacks or self._callbacks[0][0] > t:
+                    break
+                callback_time, _seq, callback = heapq.heappop(self._callbacks)
+                self._time = max(self._time, callback_time)
+            callback()
+        self._time = max(self._time, t)
+        for listener in self._listeners:
+            listener()
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    """ The clock used for timestamps, queue times and state machine timers """
+    return _clock
+
+
+def set_clock(clock):
+    """ Replace the clock, e.g. with a VirtualClock. Do this before creating clients, servers and drivers """
+    global _clock
+    _clock = clock
+
+
+class ClockDriver(Driver):
+    """
+    stmpy driver whose timers follow a clock (by default the one from get_clock()) instead of the wall clock.
+    With a VirtualClock, either start() it as usual (advance() wakes it up), or don't start it and call
+    run_pending() after each advance() to run everything on the calling thread.
+    """
+
+    def __init__(self, clock=None):
+        super().__init__()
+        self.clock = clock if clock is not None else get_clock()
+        self.clock.add_listener(self._wake_queue)
+        self._max_transitions = None
+
+    def _millis(self) -> int:
+        return int(round(self.clock.time() * 1000))
+
+    def _start_timer(self, name, timeout, stm):
+        self._stop_timer(name, stm, log=False)
+        self._timer_queue.append({'id': name, 'timeout': timeout, 'timeout_abs': self._millis() + int(timeout),
+                                  'stm': stm, 'tid': stm.id + '_' + name})
+        self._sort_timer_queue()
+        self._wake_queue()
+
+    def _get_timer(self, name, stm):
+        tid = stm.id + '_' + name
+        for timer in self._timer_queue:
+            if timer['tid'] == tid:
+                return timer['timeout_abs'] - self._millis()
+        return None
+
+    def _check_timers(self):
+        if self._timer_queue:
+            timer = self._timer_queue[0]
+            if timer['timeout_abs'] <= self._millis():
+                self._timer_queue.pop(0)
+                self._add_event(timer['id'], [], {}, timer['stm'], front=True)
+            else:
+                self._next_timeout = max(0, timer['timeout_abs'] - self._millis()) / 1000
+        else:
+            self._next_timeout = None
+
+    def next_timer_at(self):
+        """ Clock time (in seconds) when the next timer expires, None if no timer is running """
+        timers = list(self._timer_queue)
+        return timers[0]['timeout_abs'] / 1000 if timers else None
+
+    def run_pending(self) -> int:
+        """ Run all queued events and expired timers on the calling thread, returns the number of events run """
+        count = 0
+        while True:
+            self._check_timers()
+            try:
+                event = self._event_queue.get_nowait()
+            except Empty:
+                return count
+            if event is not None:
+                self._execute_transition(stm=event['stm'], event_id=event['id'], args=event['args'],
+                                         kwargs=event['kwargs'], event=event)
+                count += 1
+
+
+if __name__ == "__main__":
+    # ==== VIRTUAL TIME TEST: a 500 ms state machine timer under a virtual clock ====
+    from stmpy import Machine
+
+    class Waiter:
+        def __init__(self):
+            self.expired_at = None
+
+        def on_timeout(self):
+            self.expired_at = clock.time()
+
+    clock = VirtualClock()
+    waiter = Waiter()
+    machine = Machine(name="waiter", obj=waiter, transitions=[
+        {"source": "initial", "target": "waiting", "effect": "start_timer('t', 500)"},
+        {"source": "waiting", "target": "done", "trigger": "t", "effect": "on_timeout"},
+    ])
+    driver = ClockDriver(clock)
+    driver.add_machine(machine)
+    started = clock.time()
+    driver.run_pending()
+    clock.advance(0.499)
+    driver.run_pending()
+    assert machine.state == "waiting", machine.state
+    clock.advance(0.001)
+    driver.run_pending()
+    assert machine.state == "done" and waiter.expired_at - started == 0.5, machine.state
+
+    # the same machine, on a driver thread woken up by the clock
+    waiter.expired_at = None
+    machine = Machine(name="waiter", obj=waiter, transitions=[
+        {"source": "initial", "target": "waiting", "effect": "start_timer('t', 60000)"},
+        {"source": "waiting", "target": "done", "trigger": "t", "effect": "on_timeout"},
+    ])
+    driver = ClockDriver(clock)
+    driver.add_machine(machine)
+    driver.start()
+    time.sleep(0.1)
+    wall = time.perf_counter()
+    clock.advance(60)
+    while waiter.expired_at is None and time.perf_counter() - wall < 5:
+        time.sleep(0.001)
+    driver.stop()
+    assert waiter.expired_at is not None, "timer did not fire"
+    print(f"60 s virtual timer fired after {(time.perf_counter() - wall) * 1000:.1f} ms")
+    print("OK")
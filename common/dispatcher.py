@@ -0,0 +1,153 @@
+from collections import OrderedDict
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+from time import perf_counter
+
+from common import metrics
+from common.logger import get_logger
+from common.mqtt_utils import decode_message, DecodeError, Message, TYPE_NAMES
+
+log = get_logger("dispatcher")
+MESSAGES_RECEIVED = metrics.counter("messages_received_total", "Messages received, by request type")
+MESSAGES_DROPPED = metrics.counter("messages_dropped_total", "Messages dropped because a dispatcher queue was full")
+DECODE_ERRORS = metrics.counter("message_decode_errors_total", "Payloads that were not valid messages")
+DECODE_SECONDS = metrics.histogram("message_decode_seconds", "Time spent decoding payloads")
+HANDLE_SECONDS = metrics.histogram("message_handle_seconds", "Time spent in the message handler, by request type")
+QUEUE_SECONDS = metrics.histogram("message_queue_seconds", "Time from submit() until the handler returned")
+
+
+class _DecodeCache:
+    """
+    The most recently decoded payloads, shared by the dispatchers of a process. Every client on a LoopbackBus
+    receives the same payload for a publish, which is then decoded once instead of once per client
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self._messages = OrderedDict()  # payload -> Message
+        self._lock = Lock()
+
+    def decode(self, payload) -> Message:
+        with self._lock:
+            message = self._messages.get(payload)
+            if message is not None:
+                self._messages.move_to_end(payload)
+                return message
+        message = decode_message(payload)
+        with self._lock:
+            self._messages[payload] = message
+            if len(self._messages) > self.size:
+                self._messages.popitem(last=False)
+        return message
+
+
+_decoded = _DecodeCache()
+
+
+class MessageDispatcher:
+    """
+    Moves message handling off the MQTT network thread.
+    on_message() only calls submit(), which puts the raw payload in a bounded queue. Worker threads decode
+    the payload and call handler(topic, message). With more than one worker, messages may be handled out of order.
+    Dispatchers receiving the same payload share the decoded message, so handlers must not change it.
+    With no workers, nothing is handled until process_pending() is called, e.g. by a simulation running everything
+    on one thread.
+    """
+
+    def __init__(self, handler, maxsize: int = 1000, workers: int = 1):
+        self.handler = handler
+        self.queue = Queue(maxsize=maxsize)
+        self._lock = Lock()
+        self._stopped = False
+        # counters
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.decode_errors = 0
+        self.total_latency = 0.0  # seconds, from submit() until the handler returned
+        self.max_latency = 0.0
+        self.workers = [Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, topic: str, payload: bytes) -> bool:
+        """ Called from the network thread. Never blocks, drops the message if the queue is full """
+        with self._lock:
+            self.received += 1
+        try:
+            self.queue.put_nowait((topic, payload, perf_counter()))
+            return True
+        except Full:
+            with self._lock:
+                self.dropped += 1
+            MESSAGES_DROPPED.inc()
+            return False
+
+    def process_pending(self) -> int:
+        """ Handle the queued messages on the calling thread, returns the number of messages handled """
+        count = 0
+        while len(self.queue.queue) > 0:  # without the queue's lock, most dispatchers of a simulation are idle
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                self._handle(item)
+                count += 1
+        return count
+
+    def stop(self):
+        """ Stop the workers after the message they are handling. Never blocks, even if the queue is full """
+        self._stopped = True
+        for _ in self.workers:
+            try:
+                self.queue.put_nowait(None)  # wakes up a worker waiting for a message
+            except Full:
+                break  # the workers are busy, and see the flag after their next message
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "depth": self.queue.qsize(),
+                "received": self.received,
+                "dropped": self.dropped,
+                "processed": self.processed,
+                "decode_errors": self.decode_errors,
+                "avg_latency_ms": 1000 * self.total_latency / self.processed if self.processed > 0 else 0,
+                "max_latency_ms": 1000 * self.max_latency,
+            }
+
+    def _work(self):
+        while not self._stopped:
+            item = self.queue.get()
+            if item is None or self._stopped:
+                return
+            self._handle(item)
+
+    def _handle(self, item):
+        topic, payload, submitted_at = item
+        started = perf_counter()
+        try:
+            message = _decoded.decode(payload)
+        except DecodeError as e:
+            log.warning("Dropping message", topic=topic, error=e)
+            with self._lock:
+                self.decode_errors += 1
+            DECODE_ERRORS.inc()
+            return
+        decoded = perf_counter()
+        DECODE_SECONDS.observe(decoded - started)
+        message_type = TYPE_NAMES.get(message.request_type, str(message.request_type))
+        MESSAGES_RECEIVED.inc(type=message_type)
+        try:
+            self.handler(topic, message)
+        except Exception as e:  # a failing handler must not kill the worker
+            log.error("Error while handling message", topic=topic, type=message_type, error=repr(e))
+        handled = perf_counter()
+        HANDLE_SECONDS.observe(handled - decoded, type=message_type)
+        latency = handled - submitted_at
+        QUEUE_SECONDS.observe(latency)
+        with self._lock:
+            self.processed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
@@ -1,13 +1,26 @@
+from sys import intern
 
 
 class Feedback:
+    """ Immutable. The difficulty is interned, as there are only a few different ones """
+    __slots__ = ("group_number", "module_number", "task_number", "comment", "difficulty")
 
     def __init__(self, group_number: int, module_number: int, task_number: int, comment: str, difficulty: str):
-        self.group_number = group_number
-        self.module_number = module_number
-        self.task_number = task_number
-        self.comment = comment
-        self.difficulty = difficulty
-
-    def payload(self):
-        return str(vars(self))
+        set_field = object.__setattr__
+        set_field(self, "group_number", group_number)
+        set_field(self, "module_number", module_number)
+        set_field(self, "task_number", task_number)
+        set_field(self, "comment", comment)
+        set_field(self, "difficulty", intern(difficulty) if isinstance(difficulty, str) else difficulty)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Feedback is immutable, can't set {name}")
+
+    def payload(self) -> dict:
+        return {
+            "group_number": self.group_number,
+            "module_number": self.module_number,
+            "task_number": self.task_number,
+            "comment": self.comment,
+            "difficulty": self.difficulty,
+        }
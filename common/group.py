@@ -1,8 +1,22 @@
-
 class Group:
+    """ Immutable, groups are replaced rather than edited """
+    __slots__ = ("number", "table")
+
     def __init__(self, number: int, table: int):
-        self.number = number  # e.g. Group 1
-        self.table = table  # e.g. Table 5
+        object.__setattr__(self, "number", number)  # e.g. Group 1
+        object.__setattr__(self, "table", table)  # e.g. Table 5
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Group is immutable, can't set {name}")
+
+    def __eq__(self, other):
+        return isinstance(other, Group) and (self.number, self.table) == (other.number, other.table)
+
+    def __hash__(self):
+        return hash((self.number, self.table))
+
+    def payload(self) -> dict:
+        return {"number": self.number, "table": self.table}
 
     def __str__(self):
         return f"Group {self.number} table {self.table}"
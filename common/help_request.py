@@ -2,6 +2,8 @@ from datetime import datetime
 from enum import Enum
 from uuid import uuid1
 
+from common.clock import get_clock
+
 
 class RequestStatus(Enum):
     UNSENT: int = 0
@@ -11,8 +13,15 @@ class RequestStatus(Enum):
 
 
 class HelpRequest:
+    """
+    `time` is when the request was made, in nanoseconds since the epoch, so requests sort by time as plain ints,
+    also across midnight. `time_str` is the local time of day for display.
+    """
+    __slots__ = ("id", "module_number", "task_idx", "is_online", "zoom_url", "comment", "status", "queue_pos",
+                 "group_number", "claimed_by", "time")
 
-    def __init__(self, group_number: int, module_number: int, task_idx: int, is_online: bool, zoom_url: str, comment: str, _id=None):
+    def __init__(self, group_number: int, module_number: int, task_idx: int, is_online: bool, zoom_url: str,
+                 comment: str, _id=None, time: int = None):
         self.id = str(uuid1()) if _id is None else _id
         self.module_number = module_number
         self.task_idx = task_idx
@@ -23,13 +32,25 @@ class HelpRequest:
         self.queue_pos = -1
         self.group_number = group_number
         self.claimed_by = None
-        self.time = str(datetime.now().time())
+        # older clients sent the time of day as a string, which can't be ordered across midnight
+        self.time = time if isinstance(time, int) else get_clock().time_ns()
 
-    def payload(self):
-        variables = vars(self)
-        del variables["status"]
-        if variables["claimed_by"] is None:
-            variables["claimed_by"] = ''
-        variables["is_online"] = str(variables["is_online"]).lower()
-        return str(variables)
+    @property
+    def time_str(self) -> str:
+        """ e.g. "14:05:09" """
+        return datetime.fromtimestamp(self.time / 1e9).strftime("%H:%M:%S")
 
+    def payload(self) -> dict:
+        """ Message body for this request. Does not modify the request itself """
+        return {
+            "id": self.id,
+            "module_number": self.module_number,
+            "task_idx": self.task_idx,
+            "is_online": self.is_online,
+            "zoom_url": self.zoom_url,
+            "comment": self.comment,
+            "queue_pos": self.queue_pos,
+            "group_number": self.group_number,
+            "claimed_by": self.claimed_by or "",
+            "time": self.time,
+        }
@@ -1,17 +1,17 @@
 import json
-from os import path, chdir
+import os
+from os import path
 
 from common.group import Group
 from common.module import Module
 
+DATA_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), "data")  # <project>/data
+DATA_FILEPATH = DATA_DIR
 
-chdir(path.join(path.dirname(path.abspath(__file__)), ".."))  # set root to project dir
-DATA_FILEPATH = path.join("data")
 
-
-def import_modules():
+def import_modules(data_dir: str = DATA_DIR):
     try:
-        with open(path.join(DATA_FILEPATH, "modules.json"), "r") as f:
+        with open(path.join(data_dir, "modules.json"), "r") as f:
             loaded_data = json.load(f)
             loaded_modules = []
             for module in loaded_data:
@@ -21,9 +21,9 @@ def import_modules():
         return []
 
 
-def import_groups():
+def import_groups(data_dir: str = DATA_DIR):
     try:
-        with open(path.join(DATA_FILEPATH, "groups.json"), "r") as f:
+        with open(path.join(data_dir, "groups.json"), "r") as f:
             loaded_data = json.load(f)
             loaded_modules = []
             for group in loaded_data:
@@ -31,3 +31,13 @@ def import_groups():
             return loaded_modules
     except OSError:
         return []
+
+
+def write_json_atomic(filepath: str, data):
+    """ Write `data` as JSON to a temporary file next to `filepath`, then replace `filepath` with it in one step """
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, filepath)
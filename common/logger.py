@@ -0,0 +1,227 @@
+import atexit
+import json
+import os
+import sys
+import time
+from collections import deque
+from threading import Condition, Thread
+
+# KOMSYS_LOG_LEVEL: DEBUG (includes every message payload), INFO (default), WARNING or ERROR.
+# KOMSYS_LOG_FILE: write to this file instead of stdout, rotated at KOMSYS_LOG_MAX_BYTES (default 5 MB), keeping
+# KOMSYS_LOG_BACKUPS old files (default 3). KOMSYS_LOG_FORMAT=json writes one JSON object per line.
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+LOG_LEVEL = os.environ.get("KOMSYS_LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("KOMSYS_LOG_FILE")
+LOG_MAX_BYTES = int(os.environ.get("KOMSYS_LOG_MAX_BYTES", 5_000_000))
+LOG_BACKUPS = int(os.environ.get("KOMSYS_LOG_BACKUPS", 3))
+LOG_FORMAT = os.environ.get("KOMSYS_LOG_FORMAT", "text")
+
+
+def format_text(record: tuple) -> str:
+    created, level, name, text, fields = record
+    line = f"{time.strftime('%H:%M:%S', time.localtime(created))}.{int(created % 1 * 1000):03d} " \
+           f"{LEVEL_NAMES[level]:7} {name}: {text}"
+    if fields:
+        line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+    return line + "\n"
+
+
+def format_json(record: tuple) -> str:
+    created, level, name, text, fields = record
+    return json.dumps({"time": created, "level": LEVEL_NAMES[level], "logger": name, "msg": text, **fields},
+                      default=str) + "\n"
+
+
+class LogWriter:
+    """
+    Writes log records on a background thread, so logging never waits for the terminal or the disk.
+    Records go through a ring buffer of `capacity` records; when the writer falls behind, the oldest records are
+    dropped and the number of dropped records is logged. Formatting happens on the writer thread too.
+    Without a path, records go to whatever sys.stdout is when they are written.
+    """
+
+    def __init__(self, path: str = None, max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS,
+                 formatter=format_text, capacity: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.formatter = formatter
+        self.buffer = deque(maxlen=capacity)
+        self.dropped = 0
+        self.written = 0
+        self._file = None
+        self._size = 0
+        self._writing = False
+        self._condition = Condition()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, record: tuple):
+        with self._condition:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(record)
+            self._condition.notify()
+
+    def flush(self, timeout: float = 2.0):
+        """ Wait until everything logged so far is written """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while (self.buffer or self._writing) and time.monotonic() < deadline:
+                self._condition.wait(0.01)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.buffer:
+                    self._writing = False
+                    self._condition.notify_all()
+                    self._condition.wait()
+                records = list(self.buffer)
+                self.buffer.clear()
+                dropped, self.dropped = self.dropped, 0
+                self._writing = True
+            if dropped > 0:
+                records.insert(0, (time.time(), WARNING, "logger", f"dropped {dropped} log records", {}))
+            self._write("".join(self.formatter(record) for record in records))
+            self.written += len(records)
+
+    def _write(self, text: str):
+        try:
+            if self.path is None:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+                return
+            if self._file is None:
+                self._file = open(self.path, "a")
+                self._size = self._file.tell()
+            self._file.write(text)
+            self._file.flush()
+            self._size += len(text)
+            if self._size >= self.max_bytes:
+                self._rotate()
+        except (OSError, ValueError):  # e.g. stdout was closed, logging must never crash the client
+            pass
+
+    def _rotate(self):
+        """ app.log -> app.log.1 -> app.log.2 ..., the oldest one is removed """
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "a")
+        self._size = 0
+
+
+_level = {name: value for value, name in LEVEL_NAMES.items()}.get(LOG_LEVEL, INFO)
+_writer = None
+_loggers = {}
+
+
+def set_level(level: int):
+    global _level
+    _level = level
+
+
+def get_writer() -> LogWriter:
+    global _writer
+    if _writer is None:
+        _writer = LogWriter(LOG_FILE, formatter=format_json if LOG_FORMAT == "json" else format_text)
+        atexit.register(_writer.flush)
+    return _writer
+
+
+def set_writer(writer: LogWriter):
+    global _writer
+    _writer = writer
+
+
+class Logger:
+    """
+    Structured logger: log.info("Claim confirmed", id=req_id, ta=ta) logs the text with the fields.
+    Calls below the level return right away, and nothing is formatted on the calling thread, so debug calls
+    cost a function call unless they are enabled. Guard expensive arguments with `if log.enabled(DEBUG):`.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @staticmethod
+    def enabled(level: int) -> bool:
+        return level >= _level
+
+    def log(self, level: int, text: str, **fields):
+        if level >= _level:
+            get_writer().put((time.time(), level, self.name, text, fields))
+
+    def debug(self, text: str, **fields):
+        if DEBUG >= _level:
+            get_writer().put((time.time(), DEBUG, self.name, text, fields))
+
+    def info(self, text: str, **fields):
+        if INFO >= _level:
+            get_writer().put((time.time(), INFO, self.name, text, fields))
+
+    def warning(self, text: str, **fields):
+        if WARNING >= _level:
+            get_writer().put((time.time(), WARNING, self.name, text, fields))
+
+    def error(self, text: str, **fields):
+        if ERROR >= _level:
+            get_writer().put((time.time(), ERROR, self.name, text, fields))
+
+
+def get_logger(name: str) -> Logger:
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = Logger(name)
+    return logger
+
+
+if __name__ == "__main__":
+    # ==== LOGGER TEST: levels, structured fields, ring buffer overflow and file rotation ====
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "test.log")
+    writer = LogWriter(path, max_bytes=20_000, backups=2, capacity=100_000)
+    set_writer(writer)
+    set_level(INFO)
+    log = get_logger("test")
+
+    n = 100_000
+    started = time.perf_counter()
+    for i in range(n):
+        log.debug("payload", data={"i": i})
+    print(f"{n} disabled debug calls: {time.perf_counter() - started:.3f}s")
+    started = time.perf_counter()
+    for i in range(n):
+        log.info("Received claim request", type="claim_request", id=i, group=i % 150)
+    logged = time.perf_counter() - started
+    writer.flush(10)
+    print(f"{n} info calls: {logged:.3f}s on the calling thread")
+    assert writer.written == n, writer.written
+    assert sorted(os.listdir(directory)) == ["test.log", "test.log.1", "test.log.2"], os.listdir(directory)
+    lines = []
+    for name in ("test.log.2", "test.log.1", "test.log"):
+        with open(os.path.join(directory, name)) as file:
+            lines += file.read().splitlines()
+    last = lines[-1]
+    assert len(lines) < n and last.endswith(f"test: Received claim request type=claim_request id={n - 1} group={(n - 1) % 150}"), last
+
+    small = LogWriter(os.path.join(directory, "small.log"), capacity=10, formatter=format_json)
+    with small._condition:  # hold the writer back, so the buffer overflows
+        for i in range(50):
+            small.put((time.time(), INFO, "test", "overflow", {"i": i}))
+    small.flush()
+    with open(os.path.join(directory, "small.log")) as file:
+        lines = [json.loads(line) for line in file]
+    assert lines[0]["msg"] == "dropped 40 log records" and [line["i"] for line in lines[1:]] == list(range(40, 50))
+    print("OK")
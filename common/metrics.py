@@ -0,0 +1,333 @@
+import functools
+import json
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+from common.logger import get_logger
+
+log = get_logger("metrics")
+
+# KOMSYS_METRICS_PORT serves the metrics in the Prometheus text format on http://127.0.0.1:<port>/metrics.
+# KOMSYS_METRICS_FILE writes them as JSON to that file every KOMSYS_METRICS_INTERVAL seconds (default 10).
+METRICS_PORT = os.environ.get("KOMSYS_METRICS_PORT")
+METRICS_FILE = os.environ.get("KOMSYS_METRICS_FILE")
+METRICS_INTERVAL = float(os.environ.get("KOMSYS_METRICS_INTERVAL", 10))
+
+# seconds, from 0.1 ms to 2.5 s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_enabled = True
+
+
+def set_enabled(enabled: bool):
+    """ Turn recording on or off for all metrics, e.g. off in a simulation where the wall time means nothing """
+    global _enabled
+    _enabled = enabled
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: tuple) -> str:
+    if len(key) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}  # label key -> value
+        self._lock = threading.Lock()
+
+    def samples(self) -> list:
+        """ [(sample name, label key, value)] """
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+    def to_dict(self):
+        return {_format_labels(key): value for _name, key, value in self.samples()}
+
+
+class Counter(_Metric):
+    """ A value that only goes up, e.g. the number of messages received """
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if not _enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+
+class Gauge(_Metric):
+    """ A value that goes up and down, e.g. the queue length. Can also be read from a function when exported """
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self._functions = {}  # label key -> function returning the value
+
+    def set(self, value: float, **labels):
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def set_function(self, function, **labels):
+        with self._lock:
+            self._functions[_label_key(labels)] = function
+
+    def value(self, **labels) -> float:
+        key = _label_key(labels)
+        with self._lock:
+            function = self._functions.get(key)
+            value = self._values.get(key, 0)
+        return function() if function is not None else value
+
+    def samples(self) -> list:
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            values[key] = function()
+        return [(self.name, key, value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """ Counts observations (in seconds) in cumulative buckets, and keeps their sum """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        if not _enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def time(self, **labels):
+        """ Context manager observing the time spent inside it """
+        return _Timer(self, labels)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in sorted(self._values.items())]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((self.name + "_bucket", key + (("le", le),), cumulative))
+            samples.append((self.name + "_sum", key, total))
+            samples.append((self.name + "_count", key, cumulative))
+        return samples
+
+    def to_dict(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in sorted(self._values.items())]
+        result = {}
+        for key, counts, total in values:
+            count = sum(counts)
+            result[_format_labels(key)] = {"count": count, "sum": total, "avg": total / count if count else 0.0,
+                                           "buckets": dict(zip([repr(b) for b in self.buckets] + ["+Inf"], counts))}
+        return result
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    """ Holds the metrics of a process by name. Asking for an existing name returns the same metric """
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, description: str, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, description, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is a {metric.kind}, not a {cls.kind}")
+            return metric
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        return self._get(Counter, name, description)
+
+    def gauge(self, name: str, description: str = "") -> Gauge:
+        return self._get(Gauge, name, description)
+
+    def histogram(self, name: str, description: str = "", buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, description, buckets=buckets)
+
+    def render_prometheus(self) -> str:
+        """ All metrics in the Prometheus text exposition format """
+        with self._lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        return {metric.name: metric.to_dict() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, description: str = "") -> Counter:
+    return REGISTRY.counter(name, description)
+
+
+def gauge(name: str, description: str = "") -> Gauge:
+    return REGISTRY.gauge(name, description)
+
+
+def histogram(name: str, description: str = "", buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, description, buckets)
+
+
+def instrument_stm_callbacks(cls):
+    """ Class decorator: time every stm_* method in the stm_callback_seconds histogram, by callback name """
+    seconds = histogram("stm_callback_seconds", "Time spent in state machine callbacks")
+    for name, method in list(vars(cls).items()):
+        if name.startswith("stm_") and callable(method):
+            setattr(cls, name, _timed(method, seconds, callback=name))
+    return cls
+
+
+def _timed(method, seconds: Histogram, **labels):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with seconds.time(**labels):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no line per scrape
+
+
+def serve_metrics(port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """ Serve the Prometheus text format on localhost, on a daemon thread. Port 0 picks a free port """
+    server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Serving metrics", url=f"http://127.0.0.1:{server.server_address[1]}/metrics")
+    return server
+
+
+def dump_metrics(path: str, registry: Registry = REGISTRY):
+    """ Write all metrics to `path` as JSON, replacing the file in one step """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(registry.to_dict(), file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def start_exporter(registry: Registry = REGISTRY):
+    """ Start the exports configured with the KOMSYS_METRICS_* environment variables, if any """
+    if METRICS_PORT:
+        serve_metrics(int(METRICS_PORT), registry)
+    if METRICS_FILE:
+        def dump_periodically():
+            while True:
+                sleep(METRICS_INTERVAL)
+                dump_metrics(METRICS_FILE, registry)
+        threading.Thread(target=dump_periodically, daemon=True).start()
+
+
+if __name__ == "__main__":
+    # ==== METRICS TEST: counters, gauges and histograms, exported as Prometheus text and JSON ====
+    import urllib.request
+
+    registry = Registry()
+    messages = registry.counter("messages_received_total", "Messages received")
+    for _ in range(3):
+        messages.inc(type="add_help_request")
+    messages.inc(type="queue_event")
+    queue = []
+    registry.gauge("queue_length", "Open help requests").set_function(lambda: len(queue))
+    queue += [1, 2]
+    decode = registry.histogram("decode_seconds", "Decode time")
+    decode.observe(0.0003)
+    decode.observe(0.02)
+    assert registry.counter("messages_received_total") is messages
+    assert messages.value(type="add_help_request") == 3
+
+    server = serve_metrics(0, registry)
+    url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+    text = urllib.request.urlopen(url).read().decode()
+    server.shutdown()
+    print(text)
+    assert 'messages_received_total{type="add_help_request"} 3' in text
+    assert "queue_length 2" in text
+    assert 'decode_seconds_bucket{le="0.0005"} 1' in text and 'decode_seconds_bucket{le="+Inf"} 2' in text
+    assert "decode_seconds_count 2" in text
+
+    n = 100_000
+    started = perf_counter()
+    for _ in range(n):
+        decode.observe(0.001)
+    print(f"{n} observations in {perf_counter() - started:.3f}s")
+    assert registry.to_dict()["decode_seconds"][""]["count"] == n + 2
+
+    # ==== DISABLED: nothing is recorded until recording is turned on again ====
+    set_enabled(False)
+    messages.inc(type="queue_event")
+    decode.observe(0.001)
+    set_enabled(True)
+    assert messages.value(type="queue_event") == 1
+    assert registry.to_dict()["decode_seconds"][""]["count"] == n + 2
+    print("OK")
@@ -2,6 +2,8 @@ from common.help_request import HelpRequest
 
 
 class Module:
+    __slots__ = ("number", "name", "task_count", "finished_tasks", "requests", "latest_request")
+
     def __init__(self, number: int, name: str, task_count: int):
         self.number = number  # e.g. module 1
         self.name = name  # e.g. "Sequence diagrams"
@@ -21,5 +23,8 @@ class Module:
         self.requests.append(request)
         self.latest_request = request
 
+    def payload(self) -> dict:
+        return {"number": self.number, "name": self.name, "task_count": self.task_count}
+
     def __str__(self):
         return f"Module {self.number}: {self.name}, {self.task_count} tasks"
@@ -1,17 +1,24 @@
 import json
+import os
 
 from common.feedback import Feedback
 from common.help_request import HelpRequest
 
-BROKER = "mqtt20.iik.ntnu.no"  # https://github.com/mqtt/mqtt.org/wiki/public_brokers
-PORT = 1883
+# KOMSYS_BROKER and KOMSYS_PORT point the clients to another broker, e.g. python3 -m server.main --local-broker
+BROKER = os.environ.get("KOMSYS_BROKER", "mqtt20.iik.ntnu.no")  # https://github.com/mqtt/mqtt.org/wiki/public_brokers
+PORT = int(os.environ.get("KOMSYS_PORT", 1883))
 
 # topics
 TOPIC_BASE = "ttm4115/team1/"
 TOPIC_TA = TOPIC_BASE + "ta"
 TOPIC_TASK = TOPIC_BASE + "task"
 TOPIC_QUEUE = TOPIC_BASE + "queue"
-TOPIC_SERVER = TOPIC_BASE + "server"
+TOPIC_SERVER = TOPIC_BASE + "server"  # queue events published by the queue server
+TOPIC_SNAPSHOT = TOPIC_SERVER + "/snapshot"  # retained snapshot of the open queue
+TOPIC_RESYNC = TOPIC_SERVER + "/resync"  # clients asking for missed queue events
+
+# Version of the message envelope, bumped on incompatible changes
+PROTOCOL_VERSION = 1
 
 # From student
 TYPE_ADD_HELP_REQUEST = 0
@@ -24,46 +31,110 @@ TYPE_CLAIM_REQUEST = 3
 TYPE_RESOLVE_REQUEST = 5
 TYPE_CANCEL_CLAIM = 6
 
+# From queue server
+TYPE_QUEUE_EVENT = 7
+TYPE_QUEUE_SNAPSHOT = 8
+
+# From student and TA, to queue server
+TYPE_RESYNC_REQUEST = 9
+
+# e.g. TYPE_NAMES[TYPE_QUEUE_EVENT] == "queue_event", for logs and metrics
+TYPE_NAMES = {value: name[len("TYPE_"):].lower() for name, value in list(globals().items()) if name.startswith("TYPE_")}
+
+# Operations of a queue event
+QUEUE_OP_ADD = "add"
+QUEUE_OP_REMOVE = "remove"
+QUEUE_OP_CLAIM = "claim"
+QUEUE_OP_UNCLAIM = "unclaim"
+
+# Queue snapshots hold one array per open request, with these fields, in queue order. time is in ns since the epoch
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FIELDS = ("seq", "id", "group_number", "module_number", "task_idx", "time", "claimed_by", "is_online",
+                   "zoom_url", "comment")
 
-def parse_help_request(message: str) -> HelpRequest:
+
+class DecodeError(ValueError):
+    """ Raised when an incoming payload is not a valid message envelope """
+
+
+def parse_help_request(data: dict) -> HelpRequest:
     """
-    :param message: message to parse
+    :param data: body of an add-help-request message
     :return: help request object with data contained in message
     """
-    data = json.loads(str(message.split("\"")[1].replace("'", "\"").strip()))
-    data["is_online"] = bool(data["is_online"])
-    return HelpRequest(data["group_number"], data["module_number"], data["task_idx"], data["is_online"],
-                       data["zoom_url"], data["comment"], data["id"])
+    return HelpRequest(data["group_number"], data["module_number"], data["task_idx"], bool(data["is_online"]),
+                       data["zoom_url"], data["comment"], data["id"], time=data.get("time"))
 
-def parse_cancel_request(message: str) -> str:
-    """ Returns id of request to cancel """
-    return json.loads(str(message.split("\"")[1].replace("'", "\"").strip()))["id"]
 
+def parse_feedback(data: dict) -> Feedback:
+    return Feedback(data["group_number"], data["module_number"], data["task_number"], data["comment"],
+                    data["difficulty"])
 
-def parse_feedback(message: str) -> Feedback:
-    data = json.loads(str(message.split("\"")[1].replace("'", "\"").strip()))
-    return Feedback(data["group_number"], data["module_number"], data["task_number"], data["comment"], data["difficulty"])
 
+def parse_snapshot(data: dict) -> list:
+    """
+    :param data: body of a queue-snapshot message
+    :return: the open requests in queue order, as dicts with the SNAPSHOT_FIELDS as keys
+    """
+    if data["format"] > SNAPSHOT_VERSION:
+        raise DecodeError(f"Unsupported snapshot version {data['format']}")
+    return [dict(zip(SNAPSHOT_FIELDS, entry)) for entry in data["entries"]]
 
-def parse_body_field(message: str, field: str) -> str:
-    data = json.loads(str(message.split("\"")[1].replace("'", "\"").strip()))
-    return data[field]
 
+# request types whose body is converted to a domain object when decoded
+_BODY_PARSERS = {
+    TYPE_ADD_HELP_REQUEST: parse_help_request,
+    TYPE_SEND_FEEDBACK: parse_feedback,
+    TYPE_QUEUE_SNAPSHOT: parse_snapshot,
+}
 
-def parse_claim_request(message: str) -> (str, str):
-    """ Return (request_id, ta_name) """
-    data = json.loads(str(message.split("\"")[1].replace("'", "\"").strip()))
-    return data["id"], data["ta"]
 
+class Message:
+    """
+    A decoded message. `body` is a HelpRequest/Feedback for those request types, the list of entries for a queue
+    snapshot, otherwise the raw data
+    """
+
+    def __init__(self, request_type: int, data: dict, version: int = PROTOCOL_VERSION):
+        self.request_type = request_type
+        self.data = data
+        self.version = version
+        parser = _BODY_PARSERS.get(request_type)
+        self.body = data if parser is None else parser(data)
 
-def get_request_type(message: str) -> int:
-    return int(json.loads(str(message.split("\"")[0].replace("'", "\"").strip().split(",")[0])[2:] + "}")['request_type'])
+    def get(self, field: str, default=None):
+        """ Return a field of the message data """
+        return self.data.get(field, default)
+
+
+def decode_message(payload) -> Message:
+    """
+    Decode a raw MQTT payload exactly once.
+    :param payload: bytes or str, as produced by RequestWrapper.payload()
+    :raises DecodeError: if the payload is not a valid envelope
+    """
+    try:
+        envelope = json.loads(payload)
+        version = envelope["v"]
+        request_type = int(envelope["request_type"])
+        data = envelope["data"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise DecodeError(f"Invalid message: {e}") from e
+    if not isinstance(version, int) or isinstance(version, bool):
+        raise DecodeError(f"Invalid message: protocol version must be a number, got {version!r}")
+    if version > PROTOCOL_VERSION:
+        raise DecodeError(f"Unsupported protocol version {version}")
+    try:
+        return Message(request_type, data, version)
+    except (KeyError, TypeError) as e:
+        raise DecodeError(f"Invalid body for request type {request_type}: {e}") from e
 
 
 class RequestWrapper:
-    def __init__(self, request_type: int, data: str):
+    def __init__(self, request_type: int, data: dict):
         self.request_type = request_type
         self.data = data
 
     def payload(self) -> str:
-        return str(vars(self))
+        return json.dumps({"v": PROTOCOL_VERSION, "request_type": self.request_type, "data": self.data},
+                          separators=(",", ":"))
@@ -0,0 +1,116 @@
+import os
+import wave
+from threading import Thread, Event, Lock
+from time import monotonic, sleep
+
+from common.io_utils import DATA_DIR
+from common.logger import get_logger
+
+log = get_logger("notification")
+NOTIFICATION_SOUND_PATH = os.path.join(DATA_DIR, "notification_sound.wav")
+
+
+class NullBackend:
+    """ Silent backend, for headless and test runs """
+
+    def play(self):
+        pass
+
+
+class SimpleaudioBackend:
+    """ Plays a wav file that is read into memory once, with the simpleaudio package """
+
+    def __init__(self, file_path: str):
+        import simpleaudio
+        with wave.open(file_path, "rb") as f:
+            self.frames = f.readframes(f.getnframes())
+            self.channels = f.getnchannels()
+            self.sample_width = f.getsampwidth()
+            self.frame_rate = f.getframerate()
+        self._simpleaudio = simpleaudio
+
+    def play(self):
+        self._simpleaudio.play_buffer(self.frames, self.channels, self.sample_width, self.frame_rate).wait_done()
+
+
+class PlaysoundBackend:
+    """ Fallback backend using playsound, which reads the file on every play. Used if simpleaudio is missing """
+
+    def __init__(self, file_path: str):
+        from playsound import playsound
+        self.file_path = file_path
+        self._playsound = playsound
+
+    def play(self):
+        self._playsound(self.file_path)
+
+
+def create_backend(file_path: str = NOTIFICATION_SOUND_PATH, silent: bool = False):
+    """ Pick the best available backend. Setting KOMSYS_SILENT=1 in the environment forces the silent one """
+    if silent or os.environ.get("KOMSYS_SILENT") == "1":
+        return NullBackend()
+    try:
+        return SimpleaudioBackend(file_path)
+    except ImportError:
+        pass
+    except (OSError, EOFError, wave.Error) as e:  # missing or broken sound file, playsound would fail on it too
+        log.warning("Could not load the notification sound, notifications will be silent", path=file_path, error=e)
+        return NullBackend()
+    try:
+        return PlaysoundBackend(file_path)
+    except ImportError:
+        log.warning("No audio backend available, notifications will be silent")
+        return NullBackend()
+
+
+class NotificationPlayer:
+    """
+    Plays the notification sound on a dedicated thread.
+    notify() never blocks. The first notification chimes immediately; notifications arriving while the chime plays
+    or within `window` seconds after it are merged, and on_chime(count) is called once with the number of merged
+    notifications.
+    """
+
+    def __init__(self, backend=None, window: float = 1.0, on_chime=None):
+        self.backend = backend if backend is not None else create_backend()
+        self.window = window
+        self.on_chime = on_chime
+        self.chimes = 0
+        self.notifications = 0
+        self._pending = 0
+        self._lock = Lock()
+        self._event = Event()
+        self._stopped = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        with self._lock:
+            self._pending += 1
+            self.notifications += 1
+        self._event.set()
+
+    def stop(self):
+        self._stopped = True
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            if self._stopped:
+                return
+            started_at = monotonic()
+            try:
+                self.backend.play()
+            except Exception as e:
+                log.warning("Could not play notification sound", error=e)
+            remaining = self.window - (monotonic() - started_at)
+            if remaining > 0:
+                sleep(remaining)
+            with self._lock:
+                count = self._pending
+                self._pending = 0
+                self._event.clear()
+                self.chimes += 1
+            if self.on_chime is not None:
+                self.on_chime(count)
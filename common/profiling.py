@@ -0,0 +1,208 @@
+import atexit
+import functools
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter, sleep
+
+from common.logger import get_logger
+
+log = get_logger("profiling")
+
+# KOMSYS_PROFILE=<prefix> samples the profiled methods every KOMSYS_PROFILE_INTERVAL seconds (default 0.005),
+# and writes <prefix>.collapsed (for flamegraph.pl, speedscope, ...) and <prefix>.txt (per-function summary) on exit.
+PROFILE = os.environ.get("KOMSYS_PROFILE")
+PROFILE_INTERVAL = float(os.environ.get("KOMSYS_PROFILE_INTERVAL", 0.005))
+
+
+def _frame_name(code) -> str:
+    """ e.g. "MQTTClient.handle_message (code_student/main.py:62)" """
+    path = "/".join(code.co_filename.replace(os.sep, "/").split("/")[-2:])
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({path}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads that are inside a profiled method, from a background thread.
+    Stacks are rooted at the outermost profiled method, so a flame graph shows where time goes inside the hooks
+    and nothing else. Threads outside the hooks are not looked at.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()  # "hook;frame;frame" -> samples
+        self.seconds = Counter()  # "hook;frame;frame" -> time between the samples, which can be more than interval
+        self.samples = 0
+        self._active = {}  # thread id -> names of the profiled methods it is in, outermost first
+        self._wrapper_code = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def enter(self, name: str):
+        self._active.setdefault(threading.get_ident(), []).append(name)
+
+    def exit(self):
+        hooks = self._active.get(threading.get_ident())
+        if hooks:
+            hooks.pop()
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._running = False
+
+    def _run(self):
+        last = perf_counter()
+        while self._running:
+            sleep(self.interval)
+            now = perf_counter()
+            self.sample(now - last)
+            last = now
+
+    def sample(self, seconds: float):
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, hooks in list(self._active.items()):
+                hooks = list(hooks)
+                frame = frames.get(thread_id)
+                if len(hooks) == 0 or frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    if frame.f_code is self._wrapper_code:
+                        if len(hooks) == 0:
+                            break  # entered the wrapper but not yet registered
+                        stack.append(f"[{hooks.pop()}]")
+                        if len(hooks) == 0:
+                            break
+                    else:
+                        stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if stack and stack[-1].startswith("["):
+                    key = ";".join(reversed(stack))
+                    self.stacks[key] += 1
+                    self.seconds[key] += seconds
+                    self.samples += 1
+
+    def collapsed(self) -> str:
+        """ One "frame;frame;frame count" line per stack """
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def summary(self, top: int = 40) -> str:
+        """ Estimated time per profiled method, and per function: in the function itself and in total """
+        with self._lock:
+            stacks = dict(self.seconds)
+        hooks, own, total = Counter(), Counter(), Counter()
+        for stack, seconds in stacks.items():
+            frames = stack.split(";")
+            hooks[frames[0]] += seconds
+            own[frames[-1]] += seconds
+            for frame in set(frames):
+                total[frame] += seconds
+        lines = [f"{self.samples} samples, one every {self.interval * 1000:g} ms", "", "profiled method: ~ms"]
+        lines += [f"  {name}: {seconds * 1000:.0f}" for name, seconds in hooks.most_common()]
+        lines += ["", "function: ~ms in the function itself, ~ms in total"]
+        for name, seconds in own.most_common(top):
+            lines.append(f"  {name}: {seconds * 1000:.0f}, {total[name] * 1000:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, prefix: str):
+        self.stop()
+        with open(prefix + ".collapsed", "w") as file:
+            file.write(self.collapsed())
+        with open(prefix + ".txt", "w") as file:
+            file.write(self.summary())
+        log.info("Profile written", collapsed=prefix + ".collapsed", summary=prefix + ".txt")
+
+
+_profiler = None
+
+
+def enable(prefix: str = None, interval: float = PROFILE_INTERVAL) -> SamplingProfiler:
+    """
+    Start profiling. Only classes decorated after this call are profiled, so it is done on import when
+    KOMSYS_PROFILE is set. With a prefix, the results are written when the process exits.
+    """
+    global _profiler
+    _profiler = SamplingProfiler(interval)
+    _profiler._wrapper_code = _wrap(None, "").__code__
+    _profiler.start()
+    if prefix is not None:
+        atexit.register(_profiler.write, prefix)
+    return _profiler
+
+
+def _wrap(function, name: str):
+    profiler = _profiler
+
+    def profiled(*args, **kwargs):
+        profiler.enter(name)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.exit()
+    return functools.wraps(function)(profiled) if function is not None else profiled
+
+
+def profile_methods(*names: str, prefix: str = None):
+    """
+    Class decorator: profile the named methods, and the ones starting with `prefix`.
+    Returns the class unchanged when profiling is not enabled, so there is no overhead.
+    """
+    def decorate(cls):
+        if _profiler is None:
+            return cls
+        for attr, method in list(vars(cls).items()):
+            if callable(method) and (attr in names or (prefix is not None and attr.startswith(prefix))):
+                setattr(cls, attr, _wrap(method, f"{cls.__name__}.{attr}"))
+        return cls
+    return decorate
+
+
+if PROFILE:
+    enable(PROFILE)
+
+
+if __name__ == "__main__":
+    # ==== PROFILING TEST: two threads in profiled methods, one of them nested ====
+    profiler = enable()
+
+    def spin(seconds: float):
+        until = perf_counter() + seconds
+        while perf_counter() < until:
+            pass
+
+    @profile_methods("on_message", prefix="stm_")
+    class Client:
+        def on_message(self):
+            spin(0.2)
+            self.stm_update()
+
+        def stm_update(self):
+            spin(0.1)
+
+        def not_profiled(self):
+            spin(0.2)
+
+    client = Client()
+    worker = threading.Thread(target=client.on_message)
+    worker.start()
+    client.stm_update()
+    client.not_profiled()
+    worker.join()
+    profiler.stop()
+    print(profiler.collapsed())
+    print(profiler.summary())
+    stacks = profiler.stacks
+    assert all(stack.startswith("[Client.") for stack in stacks), stacks
+    assert not any("not_profiled" in stack for stack in stacks), stacks
+    nested = sum(count for stack, count in stacks.items() if stack.startswith("[Client.on_message];")
+                 and "[Client.stm_update]" in stack)
+    assert nested > 0, stacks
+    # 0.3 s in the worker's on_message, 0.1 s in the main thread's stm_update
+    assert 0.35 < sum(profiler.seconds.values()) < 0.5, profiler.seconds
+    print("OK")
@@ -0,0 +1,183 @@
+import datetime
+from typing import Optional
+
+
+class FenwickTree:
+    """ Binary indexed tree over positions 1..size, used to count queued requests before a given one """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    @staticmethod
+    def from_values(values: list) -> "FenwickTree":
+        """ Tree over values[1:] (values[0] is unused), built in O(n) """
+        tree = FenwickTree(0)
+        tree.size = len(values) - 1
+        tree.tree = list(values)
+        for i in range(1, tree.size + 1):
+            parent = i + (i & -i)
+            if parent <= tree.size:
+                tree.tree[parent] += tree.tree[i]
+        return tree
+
+    def values(self) -> list:
+        """ The point values, [0] + values at 1..size, recovered in O(n) """
+        values = list(self.tree)
+        for i in range(self.size, 0, -1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                values[parent] -= values[i]
+        return values
+
+    def add(self, i: int, delta: int):
+        while i > self.size:
+            self._grow()
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, i: int) -> int:
+        """ Sum of the values at 1..i """
+        i = min(i, self.size)
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def _grow(self):
+        """ Double the capacity, in O(n) """
+        grown = FenwickTree.from_values(self.values() + [0] * self.size)
+        self.size, self.tree = grown.size, grown.tree
+
+
+class QueueManager:
+    """
+    Keeps track of the global help-request queue, and this client's position in it.
+    Requests are ordered by sequence number. Positions and length are computed from a Fenwick tree in O(log n),
+    so they stay exact regardless of the order in which adds and cancels arrive.
+    The tree covers the sequence numbers from the oldest open request on (position 1 is sequence number base + 1).
+    When a request falls outside it, the open requests are indexed again in O(n), so its size follows the range of
+    sequence numbers that are open, not the highest one seen in the session.
+    """
+
+    def __init__(self):
+        # id -> tuple(seq, time)
+        self.entries = {}
+        self.tree = FenwickTree()
+        self.base = 0  # sequence number before position 1 of the tree
+        self.next_seq = 1
+        # id of this client's request
+        self.active_request: Optional[str] = None
+
+    @property
+    def global_q_pos(self) -> int:
+        """ Length of the queue """
+        return len(self.entries)
+
+    @property
+    def local_q_pos(self) -> Optional[int]:
+        """ Position of this client's request (1 is first in line), None if there is no active request """
+        return None if self.active_request is None else self.position(self.active_request)
+
+    def position(self, req_id: str) -> Optional[int]:
+        """ Position of a request in the queue, None if it isn't queued """
+        entry = self.entries.get(req_id)
+        if entry is None:
+            return None
+        return self.tree.prefix_sum(entry[0] - self.base)
+
+    def clear(self):
+        """ Forget all requests, e.g. before loading a snapshot of the queue """
+        self.entries = {}
+        self.tree = FenwickTree()
+        self.base = 0
+        self.next_seq = 1
+        self.active_request = None
+
+    def print_queue_positions(self):
+        print(f"Local: {self.local_q_pos}, Global: {self.global_q_pos}")
+
+    def on_cancel(self, req_id: str):
+        entry = self.entries.pop(req_id, None)
+        if entry is None:
+            return
+        self.tree.add(entry[0] - self.base, -1)
+        if req_id == self.active_request:
+            self.active_request = None
+
+    def on_resolve(self, req_id: str):
+        self.on_cancel(req_id)
+
+    def on_add(self, req_id: str, time: datetime.datetime, is_mine: bool, seq: Optional[int] = None):
+        """
+        :param seq: position key of the request. Defaults to arrival order
+        """
+        if req_id in self.entries:
+            return
+        if seq is None:
+            seq = self.next_seq
+        self.next_seq = max(self.next_seq, seq + 1)
+        self.entries[req_id] = (seq, time)
+        if not 1 <= seq - self.base <= self.tree.size:
+            self._reindex()
+        else:
+            self.tree.add(seq - self.base, 1)
+        if is_mine:
+            self.active_request = req_id
+
+    def _reindex(self):
+        """ Build the tree again over the open requests, with room for as many newer ones as their range """
+        seqs = [seq for seq, _time in self.entries.values()]
+        self.base = min(seqs) - 1
+        size = 1024
+        while size < 2 * (max(seqs) - self.base):
+            size *= 2
+        values = [0] * (size + 1)
+        for seq in seqs:
+            values[seq - self.base] += 1
+        self.tree = FenwickTree.from_values(values)
+
+
+if __name__ == "__main__":
+    # ==== BENCHMARK QUEUE MANAGER ====
+    from time import perf_counter
+
+    n = 100_000
+    qm = QueueManager()
+    ids = [f"req{i}" for i in range(n)]
+    now = datetime.datetime.now()
+
+    start = perf_counter()
+    for i, req_id in enumerate(ids):
+        qm.on_add(req_id, now, i == n // 2)
+    print(f"{n} adds: {perf_counter() - start:.3f}s")
+
+    start = perf_counter()
+    for req_id in ids:
+        qm.position(req_id)
+    print(f"{n} position queries: {perf_counter() - start:.3f}s")
+
+    start = perf_counter()
+    for req_id in ids[:n // 2:2]:
+        qm.on_cancel(req_id)
+    print(f"{n // 4} cancels: {perf_counter() - start:.3f}s")
+
+    assert qm.global_q_pos == n - n // 4
+    assert qm.local_q_pos == n // 4 + 1, qm.local_q_pos
+    qm.print_queue_positions()
+
+    # a long session: the tree follows the open requests, not the highest sequence number
+    qm = QueueManager()
+    for seq in range(1, 1_000_001):
+        qm.on_add(f"req{seq}", now, seq == 999_990, seq=seq)
+        if seq > 20:
+            qm.on_cancel(f"req{seq - 20}")
+    assert qm.global_q_pos == 20 and qm.local_q_pos == 10 and qm.tree.size <= 1024, qm.tree.size
+    qm.on_add("late", now, False, seq=500)  # an add that arrives long after its sequence number
+    assert qm.local_q_pos == 11 and qm.position("late") == 1
+    tree = FenwickTree.from_values([0, 3, 0, 1, 4, 0])
+    tree.add(9, 2)
+    assert tree.values()[1:10] == [3, 0, 1, 4, 0, 0, 0, 0, 2] and tree.prefix_sum(9) == 10
+    print("OK")
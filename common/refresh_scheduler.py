@@ -0,0 +1,57 @@
+from threading import Lock
+
+
+class RefreshScheduler:
+    """
+    Coalesces redraw requests into at most one redraw per frame, run on the Tk main thread.
+    State machine callbacks run on the stmpy driver thread, so instead of calling show_scene() they mark a scene
+    dirty (invalidate) or ask to switch scene (navigate). Every `interval_ms` the main thread redraws once if needed.
+    """
+
+    def __init__(self, app, show_scene, get_current_scene, interval_ms: int = 50):
+        self.app = app
+        self.show_scene = show_scene
+        self.get_current_scene = get_current_scene
+        self.interval_ms = interval_ms
+        self._lock = Lock()
+        self._dirty_scenes = set()
+        self._navigate_to = None
+        # counters
+        self.invalidations = 0
+        self.redraws = 0
+
+    @property
+    def redraws_saved(self) -> int:
+        return self.invalidations - self.redraws
+
+    def start(self):
+        """ Must be called from the main thread, before app.go() """
+        self.app.after(self.interval_ms, self._tick)
+
+    def invalidate(self, scene):
+        """ Redraw `scene` on the next frame, if it is still the current scene by then """
+        with self._lock:
+            self._dirty_scenes.add(scene)
+            self.invalidations += 1
+
+    def navigate(self, scene):
+        """ Switch to (and draw) `scene` on the next frame """
+        with self._lock:
+            self._navigate_to = scene
+            self.invalidations += 1
+
+    def _tick(self):
+        with self._lock:
+            navigate_to = self._navigate_to
+            dirty_scenes = self._dirty_scenes
+            self._navigate_to = None
+            self._dirty_scenes = set()
+        try:
+            if navigate_to is not None:
+                self.redraws += 1
+                self.show_scene(navigate_to)
+            elif self.get_current_scene() in dirty_scenes:
+                self.redraws += 1
+                self.show_scene(self.get_current_scene())
+        finally:
+            self.app.after(self.interval_ms, self._tick)
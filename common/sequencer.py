@@ -0,0 +1,178 @@
+from threading import RLock
+
+from common.clock import get_clock
+
+
+class EventSequencer:
+    """
+    Applies sequence-numbered events strictly in order.
+    Events that arrive early are held in a reorder buffer until the missing ones arrive. When a gap opens a timer is
+    armed; if the gap is not filled within `max_wait` seconds, or `window` events are waiting, request_resync(first,
+    last) is called with the missing range, and again every `max_wait` seconds while it stays open. When `max_buffer`
+    events are waiting, the buffer is dropped and request_resync(0, 0) asks for a snapshot instead.
+    A snapshot (reset) skips everything up to its sequence number.
+    Events and snapshots carry the epoch of the queue server, the time it started. A newer epoch means the server
+    restarted and may number its events from 1 again, so the sequencer starts over and calls on_restart(); events
+    of an older epoch are ignored, see accept_epoch().
+    offer() and reset() are meant to be called from the single dispatcher worker; a lock keeps them consistent with
+    the gap timer, which runs on the clock's timer thread.
+    """
+
+    def __init__(self, apply, request_resync, window: int = 32, max_wait: float = 1.0, max_buffer: int = 256,
+                 on_restart=None):
+        self.apply = apply
+        self.request_resync = request_resync
+        self.on_restart = on_restart
+        self.window = window
+        self.max_wait = max_wait
+        self.max_buffer = max_buffer
+        self.clock = get_clock()
+        self.last_seq = 0  # sequence number of the last applied event
+        self.epoch = None  # epoch of the queue server the events come from
+        self.buffer = {}  # seq -> event
+        self._lock = RLock()
+        self._gap_timer = None  # id of the timer armed for the current gap, None if there is no gap
+        self._timers = 0
+        self._gap_requested = False
+        # counters
+        self.applied = 0
+        self.duplicates = 0
+        self.resyncs = 0
+        self.snapshot_requests = 0
+        self.restarts = 0
+        self.max_buffered = 0
+
+    def accept_epoch(self, epoch) -> bool:
+        """ False if a message is from an older run of the queue server. Messages without an epoch are accepted """
+        with self._lock:
+            if epoch is None or epoch == self.epoch:
+                return True
+            if self.epoch is not None and epoch < self.epoch:
+                return False
+            if self.epoch is not None:  # the queue server restarted
+                self.restarts += 1
+                self.last_seq = 0
+                self.buffer.clear()
+                self._gap_timer = None
+                if self.on_restart is not None:
+                    self.on_restart()
+            self.epoch = epoch
+            return True
+
+    def offer(self, seq: int, event):
+        with self._lock:
+            if seq <= self.last_seq or seq in self.buffer:
+                self.duplicates += 1
+                return
+            if seq == self.last_seq + 1:
+                self._apply(seq, event)
+                self._drain()
+            else:
+                self.buffer[seq] = event
+                self.max_buffered = max(self.max_buffered, len(self.buffer))
+            self._check_gap()
+
+    def reset(self, seq: int):
+        """ Everything up to and including `seq` is known (e.g. from a snapshot), continue after it """
+        with self._lock:
+            if seq <= self.last_seq:
+                return
+            self.last_seq = seq
+            for buffered_seq in [s for s in self.buffer if s <= seq]:
+                del self.buffer[buffered_seq]
+            self._gap_timer = None
+            self._drain()
+            self._check_gap()
+
+    def stats(self) -> dict:
+        return {
+            "last_seq": self.last_seq,
+            "buffered": len(self.buffer),
+            "max_buffered": self.max_buffered,
+            "applied": self.applied,
+            "duplicates": self.duplicates,
+            "resyncs": self.resyncs,
+            "snapshot_requests": self.snapshot_requests,
+            "restarts": self.restarts,
+        }
+
+    def _apply(self, seq: int, event):
+        self.last_seq = seq
+        self.applied += 1
+        self._gap_timer = None  # a gap that is left after this is a new one
+        self.apply(event)
+
+    def _drain(self):
+        while self.last_seq + 1 in self.buffer:
+            self._apply(self.last_seq + 1, self.buffer.pop(self.last_seq + 1))
+
+    def _check_gap(self):
+        if len(self.buffer) == 0:
+            self._gap_timer = None
+            return
+        if len(self.buffer) >= self.max_buffer:  # too far behind to catch up event by event
+            self.buffer.clear()
+            self._gap_timer = None
+            self.snapshot_requests += 1
+            self.request_resync(0, 0)
+            return
+        if self._gap_timer is None:
+            self._gap_requested = False
+            self._arm_gap_timer()
+        if len(self.buffer) >= self.window and not self._gap_requested:
+            self._request_gap()
+
+    def _arm_gap_timer(self):
+        self._timers += 1
+        timer = self._gap_timer = self._timers
+        self.clock.call_later(self.max_wait, lambda: self._gap_timeout(timer))
+
+    def _gap_timeout(self, timer: int):
+        with self._lock:
+            if timer != self._gap_timer:  # the gap was filled in the meantime
+                return
+            self._request_gap()
+            self._arm_gap_timer()  # ask again if the range still hasn't arrived after max_wait
+
+    def _request_gap(self):
+        self.resyncs += 1
+        self._gap_requested = True
+        self.request_resync(self.last_seq + 1, min(self.buffer) - 1)
+
+
+if __name__ == "__main__":
+    # ==== SEQUENCER TEST: a gap re-requested by the timer alone, and a capped buffer ====
+    from common.clock import VirtualClock, set_clock
+
+    clock = VirtualClock()
+    set_clock(clock)
+    applied, requests = [], []
+    sequencer = EventSequencer(applied.append, lambda first, last: requests.append((first, last)),
+                               window=4, max_wait=1.0, max_buffer=8)
+    sequencer.offer(1, "a")
+    sequencer.offer(3, "c")  # 2 is lost, and nothing arrives after 3
+    clock.advance(0.9)
+    assert requests == []
+    clock.advance(0.2)
+    assert requests == [(2, 2)]
+    clock.advance(1.0)
+    assert requests == [(2, 2), (2, 2)]
+    sequencer.offer(2, "b")
+    clock.advance(5.0)
+    assert applied == ["a", "b", "c"] and requests == [(2, 2), (2, 2)]
+
+    for seq in range(5, 13):  # 4 is lost
+        sequencer.offer(seq, seq)
+    assert len(sequencer.buffer) == 0 and requests[-1] == (0, 0) and sequencer.snapshot_requests == 1
+    sequencer.reset(20)
+    sequencer.offer(21, "after snapshot")
+    assert applied[-1] == "after snapshot" and sequencer.stats()["buffered"] == 0
+
+    restarted = []
+    sequencer.on_restart = lambda: restarted.append(sequencer.last_seq)
+    assert sequencer.accept_epoch(100) and sequencer.accept_epoch(100) and restarted == []
+    assert sequencer.accept_epoch(200) and restarted == [0]  # the server restarted and numbers from 1 again
+    sequencer.offer(1, "new server")
+    assert not sequencer.accept_epoch(100) and applied[-1] == "new server" and sequencer.last_seq == 1
+    print(sequencer.stats())
+    print("OK")
@@ -0,0 +1,326 @@
+import atexit
+import os
+import sqlite3
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+
+from common.clock import get_clock
+from common.feedback import Feedback
+from common.group import Group
+from common.logger import get_logger
+from common.module import Module
+
+# KOMSYS_DB=<path> keeps help requests, claims, feedback and the modules and groups in a SQLite database, so
+# restarting the queue server or a client doesn't lose the session. Several processes can share one file.
+DB_PATH = os.environ.get("KOMSYS_DB")
+
+log = get_logger("storage")
+
+# help request status, the transitions are kept in request_events
+STATUS_OPEN = "open"
+STATUS_CLAIMED = "claimed"
+STATUS_CANCELLED = "cancelled"
+STATUS_RESOLVED = "resolved"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS modules (
+    number INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    task_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS groups (
+    number INTEGER PRIMARY KEY,
+    table_number INTEGER NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS help_requests (
+    id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    group_number INTEGER NOT NULL,
+    module_number INTEGER NOT NULL,
+    task_idx INTEGER NOT NULL,
+    is_online INTEGER NOT NULL,
+    zoom_url TEXT NOT NULL,
+    comment TEXT NOT NULL,
+    time_ns INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    claimed_by TEXT NOT NULL DEFAULT '',
+    updated_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS help_requests_open ON help_requests (status, module_number, seq);
+CREATE INDEX IF NOT EXISTS help_requests_group ON help_requests (group_number, time_ns);
+CREATE TABLE IF NOT EXISTS request_events (
+    seq INTEGER PRIMARY KEY,
+    request_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    actor TEXT NOT NULL DEFAULT '',
+    time_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS request_events_request ON request_events (request_id, seq);
+CREATE TABLE IF NOT EXISTS feedback (
+    group_number INTEGER NOT NULL,
+    module_number INTEGER NOT NULL,
+    task_number INTEGER NOT NULL,
+    difficulty TEXT NOT NULL,
+    comment TEXT NOT NULL,
+    time_ns INTEGER NOT NULL,
+    PRIMARY KEY (module_number, task_number, group_number)
+);
+CREATE INDEX IF NOT EXISTS feedback_group ON feedback (group_number, time_ns);
+"""
+
+# statements, compiled once per connection by sqlite3's statement cache
+INSERT_REQUEST = "INSERT OR IGNORE INTO help_requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '', ?)"
+UPDATE_REQUEST = "UPDATE help_requests SET status = ?, claimed_by = ?, updated_ns = ? WHERE id = ?"
+INSERT_EVENT = "INSERT OR REPLACE INTO request_events VALUES (?, ?, ?, ?, ?)"
+UPSERT_FEEDBACK = "INSERT OR REPLACE INTO feedback VALUES (?, ?, ?, ?, ?, ?)"
+SELECT_OPEN_REQUESTS = "SELECT * FROM help_requests WHERE status IN ('open', 'claimed') ORDER BY seq"
+SELECT_OPEN_REQUESTS_BY_MODULE = "SELECT * FROM help_requests WHERE status IN ('open', 'claimed') " \
+                                 "AND module_number = ? ORDER BY seq"
+SELECT_FEEDBACK = "SELECT * FROM feedback ORDER BY time_ns"
+SELECT_FEEDBACK_FOR_TASK = "SELECT * FROM feedback WHERE module_number = ? AND task_number = ? ORDER BY time_ns"
+SELECT_FEEDBACK_FOR_GROUP = "SELECT * FROM feedback WHERE group_number = ? ORDER BY time_ns"
+SELECT_GROUP_HISTORY = "SELECT e.time_ns, e.request_id, r.module_number, r.task_idx, e.status, e.actor " \
+                       "FROM help_requests r JOIN request_events e ON e.request_id = r.id " \
+                       "WHERE r.group_number = ? ORDER BY e.seq"
+SELECT_LAST_SEQ = "SELECT MAX(seq) FROM request_events"
+
+
+def _connect(path: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, timeout=5.0, check_same_thread=check_same_thread, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")  # readers don't block the writer, and the other way round
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class SqliteStore:
+    """
+    SQLite storage for help requests and their status changes, feedback, and the modules and groups.
+    Writes are queued and applied by a background thread, one transaction per batch: the first write waits
+    `batch_interval` seconds for more to arrive, so a burst of queue events costs one commit, and the message
+    threads never wait for the disk. A write the database refuses is logged and dropped on its own, see _execute().
+    Queries run on the calling thread and see every write queued before them.
+    """
+
+    def __init__(self, path: str, batch_interval: float = 0.05):
+        self.path = path
+        self.batch_interval = batch_interval
+        self.clock = get_clock()
+        connection = _connect(path)
+        connection.executescript(SCHEMA)
+        connection.close()
+        self._reader = _connect(path, check_same_thread=False)
+        self._reader_lock = Lock()
+        self._pending = deque()  # (sql, params) or (sql, [params, ...]) for executemany
+        self._writing = False
+        self._condition = Condition()
+        # counters
+        self.writes = 0
+        self.transactions = 0
+        self.dropped = 0  # rows the database refused, see _execute()
+        Thread(target=self._run, daemon=True).start()
+
+    # ======== writes ========
+    def record_request(self, seq: int, request: dict):
+        """ A help request was added to the queue, `request` is the body of the add-help-request message """
+        now = self.clock.time_ns()
+        time_ns = request.get("time")
+        self._put(INSERT_REQUEST, (request["id"], seq, request["group_number"], request["module_number"],
+                                   request["task_idx"], int(bool(request["is_online"])), request["zoom_url"],
+                                   request["comment"], time_ns if isinstance(time_ns, int) else now,
+                                   STATUS_OPEN, now))
+        self._put(INSERT_EVENT, (seq, request["id"], STATUS_OPEN, "", now))
+
+    def record_status(self, seq: int, request_id: str, status: str, actor: str = "", claimed_by: str = ""):
+        """ A help request was claimed, unclaimed (STATUS_OPEN), cancelled or resolved """
+        now = self.clock.time_ns()
+        self._put(UPDATE_REQUEST, (status, claimed_by, now, request_id))
+        self._put(INSERT_EVENT, (seq, request_id, status, actor, now))
+
+    def record_feedback(self, feedback: Feedback):
+        self._put(UPSERT_FEEDBACK, (feedback.group_number, feedback.module_number, feedback.task_number,
+                                    feedback.difficulty, feedback.comment, self.clock.time_ns()))
+
+    def save_modules(self, modules: list):
+        self._put("DELETE FROM modules", ())
+        self._put("INSERT INTO modules VALUES (?, ?, ?)", [(m.number, m.name, m.task_count) for m in modules])
+
+    def save_groups(self, groups: list):
+        self._put("DELETE FROM groups", ())
+        self._put("INSERT INTO groups VALUES (?, ?)", [(g.number, g.table) for g in groups])
+
+    # ======== queries ========
+    def open_requests(self, module_number: int = None) -> list:
+        """ Help requests that are still in the queue, in queue order, optionally only those for a module """
+        if module_number is None:
+            return self._query(SELECT_OPEN_REQUESTS)
+        return self._query(SELECT_OPEN_REQUESTS_BY_MODULE, (module_number,))
+
+    def last_seq(self) -> int:
+        return self._query(SELECT_LAST_SEQ)[0][0] or 0
+
+    def feedback(self, module_number: int = None, task_number: int = None) -> list:
+        """ Feedback for a task, or all feedback, oldest first """
+        if module_number is None:
+            rows = self._query(SELECT_FEEDBACK)
+        else:
+            rows = self._query(SELECT_FEEDBACK_FOR_TASK, (module_number, task_number))
+        return [_feedback(row) for row in rows]
+
+    def timed_feedback(self) -> list:
+        """ [(Feedback, time_ns)] of all feedback, oldest first """
+        return [(_feedback(row), row["time_ns"]) for row in self._query(SELECT_FEEDBACK)]
+
+    def group_feedback(self, group_number: int) -> list:
+        return [_feedback(row) for row in self._query(SELECT_FEEDBACK_FOR_GROUP, (group_number,))]
+
+    def group_history(self, group_number: int) -> list:
+        """ Every status change of the group's help requests: rows of time_ns, request_id, module_number, task_idx,
+        status and actor, in order """
+        return self._query(SELECT_GROUP_HISTORY, (group_number,))
+
+    def modules(self) -> list:
+        return [Module(row["number"], row["name"], row["task_count"])
+                for row in self._query("SELECT * FROM modules ORDER BY number")]
+
+    def groups(self) -> list:
+        return [Group(row["number"], row["table_number"]) for row in self._query("SELECT * FROM groups ORDER BY number")]
+
+    # ======== writer ========
+    def flush(self, timeout: float = 5.0):
+        """ Wait until everything queued so far is committed """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while (self._pending or self._writing) and time.monotonic() < deadline:
+                self._condition.wait(0.01)
+
+    def _put(self, sql: str, params):
+        with self._condition:
+            self._pending.append((sql, params))
+            self._condition.notify_all()
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        self.flush()
+        with self._reader_lock:
+            return self._reader.execute(sql, params).fetchall()
+
+    def _run(self):
+        connection = _connect(self.path)
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._writing = False
+                    self._condition.notify_all()
+                    self._condition.wait()
+                self._writing = True
+            time.sleep(self.batch_interval)  # let the rest of the burst arrive
+            with self._condition:
+                batch = list(self._pending)
+                self._pending.clear()
+            try:
+                connection.execute("BEGIN")
+                for sql, params in batch:
+                    self.dropped += self._execute(connection, sql, params)
+                connection.execute("COMMIT")
+                self.writes += len(batch)
+                self.transactions += 1
+            except Exception as e:  # e.g. a locked or full disk: this batch is lost, the writer keeps running
+                try:
+                    if connection.in_transaction:
+                        connection.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+                log.error("Could not write to the database", path=self.path, error=e, writes=len(batch))
+
+    def _execute(self, connection: sqlite3.Connection, sql: str, params) -> int:
+        """
+        Run one queued write in a savepoint, so a row the database refuses is dropped without the rest of the batch.
+        A failed executemany() is retried row by row. Returns the number of rows dropped.
+        """
+        many = isinstance(params, list)
+        connection.execute("SAVEPOINT write")
+        try:
+            if many:
+                connection.executemany(sql, params)
+            else:
+                connection.execute(sql, params)
+            connection.execute("RELEASE write")
+            return 0
+        except Exception as e:  # e.g. OverflowError for a number too large for SQLite
+            connection.execute("ROLLBACK TO write")
+            connection.execute("RELEASE write")
+            if many and len(params) > 1:
+                return sum(self._execute(connection, sql, row) for row in params)
+            log.error("Dropped a write the database refused", path=self.path, sql=sql, params=params, error=e)
+            return 1
+
+
+def _feedback(row) -> Feedback:
+    return Feedback(row["group_number"], row["module_number"], row["task_number"], row["comment"], row["difficulty"])
+
+
+_store = None
+
+
+def get_store():
+    """ The store configured with KOMSYS_DB, or None if there is none """
+    global _store
+    if _store is None and DB_PATH:
+        _store = SqliteStore(DB_PATH)
+        atexit.register(_store.flush)
+    return _store
+
+
+if __name__ == "__main__":
+    # ==== STORAGE TEST: request lifecycle, feedback, and 50,000 requests written in batches ====
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), "komsys.db")
+    store = SqliteStore(path)
+
+    def request(i: int) -> dict:
+        return {"id": f"r{i}", "group_number": i % 150 + 1, "module_number": i % 9 + 1, "task_idx": i % 4,
+                "is_online": False, "zoom_url": "", "comment": "help", "time": i}
+
+    store.record_request(1, request(1))
+    store.record_request(2, request(2))
+    store.record_status(3, "r1", STATUS_CLAIMED, actor="ta1", claimed_by="ta1")
+    store.record_status(4, "r2", STATUS_CANCELLED, actor="student")
+    store.record_feedback(Feedback(2, 2, 1, "tricky", "Hard"))
+    store.record_feedback(Feedback(2, 2, 1, "fine after all", "Easy"))
+    store.save_groups([Group(1, 3), Group(2, 1)])
+    assert [(row["id"], row["claimed_by"]) for row in store.open_requests()] == [("r1", "ta1")]
+    assert len(store.open_requests(module_number=2)) == 1 and store.open_requests(module_number=3) == []
+    assert store.last_seq() == 4
+    assert [(f.difficulty, f.comment) for f in store.feedback(2, 1)] == [("Easy", "fine after all")]
+    assert [row["status"] for row in store.group_history(3)] == [STATUS_OPEN, STATUS_CANCELLED]
+    assert store.groups()[0].table == 3
+
+    # a row the database refuses is dropped alone, and the writer keeps going
+    store.save_groups([Group(1, 3), Group(10 ** 20, 4), Group(2, 1)])
+    store.record_feedback(Feedback(3, 2, 1, "", "Medium"))
+    started = time.perf_counter()
+    assert [group.number for group in store.groups()] == [1, 2] and store.dropped == 1
+    assert len(store.feedback(2, 1)) == 2 and time.perf_counter() - started < 1
+
+    reopened = SqliteStore(path)  # e.g. after a restart
+    assert [row["id"] for row in reopened.open_requests()] == ["r1"] and reopened.last_seq() == 4
+
+    n = 50_000
+    transactions = store.transactions
+    started = time.perf_counter()
+    for i in range(3, n + 3):
+        store.record_request(i * 2, request(i))
+        store.record_status(i * 2 + 1, f"r{i}", STATUS_RESOLVED if i % 10 else STATUS_OPEN, actor="ta1")
+    queued = time.perf_counter() - started
+    store.flush(60)
+    print(f"{n} requests and status changes queued in {queued:.3f}s, written in "
+          f"{time.perf_counter() - started:.3f}s and {store.transactions - transactions} transactions")
+    started = time.perf_counter()
+    open_requests = store.open_requests(module_number=5)
+    history = store.group_history(42)
+    print(f"{len(open_requests)} open requests for module 5 and {len(history)} events for group 42 "
+          f"queried in {(time.perf_counter() - started) * 1000:.1f}ms")
+    assert len(open_requests) == len([i for i in range(3, n + 3) if i % 10 == 0 and i % 9 + 1 == 5])
+    print("OK")
@@ -0,0 +1,383 @@
+import socketserver
+import struct
+from abc import ABC, abstractmethod
+from threading import Thread, Lock
+
+from common.logger import get_logger
+from common.mqtt_utils import BROKER, PORT
+
+log = get_logger("transport")
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """ MQTT topic matching, with the + (one level) and # (all remaining levels) wildcards """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class Transport(ABC):
+    """
+    What the clients and the queue server need from MQTT.
+    on_message(topic, payload) is called for every message on a subscribed topic, once start() was called.
+    """
+
+    def __init__(self):
+        self.on_message = None
+
+    @abstractmethod
+    def connect(self):
+        pass
+
+    @abstractmethod
+    def subscribe(self, topic: str):
+        pass
+
+    @abstractmethod
+    def publish(self, topic: str, payload=None, retain: bool = False) -> bool:
+        pass
+
+    @abstractmethod
+    def start(self):
+        """ Start delivering messages, on a background thread """
+
+    @abstractmethod
+    def disconnect(self):
+        pass
+
+
+class PahoTransport(Transport):
+    """ A real MQTT connection, using paho """
+
+    def __init__(self, host: str = BROKER, port: int = PORT):
+        super().__init__()
+        import paho.mqtt.client as mqtt
+        self.host = host
+        self.port = port
+        self.client = mqtt.Client()
+        self.client.on_connect = lambda client, userdata, flags, rc: log.info(mqtt.connack_string(rc), host=host)
+        self.client.on_message = lambda client, userdata, msg: self.on_message(msg.topic, msg.payload)
+
+    def connect(self):
+        log.info("Connecting", host=self.host, port=self.port)
+        self.client.connect(self.host, self.port)
+
+    def subscribe(self, topic: str):
+        self.client.subscribe(topic)
+
+    def publish(self, topic: str, payload=None, retain: bool = False) -> bool:
+        try:
+            return self.client.publish(topic, payload=payload, retain=retain).is_published()
+        except RuntimeError as e:  # not connected
+            log.warning("Could not publish", topic=topic, error=e)
+            return False
+
+    def start(self):
+        try:
+            thread = Thread(target=self.client.loop_forever)
+            thread.start()
+        except KeyboardInterrupt:
+            self.client.disconnect()
+
+    def disconnect(self):
+        self.client.disconnect()
+
+
+class LoopbackBus:
+    """
+    In-process stand-in for the broker. Messages are delivered by direct calls on the publishing thread,
+    so any number of clients can talk to each other at memory speed, without a network.
+    """
+
+    def __init__(self):
+        self.subscriptions = []  # (topic filter, LoopbackTransport)
+        self.retained = {}  # topic -> payload
+        self.published = 0
+        self._receivers = {}  # topic -> the transports subscribed to it, until the subscriptions change
+        self._lock = Lock()
+
+    def subscribe(self, transport, topic_filter: str):
+        with self._lock:
+            self.subscriptions.append((topic_filter, transport))
+            self._receivers = {}
+            retained = [(topic, payload) for topic, payload in self.retained.items()
+                        if topic_matches(topic_filter, topic)]
+        for topic, payload in retained:
+            transport.deliver(topic, payload)
+
+    def unsubscribe_all(self, transport):
+        with self._lock:
+            self.subscriptions = [(f, t) for f, t in self.subscriptions if t is not transport]
+            self._receivers = {}
+
+    def publish(self, topic: str, payload, retain: bool):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:  # an empty retained message clears the retained message
+                    self.retained.pop(topic, None)
+            receivers = self._receivers.get(topic)
+            if receivers is None:
+                receivers = self._receivers[topic] = list({id(t): t for f, t in self.subscriptions
+                                                           if topic_matches(f, topic)}.values())
+        for transport in receivers:
+            transport.deliver(topic, payload)
+
+
+class LoopbackTransport(Transport):
+    """ A client of a LoopbackBus. Messages arriving before start() are held back, like paho does """
+
+    def __init__(self, bus: LoopbackBus):
+        super().__init__()
+        self.bus = bus
+        self.started = False
+        self._pending = []
+        self._lock = Lock()
+
+    def connect(self):
+        pass
+
+    def subscribe(self, topic: str):
+        self.bus.subscribe(self, topic)
+
+    def publish(self, topic: str, payload=None, retain: bool = False) -> bool:
+        self.bus.publish(topic, payload, retain)
+        return True
+
+    def start(self):
+        with self._lock:
+            self.started = True
+            pending = self._pending
+            self._pending = []
+        for topic, payload in pending:
+            self.on_message(topic, payload)
+
+    def disconnect(self):
+        self.bus.unsubscribe_all(self)
+
+    def deliver(self, topic: str, payload: bytes):
+        with self._lock:
+            if not self.started:
+                self._pending.append((topic, payload))
+                return
+        self.on_message(topic, payload)
+
+
+# MQTT 3.1.1 control packet types
+_CONNECT, _CONNACK, _PUBLISH, _PUBACK, _PUBREC, _PUBREL, _PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+_SUBSCRIBE, _SUBACK, _UNSUBSCRIBE, _UNSUBACK, _PINGREQ, _PINGRESP, _DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def _encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length > 0 else byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+
+def _publish_packet(topic: str, payload: bytes, retain: bool) -> bytes:
+    topic_bytes = topic.encode()
+    return _packet(_PUBLISH, 1 if retain else 0, struct.pack("!H", len(topic_bytes)) + topic_bytes + payload)
+
+
+class _BrokerConnection(socketserver.StreamRequestHandler):
+    """ One client connection of the LocalBroker """
+
+    def setup(self):
+        super().setup()
+        self.send_lock = Lock()
+        self.subscriptions = set()
+
+    def send(self, data: bytes):
+        with self.send_lock:
+            try:
+                self.wfile.write(data)
+            except OSError:
+                pass
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            while True:
+                header = self.rfile.read(1)
+                if not header:
+                    return
+                length, multiplier = 0, 1
+                while True:
+                    byte = self.rfile.read(1)
+                    if not byte:
+                        return
+                    length += (byte[0] & 0x7F) * multiplier
+                    multiplier *= 128
+                    if byte[0] & 0x80 == 0:
+                        break
+                body = self.rfile.read(length)
+                if len(body) < length:
+                    return
+                if not self.handle_packet(broker, header[0] >> 4, header[0] & 0x0F, body):
+                    return
+        finally:
+            broker.remove_connection(self)
+
+    def handle_packet(self, broker, packet_type: int, flags: int, body: bytes) -> bool:
+        if packet_type == _CONNECT:
+            self.send(_packet(_CONNACK, 0, b"\x00\x00"))
+        elif packet_type == _PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic_length = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2 + topic_length].decode()
+            offset = 2 + topic_length
+            if qos > 0:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self.send(_packet(_PUBACK if qos == 1 else _PUBREC, 0, packet_id))
+            broker.publish(topic, body[offset:], bool(flags & 0x01))
+        elif packet_type == _PUBREL:
+            self.send(_packet(_PUBCOMP, 0, body[:2]))
+        elif packet_type == _SUBSCRIBE:
+            packet_id, offset, topic_filters = body[:2], 2, []
+            while offset < len(body):
+                filter_length = struct.unpack("!H", body[offset:offset + 2])[0]
+                topic_filters.append(body[offset + 2:offset + 2 + filter_length].decode())
+                offset += 2 + filter_length + 1  # requested QoS is ignored, everything is delivered with QoS 0
+            self.send(_packet(_SUBACK, 0, packet_id + b"\x00" * len(topic_filters)))
+            for topic_filter in topic_filters:
+                broker.subscribe(self, topic_filter)
+        elif packet_type == _UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                filter_length = struct.unpack("!H", body[offset:offset + 2])[0]
+                self.subscriptions.discard(body[offset + 2:offset + 2 + filter_length].decode())
+                offset += 2 + filter_length
+            self.send(_packet(_UNSUBACK, 0, body[:2]))
+        elif packet_type == _PINGREQ:
+            self.send(_packet(_PINGRESP, 0, b""))
+        elif packet_type == _DISCONNECT:
+            return False
+        return True
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LocalBroker:
+    """
+    Minimal MQTT 3.1.1 broker on a local port, for tests with several processes.
+    Supports wildcards and retained messages; everything is delivered with QoS 0. No authentication, no sessions.
+    Port 0 picks a free port, see `port` after start().
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = PORT):
+        self.host = host
+        self.port = port
+        self.connections = set()
+        self.retained = {}
+        self.published = 0
+        self._lock = Lock()
+        self._server = None
+
+    def start(self):
+        self._server = _ThreadingServer((self.host, self.port), _BrokerConnection)
+        self._server.broker = self
+        self.port = self._server.server_address[1]
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        log.info("Local MQTT broker listening", host=self.host, port=self.port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def subscribe(self, connection: _BrokerConnection, topic_filter: str):
+        with self._lock:
+            self.connections.add(connection)
+            connection.subscriptions.add(topic_filter)
+            retained = [(topic, payload) for topic, payload in self.retained.items()
+                        if topic_matches(topic_filter, topic)]
+        for topic, payload in retained:
+            connection.send(_publish_packet(topic, payload, True))
+
+    def remove_connection(self, connection: _BrokerConnection):
+        with self._lock:
+            self.connections.discard(connection)
+
+    def publish(self, topic: str, payload: bytes, retain: bool):
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            receivers = [c for c in self.connections if any(topic_matches(f, topic) for f in c.subscriptions)]
+        packet = _publish_packet(topic, payload, False)
+        for connection in receivers:
+            connection.send(packet)
+
+
+if __name__ == "__main__":
+    # ==== TRANSPORT TEST: wildcards and retained messages, over the loopback bus and the local broker ====
+    import time
+    from threading import Event
+
+    def check(make_transport, name):
+        received = []
+        done = Event()
+        publisher = make_transport()
+        publisher.on_message = lambda topic, payload: None
+        publisher.connect()
+        publisher.publish("test/retained", "before", retain=True)
+        subscriber = make_transport()
+
+        def on_message(topic, payload):
+            received.append((topic, payload))
+            if topic == "test/end":
+                done.set()
+        subscriber.on_message = on_message
+        subscriber.connect()
+        subscriber.subscribe("test/+")
+        subscriber.subscribe("other/#")
+        subscriber.start()
+        publisher.start()
+        time.sleep(0.2)
+        n = 10_000
+        start = time.perf_counter()
+        for i in range(n):
+            publisher.publish("other/a/b", str(i))
+        publisher.publish("ignored/x", "x")
+        publisher.publish("test/end", "")
+        done.wait(10)
+        elapsed = time.perf_counter() - start
+        publisher.disconnect()
+        subscriber.disconnect()
+        assert received[0] == ("test/retained", b"before"), received[:1]
+        assert [payload for topic, payload in received[1:-1]] == [str(i).encode() for i in range(n)]
+        assert received[-1][0] == "test/end"
+        print(f"{name}: {n} messages in {elapsed:.3f}s")
+
+    assert topic_matches("a/+/c", "a/b/c") and topic_matches("a/#", "a/b/c") and not topic_matches("a/+", "a/b/c")
+    bus = LoopbackBus()
+    check(lambda: LoopbackTransport(bus), "loopback")
+    broker = LocalBroker(port=0)
+    broker.start()
+    check(lambda: PahoTransport("127.0.0.1", broker.port), "local broker")
+    broker.stop()
+    print("OK")
@@ -0,0 +1,73 @@
+class SpacerFactory:
+    """
+    Names for the empty labels used to push elements into place. Names are reused after every full rebuild
+    instead of generating a new uuid for each spacer.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+
+    def reset(self):
+        """ Call after removeAllWidgets() """
+        self.count = 0
+
+    def add_whitespace(self, desired_row_count: int, current_row_count: int):
+        rows_to_add = desired_row_count - current_row_count
+        for _i in range(rows_to_add):
+            self.add_spacer(row=_i + current_row_count + 1)
+
+    def add_spacer(self, **kwargs):
+        self.count += 1
+        return self.app.addLabel(f"SPACER_{self.count}", text="", **kwargs)
+
+
+class KeyedRows:
+    """
+    Keeps a list of rendered rows in sync with a list of items, touching only the rows that changed.
+    The widget operations are supplied by the caller:
+        add(key, content, row), update(key, content), move(key, row), remove(key)
+    where content is any comparable value describing what the row shows.
+    """
+
+    def __init__(self, add, update, move, remove):
+        self._add = add
+        self._update = update
+        self._move = move
+        self._remove = remove
+        self.rendered = {}  # key -> (content, row)
+        # counters of widget operations, for profiling
+        self.added = 0
+        self.updated = 0
+        self.moved = 0
+        self.removed = 0
+
+    def clear(self):
+        """ Forget all rows, call after the widgets were removed some other way (e.g. removeAllWidgets) """
+        self.rendered = {}
+
+    def sync(self, items, first_row: int = 0):
+        """
+        :param items: ordered iterable of (key, content)
+        :param first_row: grid row of the first item
+        """
+        wanted = {}
+        for i, (key, content) in enumerate(items):
+            wanted[key] = (content, first_row + i)
+        for key in [key for key in self.rendered if key not in wanted]:
+            self._remove(key)
+            self.removed += 1
+            del self.rendered[key]
+        for key, (content, row) in wanted.items():
+            previous = self.rendered.get(key)
+            if previous is None:
+                self._add(key, content, row)
+                self.added += 1
+            else:
+                if previous[1] != row:
+                    self._move(key, row)
+                    self.moved += 1
+                if previous[0] != content:
+                    self._update(key, content)
+                    self.updated += 1
+        self.rendered = wanted
@@ -0,0 +1,512 @@
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import time
+from collections import deque
+from threading import Lock
+
+from stmpy import Machine
+
+os.environ.setdefault("KOMSYS_SILENT", "1")  # no notification sounds from the simulated TAs
+os.environ.setdefault("KOMSYS_LOG_LEVEL", "WARNING")  # the clients log every claim, see --verbose
+
+from code_student.main import MQTTClient as StudentClient
+from code_teaching_assistant.help_request_store import HelpRequestStore
+from code_teaching_assistant.main import MQTTClient as TAClient
+from code_teaching_assistant.stm_utils import get_stm_states, get_stm_transitions
+from common import metrics
+from common.clock import ClockDriver, SystemClock, VirtualClock, get_clock, set_clock
+from common.dispatcher import MessageDispatcher
+from common.feedback import Feedback
+from common.help_request import HelpRequest
+from common.catalog import get_catalog
+from common.logger import INFO, set_level
+from common.mqtt_utils import TOPIC_QUEUE, TOPIC_RESYNC, TOPIC_SNAPSHOT
+from common.transport import LoopbackBus, LoopbackTransport, LocalBroker, PahoTransport
+from server.main import QueueServer
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """ Nearest-rank percentile of an already sorted list """
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(1, math.ceil(p * len(sorted_values) / 100))  # p * n first, 0.07 * 100 is not exactly 7
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class LatencyRecorder:
+    """ Collects latencies (in seconds) by name, and summarises them in milliseconds """
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def summary(self, name: str) -> dict:
+        with self._lock:
+            values = sorted(self.samples.get(name, []))
+        return {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": (values[-1] if values else 0.0) * 1000,
+        }
+
+
+class SimStudent:
+    """
+    A student group, using the real student MQTT client. Stands in for the client's state machine: the client's
+    send(signal, args) calls end up in send() below, on the client's dispatcher thread.
+    """
+
+    def __init__(self, group_number: int, transport, load):
+        self.group_number = group_number
+        self.load = load
+        self.active_request = None
+        self.claimed_by = None
+        self._lock = Lock()
+        self.client = StudentClient(self, transport, dispatcher_workers=load.dispatcher_workers)
+
+    @property
+    def idle(self) -> bool:
+        return self.active_request is None
+
+    def request_help(self, now: float):
+        module = self.load.rng.choice(self.load.modules)
+        request = HelpRequest(self.group_number, module.number, self.load.rng.randrange(module.task_count),
+                              False, "", f"load test request from group {self.group_number}")
+        with self._lock:
+            self.active_request = request
+            self.claimed_by = None
+        if self.load.rng.random() < self.load.cancel_p:
+            self.load.schedule_cancel(now + self.load.rng.uniform(1, 10), self, request.id)
+        self.load.sent_at[request.id] = self.load.clock.monotonic()
+        self.load.count("requests")
+        self.client.request_help(request)
+
+    def cancel(self, request_id: str):
+        """ Give up on the request, unless it was claimed or resolved in the meantime """
+        with self._lock:
+            if self.active_request is None or self.active_request.id != request_id or self.claimed_by:
+                return
+            self.active_request = None
+        self.load.count("cancelled")
+        self.client.cancel_request(request_id)
+
+    def send(self, signal: str, args: list = None):
+        if signal == "sig_receive_request_claim":
+            request_id, ta = args
+            with self._lock:
+                if self.active_request is None or self.active_request.id != request_id or self.claimed_by:
+                    return
+                self.claimed_by = ta
+            if request_id in self.load.sent_at:
+                self.load.latencies.record("queue_wait", self.load.clock.monotonic() - self.load.sent_at[request_id])
+            self.client.confirm_claim(request_id, ta)
+        elif signal == "sig_receive_request_resolution":
+            with self._lock:
+                request = self.active_request
+                if request is None or request.id != args[0]:
+                    return
+                self.active_request = None
+            self.load.count("resolved")
+            if self.load.rng.random() < self.load.feedback_p:
+                difficulty = self.load.rng.choice(["Easy", "Medium", "Hard"])
+                self.client.send_feedback(Feedback(self.group_number, request.module_number, request.task_idx,
+                                                   "", difficulty))
+                self.load.count("feedback")
+        elif signal == "sig_cancel_claim":
+            with self._lock:
+                if self.active_request is not None and self.active_request.id == args[0]:
+                    self.claimed_by = None
+
+    def stop(self):
+        self.client.dispatcher.stop()
+        self.client.transport.disconnect()
+
+
+class SimTA:
+    """
+    A TA, using the real TA MQTT client, help request store and state machine (on a ClockDriver, so the claim
+    timeout follows the load generator's clock). Stands in for the user interface: the stm_* methods are the
+    state machine's actions, and step() presses the buttons.
+    """
+
+    def __init__(self, name: str, transport, load):
+        self.name = name
+        self.load = load
+        self.help_requests = HelpRequestStore()
+        self.active_help_request = None
+        self.helping_until = None
+        self.claim_started = 0.0
+        self.stm = Machine(name=f"stm_{name.replace(' ', '_')}", transitions=get_stm_transitions(), obj=self,
+                           states=get_stm_states())
+        self.driver = ClockDriver(load.clock)
+        self.driver.add_machine(self.stm)
+        self.client = TAClient(self, self.help_requests, transport, dispatcher_workers=load.dispatcher_workers)
+        self.client.logged_in_ta = name
+
+    def send(self, message_id: str, args: list = None, kwargs: dict = None):
+        """ The client sends its signals here, on their way to the state machine """
+        if message_id == "sig_acc_claim" and self.active_help_request is not None:
+            self.load.latencies.record("claim_handshake", self.load.clock.monotonic() - self.claim_started)
+        self.stm.send(message_id, args or [], kwargs or {})
+
+    def step(self, now: float):
+        state = self.stm.state
+        if state == "unclaimed" and self.active_help_request is None:
+            request = self.candidate()
+            if request is None:
+                return
+            self.help_requests.set_claimed_by(request.id, self.name)
+            self.active_help_request = request
+            self.claim_started = self.load.clock.monotonic()
+            # press the button before publishing: the student's answer may reach the state machine before a
+            # button pressed afterwards, and would be dropped in the unclaimed state
+            self.stm.send("claim_button")
+            if not self.client.claim_request(request, self.name):
+                self.stm.send("cancel_claim")
+        elif state == "claimed" and self.active_help_request is not None:
+            if self.helping_until is None:
+                self.helping_until = now + self.load.rng.expovariate(1 / self.load.help_time)
+            elif now >= self.helping_until:
+                self.helping_until = float("inf")  # until the state machine has handled the button
+                if self.load.rng.random() < self.load.unclaim_p:
+                    self.load.count("unclaimed")
+                    self.stm.send("cancel_claim")
+                else:
+                    self.stm.send("resolve_button")
+
+    def candidates(self) -> list:
+        """
+        The first three unclaimed requests. Requests another TA is claiming or has resolved are left out: the claim
+        isn't visible here until the student confirmed it, nor the resolution until the server removed the request,
+        and the simulated TAs are much quicker than real ones
+        """
+        claiming = self.load.claiming()
+        return [r for r in self.help_requests
+                if not r.claimed_by and r.id not in claiming and r.id not in self.load.resolved][:3]
+
+    def candidate(self):
+        candidates = self.candidates()
+        return self.load.rng.choice(candidates) if len(candidates) > 0 else None
+
+    def ready(self) -> bool:
+        """ True if step() has something to do right now: claim a request, or start helping """
+        if self.stm.state == "claimed":
+            return self.active_help_request is not None and self.helping_until is None
+        return self.stm.state == "unclaimed" and self.active_help_request is None and len(self.candidates()) > 0
+
+    # =========== STM-controlled methods =========== ""
+    def stm_log(self, text: str):
+        pass
+
+    def stm_rec_help_req(self, request: HelpRequest):
+        if self.help_requests.add(request) and request.id in self.load.sent_at:
+            self.load.latencies.record("request_to_ta", self.load.clock.monotonic() - self.load.sent_at[request.id])
+
+    def stm_rem_help_req(self, request_id: str):
+        self.help_requests.remove(request_id)
+
+    def stm_queue_snapshot(self, requests: list):
+        self.help_requests.sync(requests)
+
+    def stm_receive_feedback(self, feedback: Feedback):
+        pass
+
+    def stm_update_request(self):
+        pass
+
+    def stm_timer_expired(self):
+        self.load.count("claim_timeouts")
+        request = self.help_requests.get(self.active_help_request.id)
+        if request is not None and request.claimed_by == self.name:  # not if another TA got it in the meantime
+            self.help_requests.set_claimed_by(request.id, None)
+        self.active_help_request = None
+
+    def stm_request_resolved(self):
+        if self.active_help_request is None:
+            return
+        self.load.resolved.add(self.active_help_request.id)
+        self.client.resolve_request(self.active_help_request.id)
+        self.help_requests.remove(self.active_help_request.id)
+        self.active_help_request = None
+        self.helping_until = None
+
+    def stm_cancel_claim(self):
+        if self.active_help_request is None:
+            return
+        self.client.cancel_claim(self.active_help_request.id)
+        self.help_requests.set_claimed_by(self.active_help_request.id, None)
+        self.active_help_request = None
+        self.helping_until = None
+
+    def stop(self):
+        self.driver.stop()
+        self.client.dispatcher.stop()
+        self.client.notifier.stop()
+        self.client.transport.disconnect()
+
+
+class LoadGenerator:
+    """
+    Simulates a lab session: a queue server, `groups` student clients and `tas` TA clients on one transport.
+    Help requests arrive as a Poisson process with `rate` requests per second, or for the `spike` pattern, half
+    of the groups ask for help within the first `spike_window` seconds, followed by the Poisson process.
+    With `virtual`, the session runs on a VirtualClock: everything happens on the calling thread and the clock
+    jumps to the next thing that is due, so a session takes a fraction of its length and the same seed always
+    gives the same report.
+    """
+
+    def __init__(self, groups: int = 150, tas: int = 15, duration: float = 60.0, rate: float = 1.0,
+                 pattern: str = "poisson", spike_window: float = 5.0, help_time: float = 5.0,
+                 cancel_p: float = 0.1, unclaim_p: float = 0.05, feedback_p: float = 0.5,
+                 transport: str = "loopback", seed: int = 4115, virtual: bool = False, tick: float = 0.05):
+        if virtual and transport != "loopback":
+            raise ValueError("virtual time needs the loopback transport")
+        self.groups = groups
+        self.tas = tas
+        self.duration = duration
+        self.rate = rate
+        self.pattern = pattern
+        self.spike_window = spike_window
+        self.help_time = help_time
+        self.cancel_p = cancel_p
+        self.unclaim_p = unclaim_p
+        self.feedback_p = feedback_p
+        self.transport = transport
+        self.virtual = virtual
+        self.tick = tick  # in virtual time, how often the simulated users look at their screens
+        self.clock = VirtualClock() if virtual else SystemClock()
+        self.dispatcher_workers = 0 if virtual else 1
+        self.rng = random.Random(seed)
+        self.modules = list(get_catalog().modules) or [_DefaultModule()]
+        self.latencies = LatencyRecorder()
+        self.sent_at = {}  # request id -> clock.monotonic() when the student sent it
+        self.cancellations = []  # heap of (session time, seq, student, request id)
+        self.sim_tas = []
+        self.resolved = set()  # ids of the requests a TA resolved, still listed by the other TAs for a moment
+        self.counters = {}
+        self._counter_lock = Lock()
+        self._started = 0.0
+
+    def now(self) -> float:
+        """ Seconds since the session started """
+        return self.clock.monotonic() - self._started
+
+    def count(self, name: str):
+        with self._counter_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def claiming(self) -> set:
+        """ Ids of the requests the TAs are claiming or helping with """
+        return {ta.active_help_request.id for ta in self.sim_tas if ta.active_help_request is not None}
+
+    def schedule_cancel(self, at: float, student: SimStudent, request_id: str):
+        heapq.heappush(self.cancellations, (at, len(self.sent_at), student, request_id))
+
+    def arrivals(self) -> list:
+        times = []
+        if self.pattern == "spike":
+            times = sorted(self.rng.uniform(0, self.spike_window) for _i in range(self.groups // 2))
+        t = 0.0
+        while True:
+            t += self.rng.expovariate(self.rate)
+            if t >= self.duration:
+                return sorted(times)
+            times.append(t)
+
+    def run(self) -> dict:
+        previous_clock = get_clock()
+        set_clock(self.clock)  # before any client is created, they take the clock when they are created
+        metrics.set_enabled(not self.virtual)  # wall-clock timings of a virtual session mean nothing
+        try:
+            return self._run()
+        finally:
+            set_clock(previous_clock)
+            metrics.set_enabled(True)
+
+    def _run(self) -> dict:
+        broker, bus = None, None
+        if self.transport == "broker":
+            broker = LocalBroker(port=0)
+            broker.start()
+            make_transport = lambda: PahoTransport(broker.host, broker.port)  # noqa: E731
+        else:
+            bus = LoopbackBus()
+            make_transport = lambda: LoopbackTransport(bus)  # noqa: E731
+
+        server_transport = make_transport()
+        server = QueueServer(server_transport)
+        server_dispatcher = MessageDispatcher(server.handle_message, maxsize=10000, workers=self.dispatcher_workers)
+        server_transport.on_message = server_dispatcher.submit
+        server_transport.connect()
+        for topic in (TOPIC_SNAPSHOT, TOPIC_QUEUE, TOPIC_RESYNC):
+            server_transport.subscribe(topic)
+        server_transport.start()
+        students = [SimStudent(i + 1, make_transport(), self) for i in range(self.groups)]
+        tas = self.sim_tas = [SimTA(f"TA {i + 1}", make_transport(), self) for i in range(self.tas)]
+        dispatchers = [server_dispatcher] + [participant.client.dispatcher for participant in students + tas]
+        if not self.virtual:
+            for ta in tas:
+                ta.driver.start(keep_active=True)
+            time.sleep(0.5)  # let every client connect
+
+        arrivals = deque(self.arrivals())
+        wall_started = time.perf_counter()
+        self._started = self.clock.monotonic()
+        published_before = broker.published if broker is not None else bus.published
+        while self.now() < self.duration:
+            if self.virtual:
+                self.run_until_idle(dispatchers, tas)
+            now = self.now()
+            while len(arrivals) > 0 and arrivals[0] <= now:
+                arrivals.popleft()
+                idle = [s for s in students if s.idle]
+                if len(idle) == 0:
+                    self.count("skipped")
+                    continue
+                self.rng.choice(idle).request_help(now)
+            while len(self.cancellations) > 0 and self.cancellations[0][0] <= now:
+                _at, _seq, student, request_id = heapq.heappop(self.cancellations)
+                student.cancel(request_id)
+            for ta in tas:
+                ta.step(now)
+            if self.virtual:
+                self.run_until_idle(dispatchers, tas)
+                self.clock.advance_to(self._started + self.next_due(now, arrivals, tas))
+            else:
+                time.sleep(0.005)
+        elapsed = self.now()
+        wall = time.perf_counter() - wall_started
+        published = (broker.published if broker is not None else bus.published) - published_before
+
+        server_dispatcher.stop()
+        for participant in students + tas:
+            participant.stop()
+        server_transport.disconnect()
+        if broker is not None:
+            broker.stop()
+        return {
+            "groups": self.groups,
+            "tas": self.tas,
+            "pattern": self.pattern,
+            "rate": self.rate,
+            "transport": self.transport,
+            "virtual": self.virtual,
+            "duration_s": elapsed,
+            "wall_s": wall,
+            "counters": dict(sorted(self.counters.items())),
+            "request_to_ta": self.latencies.summary("request_to_ta"),
+            "claim_handshake": self.latencies.summary("claim_handshake"),
+            "queue_wait": self.latencies.summary("queue_wait"),
+            "messages": published,
+            "messages_per_s": published / elapsed,
+            "queue_length": server.queue.global_q_pos,
+            "resync_requests": server.resync_requests,
+        }
+
+    @staticmethod
+    def run_until_idle(dispatchers: list, tas: list):
+        """ Virtual time: handle every queued message and state machine event, including the ones they cause """
+        while sum(d.process_pending() for d in dispatchers) + sum(ta.driver.run_pending() for ta in tas) > 0:
+            pass
+
+    def next_due(self, now: float, arrivals: list, tas: list) -> float:
+        """ Virtual time: session time of the next arrival, cancellation, finished TA, timer or callback """
+        if any(ta.ready() for ta in tas):
+            return now + self.tick
+        due = [self.duration]
+        if len(arrivals) > 0:
+            due.append(arrivals[0])
+        if len(self.cancellations) > 0:
+            due.append(self.cancellations[0][0])
+        due += [ta.helping_until for ta in tas if ta.helping_until is not None]
+        due += [ta.driver.next_timer_at() - self._started for ta in tas if ta.driver.next_timer_at() is not None]
+        if self.clock.next_callback_at() is not None:
+            due.append(self.clock.next_callback_at() - self._started)
+        return max(now + self.tick, min(due))
+
+
+class _DefaultModule:
+    """ Used when data/modules.json is missing """
+    number = 1
+    task_count = 5
+
+
+def print_report(report: dict):
+    print(f"Load test: {report['groups']} groups, {report['tas']} TAs, {report['pattern']} arrivals at "
+          f"{report['rate']} requests/s, {report['duration_s']:.1f}s over {report['transport']}"
+          f"{' in virtual time' if report['virtual'] else ''}, took {report['wall_s']:.1f}s")
+    print("Counts: " + ", ".join(f"{name} {value}" for name, value in report["counters"].items()))
+    for name, title in (("request_to_ta", "request help -> TA help_requests"), ("claim_handshake", "claim handshake"),
+                        ("queue_wait", "request help -> claimed")):
+        s = report[name]
+        print(f"{title:34} n={s['count']:<6} p50={s['p50_ms']:.1f}ms p95={s['p95_ms']:.1f}ms "
+              f"p99={s['p99_ms']:.1f}ms max={s['max_ms']:.1f}ms")
+    print(f"Throughput: {report['messages']} messages, {report['messages_per_s']:.0f} messages/s")
+    print(f"Queue length at the end: {report['queue_length']}, resync requests: {report['resync_requests']}")
+
+
+def check(min_speedup: float = 20.0):
+    """
+    Quick check, e.g. for CI: a virtual minute of the default session is reproducible and runs at least
+    `min_speedup` times faster than real time (about 60 times on a laptop)
+    """
+    reports = [LoadGenerator(duration=60, virtual=True).run() for _i in range(2)]
+    for report in reports:
+        print_report(report)
+    first, second = ({k: v for k, v in report.items() if k != "wall_s"} for report in reports)
+    assert first == second, "two runs with the same seed gave different reports"
+    assert first["counters"].get("claim_timeouts", 0) == 0, "simulated TAs raced for the same request"
+    speedup = min(report["duration_s"] / report["wall_s"] for report in reports)
+    print(f"Virtual time runs {speedup:.0f} times faster than real time")
+    assert speedup >= min_speedup, f"virtual time is only {speedup:.1f} times faster than real time"
+    print("OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lab-session load generator")
+    parser.add_argument("--groups", type=int, default=150)
+    parser.add_argument("--tas", type=int, default=15)
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+    parser.add_argument("--rate", type=float, default=1.0, help="help requests per second")
+    parser.add_argument("--pattern", choices=["poisson", "spike"], default="poisson")
+    parser.add_argument("--spike-window", type=float, default=5.0, help="seconds, for the spike pattern")
+    parser.add_argument("--help-time", type=float, default=5.0, help="mean seconds a TA spends on a request")
+    parser.add_argument("--transport", choices=["loopback", "broker"], default="loopback",
+                        help="in-process bus, or a local MQTT broker over TCP")
+    parser.add_argument("--seed", type=int, default=4115)
+    parser.add_argument("--virtual", action="store_true",
+                        help="run on a virtual clock, much faster than real time and reproducible")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the clients' log output")
+    parser.add_argument("--check", action="store_true",
+                        help="only check that a virtual session is reproducible and fast enough")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        return
+
+    metrics.start_exporter()
+    if args.verbose:
+        set_level(INFO)
+    load = LoadGenerator(groups=args.groups, tas=args.tas, duration=args.duration, rate=args.rate,
+                         pattern=args.pattern, spike_window=args.spike_window, help_time=args.help_time,
+                         transport=args.transport, seed=args.seed, virtual=args.virtual)
+    report = load.run()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import argparse
+from collections import deque
+from threading import Lock
+from time import sleep
+
+from common import metrics
+from common.clock import get_clock
+from common.dispatcher import MessageDispatcher
+from common.logger import get_logger
+from common.mqtt_utils import BROKER, PORT, TOPIC_QUEUE, TOPIC_SERVER, TOPIC_SNAPSHOT, TOPIC_RESYNC, RequestWrapper, \
+    Message, TYPE_ADD_HELP_REQUEST, TYPE_CANCEL_HELP_REQUEST, TYPE_RESOLVE_REQUEST, TYPE_CONFIRM_CLAIM, \
+    TYPE_CANCEL_CLAIM, TYPE_QUEUE_EVENT, TYPE_QUEUE_SNAPSHOT, TYPE_RESYNC_REQUEST, QUEUE_OP_ADD, QUEUE_OP_REMOVE, QUEUE_OP_CLAIM, QUEUE_OP_UNCLAIM, \
+    SNAPSHOT_VERSION
+from common.queue_manager import QueueManager
+from common.storage import DB_PATH, SqliteStore, STATUS_CLAIMED, STATUS_OPEN, STATUS_CANCELLED, STATUS_RESOLVED
+from common.transport import Transport, PahoTransport, LocalBroker
+
+log = get_logger("server")
+EVENTS_PUBLISHED = metrics.counter("queue_events_published_total", "Queue events published, by operation")
+
+
+class QueueServer:
+    """
+    Holds the single, authoritative help-request queue.
+    Applies the add/cancel/resolve/claim commands that clients publish on TOPIC_QUEUE, and publishes the result of
+    every accepted command on TOPIC_SERVER as a queue event with a sequence number, the queue length, the position
+    of the affected request and its claimant. Duplicate or stale commands are ignored, so clients never need to
+    replay or deduplicate the raw command stream.
+    The whole open queue is also published as a retained snapshot on TOPIC_SNAPSHOT, at most once every
+    `snapshot_interval` seconds, so clients that connect late start from the current queue.
+    Clients that miss events ask for the missing range on TOPIC_RESYNC. The last `history_size` events are kept
+    and published again; older ranges are answered with a snapshot.
+    Events and snapshots carry the server's epoch, the time it started, so clients notice a restart that
+    numbers the events from 1 again. A server that restores its own retained snapshot keeps its epoch.
+    With a `store`, every accepted command is also written to the database, and the open requests are restored
+    from it on start, so the queue survives a restart of both the server and the broker.
+    """
+
+    def __init__(self, transport: Transport, snapshot_interval: float = 0.5, history_size: int = 1000,
+                 store: SqliteStore = None):
+        self.transport = transport
+        self.queue = QueueManager()
+        self.requests = {}  # id -> body of the add-help-request message
+        self.claims = {}  # id -> ta name
+        self.seq = 0
+        self.clock = get_clock()
+        self.epoch = self.clock.time_ns()
+        self.snapshot_interval = snapshot_interval
+        self.snapshots_published = 0
+        self._snapshot_pending = False
+        self._last_snapshot = float("-inf")
+        self.history = deque(maxlen=history_size)  # (seq, payload) of the last published events
+        self.resync_requests = 0
+        self._lock = Lock()
+        self.store = store
+        if store is not None:
+            self.restore_from_store()
+
+    def handle_message(self, topic: str, message: Message):
+        req_type = message.request_type
+        req_id = message.get("id")
+        with self._lock:
+            if req_type == TYPE_QUEUE_SNAPSHOT:
+                # our own retained snapshot, restores the queue after a restart. It is newer than the database if
+                # the last writes didn't make it to the disk
+                if len(self.history) == 0 and message.get("seq", 0) > self.seq:
+                    self.restore(message)
+                return
+            if req_type == TYPE_RESYNC_REQUEST:
+                self.resync(message.get("from"), message.get("to"))
+                return
+            if req_type == TYPE_ADD_HELP_REQUEST:
+                if req_id in self.requests:
+                    return
+                self.seq += 1
+                self.requests[req_id] = message.data
+                self.queue.on_add(req_id, self.clock.now(), False, seq=self.seq)
+                if self.store is not None:
+                    self.store.record_request(self.seq, message.data)
+                self.publish_event(QUEUE_OP_ADD, req_id, request=message.data)
+            elif req_type == TYPE_CANCEL_HELP_REQUEST or req_type == TYPE_RESOLVE_REQUEST:
+                if self.requests.pop(req_id, None) is None:
+                    return
+                ta = self.claims.pop(req_id, None)
+                self.queue.on_cancel(req_id)
+                self.seq += 1
+                if self.store is not None:
+                    resolved = req_type == TYPE_RESOLVE_REQUEST
+                    self.store.record_status(self.seq, req_id, STATUS_RESOLVED if resolved else STATUS_CANCELLED,
+                                             actor=(ta or "") if resolved else "student")
+                self.publish_event(QUEUE_OP_REMOVE, req_id)
+            elif req_type == TYPE_CONFIRM_CLAIM:
+                if req_id not in self.requests or self.claims.get(req_id) == message.get("ta"):
+                    return
+                self.claims[req_id] = message.get("ta")
+                self.seq += 1
+                if self.store is not None:
+                    self.store.record_status(self.seq, req_id, STATUS_CLAIMED, actor=message.get("ta"),
+                                             claimed_by=message.get("ta"))
+                self.publish_event(QUEUE_OP_CLAIM, req_id, ta=message.get("ta"))
+            elif req_type == TYPE_CANCEL_CLAIM:
+                if req_id not in self.claims or self.claims[req_id] != message.get("ta"):
+                    return  # not claimed, or claimed by another TA
+                del self.claims[req_id]
+                self.seq += 1
+                if self.store is not None:
+                    self.store.record_status(self.seq, req_id, STATUS_OPEN, actor=message.get("ta") or "")
+                self.publish_event(QUEUE_OP_UNCLAIM, req_id, ta=message.get("ta"))
+
+    def publish_event(self, op: str, req_id: str, request: dict = None, ta: str = None):
+        EVENTS_PUBLISHED.inc(op=op)
+        log.debug("Queue event", seq=self.seq, op=op, id=req_id, ta=ta)
+        data = {
+            "seq": self.seq,
+            "epoch": self.epoch,
+            "op": op,
+            "id": req_id,
+            "length": self.queue.global_q_pos,
+            "position": self.queue.position(req_id),
+            "claimed_by": self.claims.get(req_id, ""),
+        }
+        if request is not None:
+            data["request"] = request
+        if ta is not None:
+            data["ta"] = ta
+        payload = RequestWrapper(TYPE_QUEUE_EVENT, data).payload()
+        self.history.append((self.seq, payload))
+        self.transport.publish(TOPIC_SERVER, payload=payload)
+        self.schedule_snapshot()
+
+    def resync(self, first: int, last: int):
+        """
+        Publish the events first..last again, or a snapshot if they are no longer in the history. first < 1 asks for
+        a snapshot, see EventSequencer
+        """
+        self.resync_requests += 1
+        if first >= 1 and len(self.history) > 0 and self.history[0][0] <= first:
+            for seq, payload in self.history:
+                if first <= seq <= last:
+                    self.transport.publish(TOPIC_SERVER, payload=payload)
+        else:
+            self._publish_snapshot()
+
+    def snapshot(self) -> dict:
+        """ Body of a queue-snapshot message, entries are arrays with the fields in SNAPSHOT_FIELDS """
+        entries = []
+        for req_id, (seq, _time) in sorted(self.queue.entries.items(), key=lambda item: item[1][0]):
+            request = self.requests[req_id]
+            entries.append([seq, req_id, request["group_number"], request["module_number"], request["task_idx"],
+                            request.get("time", ""), self.claims.get(req_id, ""), request["is_online"],
+                            request["zoom_url"], request["comment"]])
+        return {"format": SNAPSHOT_VERSION, "seq": self.seq, "epoch": self.epoch, "entries": entries}
+
+    def restore(self, message: Message):
+        self.requests.clear()
+        self.claims.clear()
+        self.queue.clear()
+        for entry in message.body:
+            req_id = entry["id"]
+            self.requests[req_id] = {key: value for key, value in entry.items() if key != "seq"}
+            self.queue.on_add(req_id, self.clock.now(), False, seq=entry["seq"])
+            if entry["claimed_by"]:
+                self.claims[req_id] = entry["claimed_by"]
+        self.seq = message.get("seq")
+        self.epoch = message.get("epoch", self.epoch)  # the sequence numbers continue, clients don't start over
+        log.info("Restored help requests from snapshot", count=len(message.body), seq=self.seq)
+
+    def restore_from_store(self):
+        """ Restore the open requests, their claims and the sequence number from the database """
+        for row in self.store.open_requests():
+            req_id = row["id"]
+            self.requests[req_id] = {"id": req_id, "group_number": row["group_number"],
+                                     "module_number": row["module_number"], "task_idx": row["task_idx"],
+                                     "is_online": bool(row["is_online"]), "zoom_url": row["zoom_url"],
+                                     "comment": row["comment"], "time": row["time_ns"]}
+            self.queue.on_add(req_id, self.clock.now(), False, seq=row["seq"])
+            if row["claimed_by"]:
+                self.claims[req_id] = row["claimed_by"]
+        self.seq = self.store.last_seq()
+        if self.seq > 0:
+            log.info("Restored help requests from the database", count=len(self.requests), seq=self.seq)
+            self.schedule_snapshot()  # replaces the retained snapshot, if the broker has an older one
+
+    def schedule_snapshot(self):
+        """ Publish a snapshot soon. Changes within `snapshot_interval` of the last snapshot are merged """
+        if self._snapshot_pending:
+            return
+        self._snapshot_pending = True
+        self.clock.call_later(max(0.0, self._last_snapshot + self.snapshot_interval - self.clock.monotonic()),
+                              self.publish_snapshot)
+
+    def publish_snapshot(self):
+        with self._lock:
+            self._snapshot_pending = False
+            self._publish_snapshot()
+
+    def _publish_snapshot(self):
+        self._last_snapshot = self.clock.monotonic()
+        self.snapshots_published += 1
+        payload = RequestWrapper(TYPE_QUEUE_SNAPSHOT, self.snapshot()).payload()
+        self.transport.publish(TOPIC_SNAPSHOT, payload=payload, retain=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless queue server")
+    parser.add_argument("--broker", default=BROKER)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--local-broker", action="store_true",
+                        help="also run a local MQTT broker on --port, and use it instead of --broker")
+    parser.add_argument("--db", default=DB_PATH,
+                        help="SQLite database keeping the queue and its history across restarts (default $KOMSYS_DB)")
+    args = parser.parse_args()
+
+    broker = None
+    if args.local_broker:
+        broker = LocalBroker(port=args.port)
+        broker.start()
+        args.broker = broker.host
+    transport = PahoTransport(args.broker, args.port)
+    store = SqliteStore(args.db) if args.db else None
+    server = QueueServer(transport, store=store)
+    metrics.gauge("queue_length", "Open help requests").set_function(lambda: server.queue.global_q_pos)
+    metrics.start_exporter()
+    dispatcher = MessageDispatcher(server.handle_message)
+    transport.on_message = dispatcher.submit
+    transport.connect()
+    transport.subscribe(TOPIC_SNAPSHOT)  # the retained snapshot arrives before any new command
+    transport.subscribe(TOPIC_QUEUE)
+    transport.subscribe(TOPIC_RESYNC)
+    transport.start()
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        transport.disconnect()
+        dispatcher.stop()
+        if store is not None:
+            store.flush()
+        if broker is not None:
+            broker.stop()
+
+
+if __name__ == "__main__":
+    main()
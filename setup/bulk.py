@@ -0,0 +1,212 @@
+import csv
+import json
+import os
+from os import path
+
+from common.group import Group
+from common.module import Module
+from setup.config_store import ConfigStore
+
+MODULE_FIELDS = ("number", "name", "task_count")
+GROUP_FIELDS = ("number", "table")
+MAX_ERRORS = 20  # errors reported for one import, the rest are counted
+MAX_NUMBER = 10_000  # highest module, group, table number and task count; larger ones are typos
+
+
+def _is_jsonl(filepath: str) -> bool:
+    return path.splitext(filepath)[1].lower() in (".jsonl", ".ndjson")
+
+
+def read_records(filepath: str):
+    """
+    Stream (line number, record dict) from a CSV file with a header row, or a JSON-lines file with one object per
+    line. The format is picked by the extension: .jsonl/.ndjson are JSON lines, anything else is CSV.
+    """
+    with open(filepath, newline="") as f:
+        if _is_jsonl(filepath):
+            for line_number, line in enumerate(f, 1):
+                if line.strip() == "":
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"line {line_number} is not valid JSON ({e})")
+                yield line_number, record
+        else:
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, {key.strip(): value.strip() for key, value in record.items()
+                                        if key is not None and value is not None}
+
+
+def _number(record: dict, field: str) -> int:
+    value = record.get(field)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    raise ValueError(f"{field} must be a whole number, got {value!r}")
+
+
+def _parse(record: dict):
+    """ A Module or a Group, depending on the fields of the record """
+    if not isinstance(record, dict):
+        raise ValueError("expected an object with the fields of a module or a group")
+    if "table" in record:
+        return Group(_number(record, "number"), _number(record, "table"))
+    if "task_count" in record or "name" in record:
+        name = str(record.get("name", "")).strip()
+        if name == "":
+            raise ValueError("name is missing")
+        return Module(_number(record, "number"), name, _number(record, "task_count"))
+    raise ValueError(f"not a module ({', '.join(MODULE_FIELDS)}) or a group ({', '.join(GROUP_FIELDS)})")
+
+
+class ImportResult:
+    """ What an import would change, and the problems found in the files """
+
+    def __init__(self):
+        self.modules = {}  # number -> Module, after the import
+        self.groups = {}  # number -> Group, after the import
+        self.modules_imported = 0
+        self.groups_imported = 0
+        self.errors = []
+        self.error_count = 0
+
+    def error(self, where: str, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(f"{where}: {message}")
+
+    def summary(self) -> str:
+        if self.error_count > 0:
+            lines = self.errors + ([f"... and {self.error_count - len(self.errors)} more errors"]
+                                   if self.error_count > len(self.errors) else [])
+            return "\n".join(lines)
+        return f"{self.modules_imported} modules and {self.groups_imported} groups imported, " \
+               f"{len(self.modules)} modules and {len(self.groups)} groups in total"
+
+
+def validate(store: ConfigStore, filepaths: list, replace: bool = False) -> ImportResult:
+    """
+    Read the files in one pass and work out the modules and groups after importing them. Records update the
+    entry with the same number, and add it otherwise; with `replace`, the imported modules (or groups) replace
+    all existing ones. Finds duplicate numbers and tables in the files, tables already taken by another group and
+    task counts below 1. Nothing is changed, see import_files().
+    """
+    result = ImportResult()
+    modules, groups = {}, {}  # number -> (where, entry) from the files
+    for filepath in filepaths:
+        try:
+            for line_number, record in read_records(filepath):
+                where = f"{filepath}:{line_number}"
+                try:
+                    entry = _parse(record)
+                except ValueError as e:
+                    result.error(where, str(e))
+                    continue
+                imported = modules if isinstance(entry, Module) else groups
+                kind = "module" if isinstance(entry, Module) else "group"
+                if entry.number < 1:
+                    result.error(where, f"{kind} number must be at least 1")
+                elif entry.number > MAX_NUMBER:
+                    result.error(where, f"{kind} number must be at most {MAX_NUMBER}")
+                elif entry.number in imported:
+                    result.error(where, f"duplicate {kind} number {entry.number}, also on {imported[entry.number][0]}")
+                elif kind == "module" and entry.task_count < 1:
+                    result.error(where, f"module {entry.number} must have at least one task")
+                elif kind == "module" and entry.task_count > MAX_NUMBER:
+                    result.error(where, f"module {entry.number} can have at most {MAX_NUMBER} tasks")
+                elif kind == "group" and entry.table < 1:
+                    result.error(where, f"group {entry.number}: table must be at least 1")
+                elif kind == "group" and entry.table > MAX_NUMBER:
+                    result.error(where, f"group {entry.number}: table must be at most {MAX_NUMBER}")
+                else:
+                    imported[entry.number] = (where, entry)
+        except (OSError, ValueError, csv.Error) as e:
+            result.error(filepath, str(e))
+
+    result.modules = {} if replace and modules else dict(store.modules)
+    result.modules.update((number, module) for number, (_where, module) in modules.items())
+    result.groups = {} if replace and groups else dict(store.groups)
+    result.groups.update((number, group) for number, (_where, group) in groups.items())
+    result.modules_imported = len(modules)
+    result.groups_imported = len(groups)
+
+    tables = {}  # table -> group number, after the import
+    for group in result.groups.values():
+        other = tables.setdefault(group.table, group.number)
+        if other != group.number:
+            imported = groups.get(group.number) or groups.get(other)
+            where = imported[0] if imported is not None else "groups.json"
+            result.error(where, f"table {group.table} is used by both group {other} and group {group.number}")
+    return result
+
+
+def import_files(store: ConfigStore, filepaths: list, replace: bool = False, dry_run: bool = False) -> ImportResult:
+    """ Validate the files, and if there are no errors, write the result with one write per data file """
+    result = validate(store, filepaths, replace)
+    if result.error_count == 0 and not dry_run:
+        with store.batch():
+            store.replace(modules=list(result.modules.values()) if result.modules_imported else None,
+                          groups=list(result.groups.values()) if result.groups_imported else None)
+    return result
+
+
+def export_file(store: ConfigStore, kind: str, filepath: str) -> int:
+    """ Write the modules or groups (`kind`) to a CSV or JSON-lines file, sorted by number. Returns the count """
+    fields = MODULE_FIELDS if kind == "modules" else GROUP_FIELDS
+    entries = store.sorted_modules() if kind == "modules" else store.sorted_groups()
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, "w", newline="") as f:
+        if _is_jsonl(filepath):
+            f.writelines(json.dumps(entry.payload()) + "\n" for entry in entries)
+        else:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            writer.writerows([getattr(entry, field) for field in fields] for entry in entries)
+    os.replace(tmp_filepath, filepath)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    # ==== BULK TEST: validation errors, and 10,000 groups imported and exported ====
+    import tempfile
+    from time import perf_counter
+
+    directory = tempfile.mkdtemp()
+    store = ConfigStore([Module(1, "Setup", 3)], [Group(1, 1), Group(2, 2)], directory)
+
+    def write(name: str, text: str) -> str:
+        filepath = path.join(directory, name)
+        with open(filepath, "w") as f:
+            f.write(text)
+        return filepath
+
+    bad = write("bad.csv", "number,table\n3,3\n3,4\n4,1\nx,5\n5,100000000000000000000\n99999,6\n")
+    modules = write("modules.jsonl", '{"number": 2, "name": "Modeling", "task_count": 0}\n{"number": 3}\n')
+    result = import_files(store, [bad, modules])
+    print(result.summary())
+    assert result.error_count == 7, result.errors
+    assert any("bad.csv:6: group 5: table must be at most" in error for error in result.errors)
+    assert any("duplicate group number 3" in error for error in result.errors)
+    assert any("table 1 is used by both group 1 and group 4" in error for error in result.errors)
+    assert len(store.groups) == 2 and store.writes == 0
+
+    n = 10_000
+    groups = write("groups.csv", "number,table\n" + "".join(f"{i},{n + 1 - i}\n" for i in range(1, n + 1)))
+    started = perf_counter()
+    result = import_files(store, [groups])
+    elapsed = perf_counter() - started
+    print(f"{result.summary()} in {elapsed:.3f}s")
+    assert result.error_count == 0 and len(store.groups) == n and store.group(1).table == n and store.writes == 1
+    assert ConfigStore.load(directory).group_at_table(1).number == n
+
+    exported = path.join(directory, "exported.jsonl")
+    assert export_file(store, "groups", exported) == n
+    result = import_files(ConfigStore([], [], directory), [exported], dry_run=True)
+    assert result.error_count == 0 and result.groups == store.groups
+    export_file(store, "modules", path.join(directory, "exported.csv"))
+    with open(path.join(directory, "exported.csv")) as f:
+        assert f.read().splitlines() == ["number,name,task_count", "1,Setup,3"]
+    print("OK")
@@ -0,0 +1,286 @@
+import heapq
+import math
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+from os import path
+
+from common.group import Group
+from common.io_utils import DATA_DIR, import_groups, import_modules, write_json_atomic
+from common.module import Module
+
+
+class NumberAllocator:
+    """
+    Hands out the lowest free number >= 1, e.g. the next vacant group number.
+    Free numbers below the highest one in use are kept as sorted gap intervals (the numbers never taken) and a
+    min-heap (the numbers released); released numbers that were taken again are skipped lazily when they reach the
+    top. Memory grows with the count of numbers in use, not with the highest one, so a typo like group 5000000 costs
+    one gap. take() and release() are O(log n) amortized, plus a list insert when take() splits a gap.
+    """
+
+    def __init__(self, used=()):
+        self.used = set(used)
+        self._gaps = []  # sorted (first, last) of the free numbers below _next that were never taken
+        previous = 0
+        for number in sorted(self.used):
+            if number > previous + 1:
+                self._gaps.append((previous + 1, number - 1))
+            previous = number
+        self._next = previous + 1  # every number from here on is free
+        self._free = []  # released numbers below _next
+
+    def __contains__(self, number: int) -> bool:
+        return number in self.used
+
+    def lowest_free(self) -> int:
+        while self._free and self._free[0] in self.used:
+            heapq.heappop(self._free)
+        lowest = self._next
+        if self._gaps:
+            lowest = min(lowest, self._gaps[0][0])
+        if self._free:
+            lowest = min(lowest, self._free[0])
+        return lowest
+
+    def take(self, number: int):
+        if number < 1:
+            raise ValueError(f"Number must be at least 1, got {number}")
+        if number in self.used:
+            return
+        self.used.add(number)
+        if number >= self._next:
+            if number > self._next:
+                self._gaps.append((self._next, number - 1))
+            self._next = number + 1
+            return
+        i = bisect_right(self._gaps, (number, math.inf)) - 1
+        if i >= 0 and self._gaps[i][0] <= number <= self._gaps[i][1]:
+            first, last = self._gaps[i]
+            self._gaps[i:i + 1] = [gap for gap in ((first, number - 1), (number + 1, last)) if gap[0] <= gap[1]]
+
+    def release(self, number: int):
+        if number in self.used:
+            self.used.remove(number)
+            heapq.heappush(self._free, number)
+
+
+class ConfigStore:
+    """
+    The modules and groups edited by the setup app, indexed by number (and groups by table), with the numbers kept
+    sorted for listing and a NumberAllocator for the next vacant module, group and table number.
+    Edits mark modules.json or groups.json as changed and are written when the outermost batch() ends; outside a
+    batch every edit is written right away. Files are replaced atomically, so the clients watching them never
+    read a half-written file. Invalid edits raise ValueError with a message for the user, and change nothing.
+    With a `database` (common.storage.SqliteStore), the saved modules and groups are also written to it.
+    """
+
+    def __init__(self, modules: list, groups: list, data_dir: str = DATA_DIR, database=None):
+        self.data_dir = data_dir
+        self.database = database
+        self._set_modules(modules)
+        self._set_groups(groups)
+        self._dirty = set()  # names of the files to write
+        self._batch_depth = 0
+        # counters
+        self.writes = 0
+
+    @staticmethod
+    def load(data_dir: str = DATA_DIR, database=None) -> "ConfigStore":
+        return ConfigStore(import_modules(data_dir), import_groups(data_dir), data_dir, database)
+
+    def module(self, number: int):
+        return self.modules.get(number)
+
+    def group(self, number: int):
+        return self.groups.get(number)
+
+    def group_at_table(self, table: int):
+        number = self.tables.get(table)
+        return None if number is None else self.groups[number]
+
+    def sorted_modules(self, start: int = 0, stop: int = None) -> list:
+        """ Modules by number, optionally a slice of them, e.g. one page """
+        return [self.modules[number] for number in self.module_numbers[start:stop]]
+
+    def sorted_groups(self, start: int = 0, stop: int = None) -> list:
+        return [self.groups[number] for number in self.group_numbers[start:stop]]
+
+    def next_vacant_module_number(self) -> int:
+        return self.free_module_numbers.lowest_free()
+
+    def next_vacant_group_number(self) -> int:
+        return self.free_group_numbers.lowest_free()
+
+    def next_vacant_table(self) -> int:
+        return self.free_tables.lowest_free()
+
+    def put_module(self, module: Module, replacing: int = None):
+        """ Add a module, or replace module number `replacing` with it (its number may change) """
+        if module.number < 1:
+            raise ValueError("Module number must be at least 1")
+        if module.task_count < 1:
+            raise ValueError("Module must have at least one task")
+        if module.number != replacing and module.number in self.modules:
+            raise ValueError("Module number already taken")
+        if replacing is not None:
+            self._remove_module(replacing)
+        self.modules[module.number] = module
+        insort(self.module_numbers, module.number)
+        self.free_module_numbers.take(module.number)
+        self._changed("modules.json")
+
+    def delete_module(self, number: int):
+        if number in self.modules:
+            self._remove_module(number)
+            self._changed("modules.json")
+
+    def put_group(self, group: Group, replacing: int = None):
+        """ Add a group, or replace group number `replacing` with it (its number and table may change) """
+        if group.number < 1 or group.table < 1:
+            raise ValueError("Group and table numbers must be at least 1")
+        if group.number != replacing and group.number in self.groups:
+            raise ValueError("Group number already taken")
+        table_group = self.tables.get(group.table)
+        if table_group is not None and table_group != replacing:
+            raise ValueError(f"Table {group.table} is taken by group {table_group}")
+        if replacing is not None:
+            self._remove_group(replacing)
+        self.groups[group.number] = group
+        self.tables[group.table] = group.number
+        insort(self.group_numbers, group.number)
+        self.free_group_numbers.take(group.number)
+        self.free_tables.take(group.table)
+        self._changed("groups.json")
+
+    def delete_group(self, number: int):
+        if number in self.groups:
+            self._remove_group(number)
+            self._changed("groups.json")
+
+    def replace(self, modules: list = None, groups: list = None):
+        """
+        Replace all modules and/or all groups in one step, e.g. after a bulk import. The lists are not validated
+        here, see setup.bulk.
+        """
+        if modules is not None:
+            self._set_modules(modules)
+            self._changed("modules.json")
+        if groups is not None:
+            self._set_groups(groups)
+            self._changed("groups.json")
+
+    @contextmanager
+    def batch(self):
+        """ Write the changed files once, when the outermost batch ends """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.save()
+
+    def save(self):
+        if "modules.json" in self._dirty:
+            write_json_atomic(path.join(self.data_dir, "modules.json"),
+                              [self.modules[number].payload() for number in self.module_numbers])
+            if self.database is not None:
+                self.database.save_modules(self.sorted_modules())
+        if "groups.json" in self._dirty:
+            write_json_atomic(path.join(self.data_dir, "groups.json"),
+                              [self.groups[number].payload() for number in self.group_numbers])
+            if self.database is not None:
+                self.database.save_groups(self.sorted_groups())
+        self.writes += len(self._dirty)
+        self._dirty.clear()
+
+    def _changed(self, filename: str):
+        self._dirty.add(filename)
+        if self._batch_depth == 0:
+            self.save()
+
+    def _set_modules(self, modules: list):
+        self.modules = {module.number: module for module in modules}
+        self.module_numbers = sorted(self.modules)
+        self.free_module_numbers = NumberAllocator(self.modules)
+
+    def _set_groups(self, groups: list):
+        self.groups = {group.number: group for group in groups}
+        self.tables = {group.table: group.number for group in self.groups.values()}
+        self.group_numbers = sorted(self.groups)
+        self.free_group_numbers = NumberAllocator(self.groups)
+        self.free_tables = NumberAllocator(self.tables)
+
+    def _remove_module(self, number: int):
+        del self.modules[number]
+        del self.module_numbers[bisect_left(self.module_numbers, number)]
+        self.free_module_numbers.release(number)
+
+    def _remove_group(self, number: int):
+        group = self.groups.pop(number)
+        del self.tables[group.table]
+        del self.group_numbers[bisect_left(self.group_numbers, number)]
+        self.free_group_numbers.release(number)
+        self.free_tables.release(group.table)
+
+
+if __name__ == "__main__":
+    # ==== CONFIG STORE TEST: allocator, validation, and 20,000 groups added in one batch ====
+    import json
+    import tempfile
+    from time import perf_counter
+
+    allocator = NumberAllocator([1, 2, 4, 7])
+    assert allocator.lowest_free() == 3
+    allocator.take(3)
+    assert allocator.lowest_free() == 5
+    allocator.release(2)
+    assert allocator.lowest_free() == 2
+    allocator.take(2)
+    allocator.take(5)
+    allocator.take(6)
+    assert allocator.lowest_free() == 8
+    allocator.take(12)
+    assert allocator.lowest_free() == 8 and 12 in allocator and 9 not in allocator
+    for number in (8, 10, 9, 11):
+        allocator.take(number)
+    assert allocator.lowest_free() == 13 and allocator._gaps == []
+
+    started = perf_counter()
+    allocator = NumberAllocator([2, 5_000_000])  # e.g. a typo'd table number
+    allocator.take(10_000_000)
+    allocator.take(1)
+    allocator.take(3)
+    allocator.release(2)
+    assert allocator.lowest_free() == 2 and perf_counter() - started < 0.1
+    allocator.take(2)
+    assert allocator.lowest_free() == 4 and allocator._gaps == [(4, 4_999_999), (5_000_001, 9_999_999)]
+
+    data_dir = tempfile.mkdtemp()
+    store = ConfigStore([Module(1, "Setup", 3)], [Group(1, 2), Group(2, 1)], data_dir)
+    assert store.next_vacant_group_number() == 3 and store.next_vacant_table() == 3
+    for bad_group in (Group(1, 5), Group(3, 2), Group(0, 9)):
+        try:
+            store.put_group(bad_group)
+            assert False, f"{bad_group} should be rejected"
+        except ValueError:
+            pass
+    store.put_group(Group(2, 7), replacing=2)  # move group 2 to table 7, freeing table 1
+    assert store.next_vacant_table() == 1 and store.group_at_table(7).number == 2
+    store.put_module(Module(150, "Extra", 2))
+    assert store.next_vacant_module_number() == 2 and store.writes == 2
+
+    n = 20_000
+    started = perf_counter()
+    with store.batch():
+        for _ in range(n):
+            store.put_group(Group(store.next_vacant_group_number(), store.next_vacant_table()))
+        store.delete_group(1)
+    elapsed = perf_counter() - started
+    print(f"{n} groups added in {elapsed:.3f}s, {store.writes} file writes")
+    assert store.writes == 3 and store.next_vacant_group_number() == 1
+    with open(path.join(data_dir, "groups.json")) as file:
+        groups = json.load(file)
+    assert len(groups) == n + 1 and [group["number"] for group in groups] == list(range(2, n + 3))
+    assert len(ConfigStore.load(data_dir).sorted_groups(0, 15)) == 15
+    print("OK")
@@ -1,13 +1,15 @@
+import argparse
+import sys
 from appJar import gui
-from os import path
-import json
 from enum import Enum
-from uuid import uuid1
 from common.group import Group
 from common.module import Module
-from common.io_utils import import_modules, import_groups
+from common.storage import get_store
+from common.ui_utils import SpacerFactory
+from setup.bulk import export_file, import_files
+from setup.config_store import ConfigStore
 
-DATA_FILEPATH = path.join("..", "data")
+PAGE_SIZE = 15  # modules or groups listed per page
 
 
 class Scene(Enum):
@@ -22,10 +24,11 @@ class UserInterface:
     def __init__(self):
         self.app = gui("Configuration App", "1x1")  # size is set in show_scene() method
         self.current_scene = -1
-        self.modules = import_modules()
-        self.groups = import_groups()
+        self.store = ConfigStore.load(database=get_store())
+        self.page = 0  # page of the module or group list
         self.item_to_edit = -1
         self.is_editing = False
+        self.spacers = SpacerFactory(self.app)
         self.start_app()
 
     def show_error(self, message: str):
@@ -38,74 +41,9 @@ class UserInterface:
         self.show_scene(Scene.MAIN_MENU)
         self.app.go()
 
-    def get_module(self, number: int):
-        for _module in self.modules:
-            if _module.number == number:
-                return _module
-        return None
-
-    def swap_module(self, old_module_number: int, new_module: Module):
-        for i in range(len(self.modules)):
-            _m = self.modules[i]
-            if old_module_number == _m.number:
-                self.modules[i] = new_module
-                return
-
-    def persist_modules(self):
-        modules = []
-        for module in self.modules:
-            modules.append({"name": module.name, "number": module.number, "task_count": module.task_count})
-        with open(path.join(DATA_FILEPATH, "modules.json"), "w") as f:
-            json.dump(modules, f)
-        self.show_scene(Scene.MODULES)
-
-    def get_next_vacant_module_number(self):
-        num_arr = [0] * 100
-        for _module in self.modules:
-            num_arr[_module.number - 1] = 1
-        for i in range(len(num_arr)):
-            if num_arr[i] == 0:
-                return i + 1
-        return -1  # No vacant spots, very unlikely, won't bother handling it
-
-    def get_group(self, number: int):
-        for _group in self.groups:
-            if _group.number == number:
-                return _group
-        return None
-
-    def swap_group(self, old_group_number: int, new_group: Group):
-        for i in range(len(self.groups)):
-            _g = self.groups[i]
-            if old_group_number == _g.number:
-                self.groups[i] = new_group
-                return
-
-    def get_next_vacant_group_number(self):
-        num_arr = [0] * 100
-        for _group in self.groups:
-            num_arr[_group.number - 1] = 1
-        for i in range(len(num_arr)):
-            if num_arr[i] == 0:
-                return i + 1
-        return -1  # No vacant spots, very unlikely, won't bother handling it
-
-    def get_next_vacant_table_number(self):
-        num_arr = [0] * 100
-        for _group in self.groups:
-            num_arr[_group.table - 1] = 1
-        for i in range(len(num_arr)):
-            if num_arr[i] == 0:
-                return i + 1
-        return -1  # No vacant spots, very unlikely, won't bother handling it
-
-    def persist_groups(self):
-        groups = []
-        for group in self.groups:
-            groups.append({"number": group.number, "table": group.table})
-        with open(path.join(DATA_FILEPATH, "groups.json"), "w") as f:
-            json.dump(groups, f)
-        self.show_scene(Scene.GROUPS)
+    def show_list(self, scene: Scene, page: int = 0):
+        self.page = page
+        self.show_scene(scene)
 
     def set_window_size_and_center(self, x: int, y: int):
         """ Resize and center window """
@@ -120,9 +58,7 @@ class UserInterface:
     def show_scene(self, scene: int):
         def add_whitespace(desired_row_count: int, current_row_count: int):
             """ Essentially just used to push elements into place """
-            rows_to_add = desired_row_count - current_row_count
-            for _i in range(rows_to_add):
-                self.app.addLabel(str(uuid1()), text="", row=_i + current_row_count + 1, rowspan=1)
+            self.spacers.add_whitespace(desired_row_count, current_row_count)
 
         def add_side_menu(back_btn_func=None, desired_rows=15):
             self.app.startLabelFrame("Menu", row=0, rowspan=5, column=0, colspan=1)
@@ -133,19 +69,34 @@ class UserInterface:
             add_whitespace(desired_rows, current_row_count)
             self.app.stopLabelFrame()
 
+        def add_page_links(item_count: int) -> int:
+            """ Links to the previous and next page, if any. Returns the number of rows added """
+            page_count = max(1, (item_count + PAGE_SIZE - 1) // PAGE_SIZE)
+            if page_count == 1:
+                return 0
+            self.app.startFrame("PAGEFRAME", colspan=3, rowspan=1)
+            self.app.addLabel("LAB_PAGE", f"Page {self.page + 1} of {page_count}", column=0, row=0)
+            if self.page > 0:
+                self.app.addLink("< Previous page", lambda _: self.show_list(scene, self.page - 1), column=1, row=0)
+            if self.page < page_count - 1:
+                self.app.addLink("Next page >", lambda _: self.show_list(scene, self.page + 1), column=2, row=0)
+            self.app.stopFrame()
+            return 1
+
         self.app.removeAllWidgets()
+        self.spacers.reset()
         self.current_scene = scene
         if scene == Scene.MAIN_MENU:
             self.set_window_size_and_center(500, 100)
             self.app.startLabelFrame("Options")
             self.app.setSticky("nwe")  # on resize, stretch from north-west to east
-            self.app.addLink("Edit modules", lambda _: self.show_scene(Scene.MODULES))
-            self.app.addLink("Edit groups", lambda _: self.show_scene(Scene.GROUPS))
+            self.app.addLink("Edit modules", lambda _: self.show_list(Scene.MODULES))
+            self.app.addLink("Edit groups", lambda _: self.show_list(Scene.GROUPS))
             self.app.stopLabelFrame()
         elif scene == Scene.MODULES:
             def delete_module(num: int):
-                self.modules = [_module for _module in self.modules if _module.number != num]
-                self.persist_modules()
+                self.store.delete_module(num)
+                self.show_list(Scene.MODULES, max(0, min(self.page, (len(self.store.modules) - 1) // PAGE_SIZE)))
 
             def on_edit_module(module_num: int):
                 self.item_to_edit = module_num
@@ -169,10 +120,12 @@ class UserInterface:
             self.app.startLabelFrame("Modules", column=1, row=0, rowspan=4)
             self.app.setSticky("nwe")  # on resize, stretch from north-west to east
             max_rows = 15
-            for module in sorted(self.modules, key=lambda _m: _m.number):
+            modules = self.store.sorted_modules(self.page * PAGE_SIZE, (self.page + 1) * PAGE_SIZE)
+            for module in modules:
                 add_module_frame(module)
             self.app.addLink("+ Add module", on_add_module)
-            add_whitespace(max_rows, len(self.modules) + 1)
+            page_rows = add_page_links(len(self.store.modules))
+            add_whitespace(max_rows, len(modules) + 1 + page_rows)
             self.app.stopLabelFrame()
 
         elif scene == Scene.SAVE_EDIT_MODULE:
@@ -183,25 +136,18 @@ class UserInterface:
                 if not number.isnumeric():
                     self.app.setLabel("LAB_ERROR", "Module number field is not numeric")
                     return
-                if int(number) > 100 or int(number) < 1:
-                    self.app.setLabel("LAB_ERROR", "Module number must be between 1 and 100")
-                    return
                 if not task_count.isnumeric():
                     self.app.setLabel("LAB_ERROR", "Module task count is not numeric")
                     return
                 if name == "":
                     self.app.setLabel("LAB_ERROR", "Invalid module name")
                     return
-                # Avoid that two modules end up with the same number
-                for _module in self.modules:
-                    if _module.number == int(number) and (not self.is_editing or _module.number != self.item_to_edit):
-                        self.app.setLabel("LAB_ERROR", "Module number already taken")
-                        return
-                if self.is_editing:
-                    self.swap_module(self.item_to_edit, Module(int(number), name, int(task_count)))
-                else:
-                    self.modules.append(Module(int(number), name, int(task_count)))
-                self.persist_modules()
+                try:
+                    self.store.put_module(Module(int(number), name, int(task_count)),
+                                          replacing=self.item_to_edit if self.is_editing else None)
+                except ValueError as e:  # e.g. the number is already taken
+                    self.app.setLabel("LAB_ERROR", str(e))
+                    return
                 self.show_scene(Scene.MODULES)
 
             self.set_window_size_and_center(500, 300)
@@ -221,20 +167,20 @@ class UserInterface:
             if self.is_editing:
                 self.app.setButton("BTN_SUBMIT_MODULE", "Update module")
                 # find current module
-                current_module = self.get_module(self.item_to_edit)
+                current_module = self.store.module(self.item_to_edit)
                 self.app.setEntry("LAB_NUMBER", current_module.number)
                 self.app.setEntry("LAB_NAME", current_module.name)
                 self.app.setEntry("LAB_TASK_COUNT", current_module.task_count)
             else:
                 self.app.setButton("BTN_SUBMIT_MODULE", "Add module")
-                self.app.setEntry("LAB_NUMBER", self.get_next_vacant_module_number())
+                self.app.setEntry("LAB_NUMBER", self.store.next_vacant_module_number())
             add_whitespace(10, 7)
             self.app.stopLabelFrame()
 
         elif scene == Scene.GROUPS:
             def delete_group(num: int):
-                self.groups = [_group for _group in self.groups if _group.number != num]
-                self.persist_modules()
+                self.store.delete_group(num)
+                self.show_list(Scene.GROUPS, max(0, min(self.page, (len(self.store.groups) - 1) // PAGE_SIZE)))
 
             def on_edit_group(group_num: int):
                 self.item_to_edit = group_num
@@ -258,10 +204,12 @@ class UserInterface:
             self.app.startLabelFrame("Groups", column=1, row=0, rowspan=4)
             self.app.setSticky("nwe")  # on resize, stretch from north-west to east
             max_rows = 15
-            for group in sorted(self.groups, key=lambda _g: _g.number):
+            groups = self.store.sorted_groups(self.page * PAGE_SIZE, (self.page + 1) * PAGE_SIZE)
+            for group in groups:
                 add_group_frame(group)
             self.app.addLink("+ Add group", on_add_group)
-            add_whitespace(max_rows, len(self.groups) + 1)
+            page_rows = add_page_links(len(self.store.groups))
+            add_whitespace(max_rows, len(groups) + 1 + page_rows)
             self.app.stopLabelFrame()
 
         elif scene == Scene.SAVE_EDIT_GROUP:
@@ -269,24 +217,17 @@ class UserInterface:
                 number = self.app.getEntry("LAB_NUMBER")
                 table = self.app.getEntry("LAB_TABLE")
                 if not number.isnumeric():
-                    self.app.setLabel("LAB_ERROR", "Module number field is not numeric")
-                    return
-                if int(number) > 100 or int(number) < 1:
-                    self.app.setLabel("LAB_ERROR", "Module number must be between 1 and 100")
+                    self.app.setLabel("LAB_ERROR", "Group number field is not numeric")
                     return
                 if not table.isnumeric():
-                    self.app.setLabel("LAB_ERROR", "Module task count is not numeric")
+                    self.app.setLabel("LAB_ERROR", "Table number field is not numeric")
+                    return
+                try:
+                    self.store.put_group(Group(int(number), int(table)),
+                                         replacing=self.item_to_edit if self.is_editing else None)
+                except ValueError as e:  # e.g. the number or the table is already taken
+                    self.app.setLabel("LAB_ERROR", str(e))
                     return
-                # Avoid that two groups end up with the same group number
-                for _group in self.groups:
-                    if _group.number == int(number) and (not self.is_editing or _group.number != self.item_to_edit):
-                        self.app.setLabel("LAB_ERROR", "Group number already taken")
-                        return
-                if self.is_editing:
-                    self.swap_group(self.item_to_edit, Group(int(number), int(table)))
-                else:
-                    self.groups.append(Group(int(number), int(table)))
-                self.persist_groups()
                 self.show_scene(Scene.GROUPS)
 
             self.set_window_size_and_center(500, 300)
@@ -304,18 +245,45 @@ class UserInterface:
             if self.is_editing:
                 self.app.setButton("BTN_SUBMIT_GROUP", "Update group")
                 # find current module
-                current_group = self.get_group(self.item_to_edit)
+                current_group = self.store.group(self.item_to_edit)
                 self.app.setEntry("LAB_NUMBER", current_group.number)
                 self.app.setEntry("LAB_TABLE", current_group.table)
             else:
                 self.app.setButton("BTN_SUBMIT_GROUP", "Add group")
-                self.app.setEntry("LAB_NUMBER", self.get_next_vacant_group_number())
-                self.app.setEntry("LAB_TABLE", self.get_next_vacant_table_number())
+                self.app.setEntry("LAB_NUMBER", self.store.next_vacant_group_number())
+                self.app.setEntry("LAB_TABLE", self.store.next_vacant_table())
             add_whitespace(10, 7)
             self.app.stopLabelFrame()
         else:
             pass
 
 
+def main():
+    """ Without a command, start the configuration app. The commands work without a display """
+    parser = argparse.ArgumentParser(description="Edit the modules and groups of the course")
+    commands = parser.add_subparsers(dest="command")
+    import_parser = commands.add_parser("import", help="import modules and/or groups from CSV or JSON-lines files")
+    import_parser.add_argument("files", nargs="+", help=".csv with a header row, or .jsonl")
+    import_parser.add_argument("--replace", action="store_true",
+                               help="replace all modules (or groups) instead of adding to and updating them")
+    import_parser.add_argument("--dry-run", action="store_true", help="only validate the files")
+    export_parser = commands.add_parser("export", help="export the modules or groups to a CSV or JSON-lines file")
+    export_parser.add_argument("kind", choices=["modules", "groups"])
+    export_parser.add_argument("file")
+    args = parser.parse_args()
+
+    if args.command is None:
+        UserInterface()
+    elif args.command == "import":
+        result = import_files(ConfigStore.load(database=get_store()), args.files, replace=args.replace, dry_run=args.dry_run)
+        print(result.summary())
+        if result.error_count > 0:
+            print(f"{result.error_count} errors, nothing was imported", file=sys.stderr)
+            sys.exit(1)
+    else:
+        count = export_file(ConfigStore.load(), args.kind, args.file)
+        print(f"{count} {args.kind} exported to {args.file}")
+
+
 if __name__ == "__main__":
-    ui = UserInterface()
+    main()